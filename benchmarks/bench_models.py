@@ -0,0 +1,222 @@
+"""Benchmarks for the models layer against synthetic leagues
+
+Run from the repository root, against a scratch database (all tables in it are dropped and recreated):
+
+    python -m benchmarks.bench_models --database spies_bench --scales 500x5000,2000x50000
+    python -m benchmarks.bench_models --temp-cluster --output bench_output.txt
+
+The default scales are leagues of 10k, 100k and 1M games. --scales quick runs two small leagues instead.
+
+--temp-cluster starts a throwaway Postgres cluster with initdb/pg_ctl instead of using an existing server.
+Results are written as one JSON object per line so they can be compared between releases.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+
+@contextlib.contextmanager
+def temporary_postgres():
+    # Start a throwaway Postgres cluster listening on a unix socket in a temp directory, and point libpq at it with PGHOST/PGPORT
+    data_dir = tempfile.mkdtemp(prefix='spiesbench')
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    subprocess.run(['initdb', '-D', data_dir, '-A', 'trust', '-U', 'postgres'], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(['pg_ctl', '-D', data_dir, '-w', '-l', os.path.join(data_dir, 'server.log'),
+                    '-o', f'-k {data_dir} -p {port} -c listen_addresses=\'\' -c fsync=off', 'start'], check=True, stdout=subprocess.DEVNULL)
+    os.environ['PGHOST'], os.environ['PGPORT'] = data_dir, str(port)
+    try:
+        yield 'postgres', 'postgres'
+    finally:
+        subprocess.run(['pg_ctl', '-D', data_dir, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+SCALE_PRESETS = {
+    'default': '1000x10000,5000x100000,20000x1000000',  # the 10k, 100k and 1M game leagues that results are compared at
+    'quick': '200x2000,1000x10000',
+}
+
+
+class BenchmarkRun:
+
+    def __init__(self, models, settings, output, scale, repeat, medians=None):
+        self.models = models
+        self.settings = settings
+        self.output = output
+        self.scale = scale
+        self.repeat = repeat
+        self.revision = git_revision()
+        self.medians = medians if medians is not None else {}  # (benchmark, scale): median seconds, for print_table()
+
+    def record(self, name, samples, **extra):
+        result = {
+            'benchmark': name,
+            'players': self.scale[0],
+            'games': self.scale[1],
+            'runs': len(samples),
+            'min': min(samples),
+            'median': statistics.median(samples),
+            'max': max(samples),
+            'revision': self.revision,
+            'timestamp': datetime.datetime.now().isoformat(),
+        }
+        result.update(extra)
+        self.medians[(name, self.scale)] = result['median']
+        self.output.write(json.dumps(result) + '\n')
+        self.output.flush()
+        print(f'{name:<32} {self.scale[0]:>7}p {self.scale[1]:>8}g  median {result["median"] * 1000:10.2f} ms', file=sys.stderr)
+
+    def time(self, name, func, setup=None, repeat=None, **extra):
+        samples = []
+        for _ in range(repeat if repeat else self.repeat):
+            args = setup() if setup else ()
+            start = timer()
+            func(*args)
+            samples.append(timer() - start)
+        self.record(name, samples, **extra)
+
+
+def reset_schema(models):
+    import modules.migrations as migrations
+    tables = [migrations.SchemaVersion, models.Matchup, models.PendingConfirmation, models.RatingCheckpointEntry, models.RatingCheckpoint, models.PlayerGame, models.Game, models.Player]
+    models.db.drop_tables(tables)
+    migrations.run_migrations()
+
+
+def print_table(medians, scales, file=sys.stderr):
+    # One row per benchmark and one column per scale, each cell the median in ms
+    names = list(dict.fromkeys(name for name, _ in medians))
+    headers = [f'{p}p/{g}g' for p, g in scales]
+    width = max(len(name) for name in names)
+    print(f'{"median ms":<{width}}  ' + '  '.join(f'{h:>16}' for h in headers), file=file)
+    for name in names:
+        cells = [f'{medians[(name, scale)] * 1000:16.2f}' if (name, scale) in medians else f'{"-":>16}' for scale in scales]
+        print(f'{name:<{width}}  ' + '  '.join(cells), file=file)
+
+
+def run_scale(models, settings, output, scale, repeat, seed, medians=None):
+    from benchmarks.league import SyntheticLeague
+
+    player_count, game_count = scale
+    Player, Game = models.Player, models.Game
+    rng = random.Random(seed)
+    run = BenchmarkRun(models, settings, output, scale, repeat, medians=medians)
+
+    reset_schema(models)
+    league = SyntheticLeague(players=player_count, games=game_count, seed=seed, pending_games=repeat * 2)
+    start = timer()
+    players = league.write(models, date_cutoff=settings.date_cutoff)
+    run.record('generate_league', [timer() - start])
+
+    run.time('recalculate_all_elo', Game.recalculate_all_elo, repeat=1)
+
+    sample_ids = [p['id'] for p in rng.sample(players, min(len(players), 50))]
+    sample_players = list(Player.select().where(Player.id.in_(sample_ids)))
+
+    models.rating_index.unload()
+    run.time('leaderboard', lambda: list(Player.leaderboard(date_cutoff=settings.date_cutoff).tuples()))
+    run.time('leaderboard_first_page', lambda: Player.leaderboard_page(date_cutoff=settings.date_cutoff))
+    run.time('leaderboard_last_page', lambda: Player.leaderboard_page(date_cutoff=settings.date_cutoff, last=True))
+    run.time('leaderboard_rank', lambda: [p.leaderboard_rank(settings.date_cutoff) for p in sample_players[:10]], per_call_count=10)
+
+    run.time('rebuild_rating_index', lambda: Player.rebuild_rating_index(date_cutoff=settings.date_cutoff), repeat=1)
+    run.time('leaderboard_rank_indexed', lambda: [p.leaderboard_rank(settings.date_cutoff) for p in sample_players[:10]], per_call_count=10)
+
+    run.time('get_record', lambda: [p.get_record() for p in sample_players[:10]], per_call_count=10)
+
+    search_terms = [p.name[:4] for p in sample_players[:5]] + [p.name for p in sample_players[5:10]] + [f'<@{p.discord_id}>' for p in sample_players[10:15]]
+    run.time('string_matches', lambda: [list(Player.string_matches(term)) for term in search_terms], per_call_count=len(search_terms))
+
+    pending = list(Game.select().where(Game.is_confirmed == 0))
+
+    def next_pending():
+        return (pending.pop(),)
+    run.time('confirm', lambda game: game.confirm(), setup=next_pending)
+
+    def old_game():
+        # a game from roughly the middle of the history, so that deleting it recalculates half the league
+        offset = Game.select().where(Game.is_confirmed == 1).count() // 2 + rng.randint(0, 100)
+        return (Game.select().where(Game.is_confirmed == 1).order_by(Game.completed_ts).offset(offset).get(),)
+    run.time('delete_game', lambda game: game.delete_game(), setup=old_game)
+
+    def late_timestamp():
+        offset = int(Game.select().where(Game.is_confirmed == 1).count() * 0.9)
+        return (Game.select(Game.completed_ts).where(Game.is_confirmed == 1).order_by(Game.completed_ts).offset(offset).scalar(),)
+    run.time('recalculate_elo_since', lambda ts: Game.recalculate_elo_since(ts), setup=late_timestamp)
+
+
+def parse_scales(scales_str):
+    # Comma-separated PLAYERSxGAMES, or the name of one of SCALE_PRESETS
+    scales = []
+    for scale in SCALE_PRESETS.get(scales_str, scales_str).split(','):
+        player_count, game_count = scale.lower().split('x')
+        scales.append((int(player_count), int(game_count)))
+    return scales
+
+
+def add_database_arguments(parser):
+    parser.add_argument('--database', help='Scratch database to use. All bot tables in it are dropped.')
+    parser.add_argument('--user', help='Database user, defaults to psql_user from config.ini')
+    parser.add_argument('--temp-cluster', action='store_true', help='Run against a temporary Postgres cluster created with initdb')
+
+
+def open_database(stack, database=None, user=None, temp_cluster=False):
+    # Point settings at the scratch database, or a temporary cluster, and import the models. Returns (models, settings)
+    import settings
+    if temp_cluster:
+        settings.psql_db, settings.psql_user = stack.enter_context(temporary_postgres())
+    else:
+        settings.psql_db = database
+        settings.psql_user = user if user else settings.psql_user
+
+    # models binds the database when it is imported, so settings have to be overridden first
+    import modules.models as models
+
+    models.db.connect(reuse_if_open=True)
+    stack.callback(models.db.close)
+    return models, settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the models layer against synthetic leagues')
+    add_database_arguments(parser)
+    parser.add_argument('--scales', default='default', help=f'Comma-separated PLAYERSxGAMES, or one of {", ".join(SCALE_PRESETS)}. '
+                        f'default is {SCALE_PRESETS["default"]}')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='File to append JSON results to. Defaults to stdout')
+    args = parser.parse_args()
+    if not args.database and not args.temp_cluster:
+        parser.error('one of --database or --temp-cluster is required')
+
+    with contextlib.ExitStack() as stack:
+        models, settings = open_database(stack, database=args.database, user=args.user, temp_cluster=args.temp_cluster)
+        output = stack.enter_context(open(args.output, 'a')) if args.output else sys.stdout
+        scales, medians = parse_scales(args.scales), {}
+        for scale in scales:
+            run_scale(models, settings, output, scale, repeat=args.repeat, seed=args.seed, medians=medians)
+        print_table(medians, scales)
+
+
+if __name__ == '__main__':
+    main()
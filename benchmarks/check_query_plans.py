@@ -0,0 +1,137 @@
+"""Query plan regression checks for the hot queries in the models layer
+
+Seeds a scratch database with a synthetic league, runs EXPLAIN on every query issued by the hot Player and Game methods,
+and exits with status 1 if any of them reads a table with a sequential scan:
+
+    python -m benchmarks.check_query_plans --database spies_bench
+    python -m benchmarks.check_query_plans --temp-cluster
+
+Sequential scans are disabled for the session while planning, so on a small seeded database the planner still picks an
+index whenever one can serve the query. A Seq Scan in the output means no usable index exists.
+
+Without either option the check is skipped with exit status 0. tests/test_query_plans.py runs the same check under pytest
+when SPIES_TEST_DATABASE or SPIES_TEST_TEMP_CLUSTER is set.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import sys
+
+from benchmarks.bench_models import add_database_arguments, open_database, reset_schema
+
+
+@contextlib.contextmanager
+def captured_queries(db):
+    # Record the SQL and parameters of every SELECT issued through db while the block runs
+    queries = []
+    original_execute_sql = db.execute_sql
+
+    def execute_sql(sql, params=None, *args, **kwargs):
+        if sql.lstrip().upper().startswith('SELECT'):
+            queries.append((sql, params))
+        return original_execute_sql(sql, params, *args, **kwargs)
+
+    db.execute_sql = execute_sql
+    try:
+        yield queries
+    finally:
+        del db.execute_sql
+
+
+def seq_scans(plan):
+    # Yield relation names of every Seq Scan node in an EXPLAIN (FORMAT JSON) plan tree
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan.get('Relation Name')
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def hot_queries(models, settings):
+    # (name, callable) pairs exercising each hot path. Only the queries they issue are checked, their results are ignored.
+    # Player.string_matches() is left out: its ILIKE '%name%' fallback can't use a btree index, and the bot normally answers it from player_name_index
+    Player, Game, PlayerGame = models.Player, models.Game, models.PlayerGame
+    player = Player.select().order_by(Player.games_played.desc()).get()
+    opponent = Player.select().where(Player.id != player.id).order_by(Player.games_played.desc()).get()
+    midpoint = Game.select(Game.completed_ts).where(Game.is_confirmed == 1).order_by(Game.completed_ts).offset(
+        Game.select().where(Game.is_confirmed == 1).count() // 2).scalar()
+
+    return [
+        ('Player.leaderboard', lambda: list(Player.leaderboard(date_cutoff=settings.date_cutoff).tuples())),
+        ('Player.leaderboard max', lambda: list(Player.leaderboard(date_cutoff=settings.date_cutoff, max_flag=True).tuples())),
+        ('Player.leaderboard_page', lambda: Player.leaderboard_page(date_cutoff=settings.date_cutoff, after=(player.elo, player.id))),
+        ('Player.leaderboard_page last', lambda: Player.leaderboard_page(date_cutoff=settings.date_cutoff, last=True)),
+        ('Player.leaderboard_count_above', lambda: Player.leaderboard_count_above(settings.date_cutoff, player.elo)),
+        ('Player.leaderboard_ranks', lambda: Player.leaderboard_ranks([player, opponent], date_cutoff=settings.date_cutoff, use_index=False)),
+        ('Player.wins', lambda: player.wins().count()),
+        ('Player.losses', lambda: player.losses().count()),
+        ('Player.ratings_before', lambda: Player.ratings_before(midpoint, players=[player.id, opponent.id])),
+        ('pending game lookup', lambda: list(Game.select().where(
+            (Game.winning_player == player) & (Game.losing_player == opponent) & (Game.is_confirmed == 0)).tuples())),
+        ('confirmed games since', lambda: list(Game.select(Game.id).where(
+            (Game.is_confirmed == 1) & (Game.completed_ts >= midpoint)).order_by(Game.completed_ts, Game.id).tuples())),
+        ('game lineup', lambda: list(PlayerGame.select().where(PlayerGame.game == Game.select(Game.id).where(Game.is_confirmed == 1).scalar()).tuples())),
+        ('Player.matchup', lambda: player.matchup(opponent)),
+        ('Player.top_rivals', lambda: list(player.top_rivals().tuples())),
+        ('Game.stale_pending_games', lambda: list(Game.stale_pending_games(datetime.datetime.now(), limit=50).tuples())),
+        ('RatingCheckpoint.nearest', lambda: models.RatingCheckpoint.nearest(midpoint)),
+    ]
+
+
+def check_plans(models, settings, players: int, games: int, verbose: bool = False):
+    # Seed a league into the scratch database, EXPLAIN every query issued by hot_queries() and print the result of each.
+    # Returns [(name, sql, [tables read with a sequential scan]), ...] for the queries that fail. Also run by tests/test_query_plans.py
+    from benchmarks.league import SyntheticLeague
+
+    reset_schema(models)
+    SyntheticLeague(players=players, games=games, pending_games=10).write(models, date_cutoff=settings.date_cutoff)
+    models.Game.recalculate_all_elo()
+    models.db.execute_sql('ANALYZE')
+    models.db.execute_sql('SET enable_seqscan = off')
+
+    failures = []
+    try:
+        for name, func in hot_queries(models, settings):
+            with captured_queries(models.db) as queries:
+                func()
+
+            for sql, params in queries:
+                plan = models.db.execute_sql('EXPLAIN (FORMAT JSON) ' + sql, params).fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                scanned = sorted(set(seq_scans(plan[0]['Plan'])))
+                if scanned:
+                    failures.append((name, sql, scanned))
+                    print(f'FAIL {name}: sequential scan on {", ".join(scanned)}\n     {sql}')
+                else:
+                    print(f'ok   {name}')
+                if verbose:
+                    print(json.dumps(plan, indent=2))
+    finally:
+        models.db.execute_sql('SET enable_seqscan = on')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fail if any hot query falls back to a sequential scan')
+    add_database_arguments(parser)
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--games', type=int, default=20000)
+    parser.add_argument('--verbose', action='store_true', help='Print every plan')
+    args = parser.parse_args()
+
+    if not args.database and not args.temp_cluster:
+        print('skipped: no database configured, pass --database or --temp-cluster')
+        return
+
+    with contextlib.ExitStack() as stack:
+        models, settings = open_database(stack, database=args.database, user=args.user, temp_cluster=args.temp_cluster)
+        failures = check_plans(models, settings, players=args.players, games=args.games, verbose=args.verbose)
+
+    if failures:
+        print(f'{len(failures)} hot queries use sequential scans')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import datetime
+import math
+import random
+
+from peewee import chunked
+
+# Synthetic league generator used by the benchmarks. Generates players with a spread of skill and activity, and a history of
+# confirmed games between them, then writes them to the database with bulk inserts.
+
+
+class SyntheticLeague:
+
+    def __init__(self, players: int, games: int, seed: int = 0, active_fraction: float = 0.3, history_days: int = 720,
+                 skill_spread: float = 200.0, pending_games: int = 0):
+        # active_fraction is the share of players who have played since settings.date_cutoff
+        # history_days is how far back the oldest game is
+        self.player_count = players
+        self.game_count = games
+        self.active_fraction = active_fraction
+        self.history_days = history_days
+        self.skill_spread = skill_spread
+        self.pending_game_count = pending_games
+        self.random = random.Random(seed)
+
+    def generate_players(self):
+        # [{id, discord_id, name, skill, activity}, ...] - skill is the player's 'true' ELO used to pick game winners
+        players = []
+        for i in range(1, self.player_count + 1):
+            skill = self.random.gauss(1000, self.skill_spread)
+            activity = self.random.paretovariate(1.2)  # a few players play most of the games
+            players.append({
+                'id': i,
+                'discord_id': 100000000000000000 + i,
+                'name': self._name(i),
+                'skill': skill,
+                'activity': activity,
+            })
+        return players
+
+    def _name(self, i):
+        syllables = ['ka', 'lo', 'mi', 'spy', 'ne', 'luk', 'duf', 'fy', 'ra', 'zo', 'qu', 'tor']
+        length = 2 + i % 3
+        return ''.join(self.random.choice(syllables) for _ in range(length)).title() + str(i)
+
+    def generate_games(self, players, date_cutoff, now=None):
+        # Yields game dicts in completed_ts order. Players outside the active fraction stop playing before date_cutoff.
+        now = now if now else datetime.datetime.now()
+        start = now - datetime.timedelta(days=self.history_days)
+        span = (now - start).total_seconds()
+
+        active_count = max(2, int(len(players) * self.active_fraction))
+        active_ids = set(p['id'] for p in self.random.sample(players, active_count))
+        retired_until = {p['id']: self.random.uniform(start.timestamp(), date_cutoff.timestamp()) for p in players if p['id'] not in active_ids}
+
+        weights = [p['activity'] for p in players]
+        cumulative = []
+        total = 0
+        for w in weights:
+            total += w
+            cumulative.append(total)
+
+        for game_id in range(1, self.game_count + 1):
+            completed_ts = start + datetime.timedelta(seconds=span * game_id / (self.game_count + 1))
+            ts = completed_ts.timestamp()
+            p1, p2 = self._pick_pair(players, cumulative, retired_until, ts)
+
+            chance_p1 = 1 / (1 + 10 ** ((p2['skill'] - p1['skill']) / 400.0))
+            winner, loser = (p1, p2) if self.random.random() < chance_p1 else (p2, p1)
+            closeness = 1 - abs(chance_p1 - 0.5) * 2  # 1 for an even matchup
+            losing_score = self.random.choices([0, 1, 2], weights=[1.5 - closeness, 1.0, 0.5 + closeness])[0]
+
+            yield {
+                'id': game_id,
+                'winning_player': winner['id'],
+                'losing_player': loser['id'],
+                'losing_score': losing_score,
+                'is_confirmed': True,
+                'win_claimed_ts': completed_ts - datetime.timedelta(minutes=self.random.randint(1, 30)),
+                'completed_ts': completed_ts,
+            }
+
+    def _pick_pair(self, players, cumulative, retired_until, ts):
+        for _ in range(100):
+            p1 = players[self._weighted_index(cumulative)]
+            p2 = players[self._weighted_index(cumulative)]
+            if p1 is p2:
+                continue
+            if retired_until.get(p1['id'], math.inf) < ts or retired_until.get(p2['id'], math.inf) < ts:
+                continue
+            return p1, p2
+        # fall back to any two players if the weighted draw keeps hitting retired players
+        return self.random.sample(players, 2)
+
+    def _weighted_index(self, cumulative):
+        target = self.random.random() * cumulative[-1]
+        lo, hi = 0, len(cumulative) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumulative[mid] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def write(self, models, date_cutoff, batch_size=5000):
+        # Bulk insert the league into the database. Ratings are left at the default - run Game.recalculate_all_elo() afterwards
+        db = models.db
+        players = self.generate_players()
+
+        with db.atomic():
+            for batch in chunked(players, batch_size):
+                models.Player.insert_many([{'id': p['id'], 'discord_id': p['discord_id'], 'name': p['name']} for p in batch]).execute()
+
+            game_rows = self.generate_games(players, date_cutoff=date_cutoff)
+            for batch in chunked(game_rows, batch_size):
+                models.Game.insert_many(batch).execute()
+                playergames = []
+                for g in batch:
+                    playergames.append({'player': g['winning_player'], 'game': g['id']})
+                    playergames.append({'player': g['losing_player'], 'game': g['id']})
+                models.PlayerGame.insert_many(playergames).execute()
+
+            for i in range(self.pending_game_count):
+                p1, p2 = self.random.sample(players, 2)
+                game_id = self.game_count + i + 1
+                models.Game.insert(id=game_id, winning_player=p1['id'], losing_player=p2['id'],
+                                   losing_score=self.random.choice([0, 1, 2]), is_confirmed=False).execute()
+                models.PlayerGame.insert_many([{'player': p1['id'], 'game': game_id}, {'player': p2['id'], 'game': game_id}]).execute()
+
+            for table in ('player', 'game'):
+                db.execute_sql(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+
+        return players
@@ -4,6 +4,9 @@ import traceback
 from discord.ext import commands
 from modules import models
 from modules import utilities
+from modules import migrations
+from modules import instrumentation
+from modules.logqueue import log_queue
 import settings
 import logging
 import sys
@@ -13,27 +16,40 @@ from timeit import default_timer as timer
 
 
 # Logger config is a bit of a mess and probably could be simplified a lot, but works. debug and above sent to file / error above sent to stderr
+# Every handler is wrapped by log_queue, so loggers only put records on a queue and a background thread does the writing. See modules/logqueue.py
 handler = RotatingFileHandler(filename='logs/full_bot.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=10)
 partial_handler = RotatingFileHandler(filename='logs/discord.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=10)  # without peewee logging
 elo_handler = RotatingFileHandler(filename='logs/elo.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=5)
+metrics_handler = RotatingFileHandler(filename='logs/metrics.log', encoding='utf-8', maxBytes=1024 * 1024 * 5, backupCount=5)
 
 handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
 partial_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
 elo_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
 
+err = logging.StreamHandler(sys.stderr)
+err.setLevel(logging.ERROR)
+err.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+
+queued_handler = log_queue.wrap(handler)
+queued_partial_handler = log_queue.wrap(partial_handler)
+queued_err = log_queue.wrap(err)
+
 my_logger = logging.getLogger('spiesbot')
 my_logger.setLevel(logging.DEBUG)
-my_logger.addHandler(handler)  # root handler for app. module-specific loggers will inherit this
-my_logger.addHandler(partial_handler)
+my_logger.addHandler(queued_handler)  # root handler for app. module-specific loggers will inherit this
+my_logger.addHandler(queued_partial_handler)
+my_logger.addHandler(queued_err)
 
 elo_logger = logging.getLogger('spiesbot.elo')
 elo_logger.setLevel(logging.DEBUG)
-elo_logger.addHandler(elo_handler)
+elo_logger.addHandler(log_queue.wrap(elo_handler))
 
-err = logging.StreamHandler(sys.stderr)
-err.setLevel(logging.ERROR)
-err.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-my_logger.addHandler(err)
+# one JSON object per command invocation, see modules/instrumentation.py. Kept out of the main logs
+metrics_handler.setFormatter(logging.Formatter('%(message)s'))
+metrics_logger = logging.getLogger('spiesbot.metrics')
+metrics_logger.setLevel(logging.INFO)
+metrics_logger.propagate = False
+metrics_logger.addHandler(log_queue.wrap(metrics_handler))
 
 
 discord_logger = logging.getLogger('discord')
@@ -42,8 +58,8 @@ discord_logger.setLevel(logging.INFO)
 if (discord_logger.hasHandlers()):
     discord_logger.handlers.clear()
 
-discord_logger.addHandler(handler)
-discord_logger.addHandler(partial_handler)
+discord_logger.addHandler(queued_handler)
+discord_logger.addHandler(queued_partial_handler)
 
 logger_peewee = logging.getLogger('peewee')
 logger_peewee.setLevel(logging.DEBUG)
@@ -51,7 +67,10 @@ logger_peewee.setLevel(logging.DEBUG)
 if (logger_peewee.hasHandlers()):
     logger_peewee.handlers.clear()
 
-logger_peewee.addHandler(handler)
+logger_peewee.addHandler(queued_handler)
+# peewee logs every SQL statement, so limit how much of it reaches full_bot.log
+log_queue.rate_limit('peewee', rate=settings.sql_log_rate, burst=settings.sql_log_burst)
+log_queue.start()
 
 logger = logging.getLogger('spiesbot.' + __name__)
 
@@ -62,10 +81,16 @@ def main():
     parser.add_argument('--recalc_elo', action='store_true')
     parser.add_argument('--skip_tasks', action='store_true')
     args = parser.parse_args()
+
+    applied = migrations.run_migrations()
+    if applied:
+        logger.warn(f'Applied schema migrations {applied}')
+
     if args.recalc_elo:
         print('Recalculating all ELO')
         start = timer()
-        models.Game.recalculate_all_elo()
+        with utilities.connection():
+            models.Game.recalculate_all_elo()
         end = timer()
         print(f'Recalculation complete - took {end - start} seconds.')
         exit(0)
@@ -89,17 +114,14 @@ def main():
 
 
 def get_prefix(bot, message):
-    # Guild-specific command prefixes
-    if message.guild and message.guild.id in settings.config:
+    # Guild-specific command prefixes. Runs for every message, so the prefix list comes prebuilt from the guild's settings snapshot
+    prefixes = settings.guild_prefixes(bot, message.guild.id) if message.guild else None
+    if prefixes:
         # Current guild is allowed
-        set_prefix = settings.guild_setting(message.guild.id, "command_prefix")
-        if not set_prefix:
+        if not prefixes[-1]:
             logger.error(f'No prefix found in settings! Guild: {message.guild.id} {message.guild.name}')
             return 'fakeprefix'
-
-        # temp debug log to try to fix NoneType errors related to prefixes
-        # logger.debug(f'Found prefix setting {settings.guild_setting(message.guild.id, "command_prefix")} for guild {message.guild.id}')
-        return commands.when_mentioned_or(settings.guild_setting(message.guild.id, 'command_prefix'))(bot, message)
+        return prefixes
     else:
         if message.guild:
             logger.error(f'Message received not from allowed guild. ID {message.guild.id }')
@@ -170,8 +192,13 @@ if __name__ == '__main__':
 
     @bot.before_invoke
     async def pre_invoke_setup(ctx):
-        utilities.connect()
+        # database work happens on the dbexecutor threads, which connect on their own
         logger.debug(f'Command invoked: {ctx.message.clean_content}. By {ctx.message.author.name} in {ctx.channel.id} {ctx.channel.name} on {ctx.guild.name}')
+        instrumentation.start_invocation(ctx.command.qualified_name, guild_id=ctx.guild.id, author_id=ctx.author.id)
+
+    @bot.after_invoke
+    async def post_invoke_metrics(ctx):
+        instrumentation.finish_invocation(failed=ctx.command_failed)
 
     initial_extensions = ['modules.games', 'modules.customhelp']
     for extension in initial_extensions:
@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import heapq
+import logging
+
+import discord
+
+import settings
+from modules.models import PendingConfirmation
+from modules.dbexecutor import db_executor
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+CONFIRM_EMOJI = '✅'
+REJECT_EMOJI = '❌'
+
+
+class ConfirmationScheduler:
+    # Tracks every claimed game waiting for its loser to react, replacing a bot.wait_for() coroutine per game.
+    # Pending claims are stored in the PendingConfirmation table so they survive restarts, and held in memory by message ID so
+    # each raw reaction event is matched with a dict lookup. A single task sleeps until the earliest expiry in a heap of
+    # (expires_ts, game_id) and auto-confirms whatever has expired.
+    # Resolving a claim is left to the on_confirm(channel, game_id, auto) and on_reject(channel, game_id) coroutines.
+
+    def __init__(self, bot, on_confirm, on_reject):
+        self.bot = bot
+        self.on_confirm = on_confirm
+        self.on_reject = on_reject
+        self._by_message = {}  # message_id: PendingConfirmation
+        self._by_game = {}  # game_id: PendingConfirmation
+        self._heap = []  # (expires_ts, game_id). Entries for games no longer in _by_game, or with a changed expiry, are skipped when popped
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._by_game)
+
+    async def start(self):
+        # Load pending claims from the database and start the timer task. Claims that expired while the bot was offline fire straight away
+        if self._task:
+            return
+        pending = await db_executor.run(lambda: list(PendingConfirmation.select()))
+        for entry in pending:
+            self._track(entry)
+        logger.info(f'Loaded {len(pending)} pending confirmations')
+        self._task = self.bot.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _track(self, entry):
+        self._by_message[entry.message_id] = entry
+        self._by_game[entry.game_id] = entry
+        heapq.heappush(self._heap, (entry.expires_ts, entry.game_id))
+
+    def _untrack(self, game_id):
+        entry = self._by_game.pop(game_id, None)
+        if entry:
+            self._by_message.pop(entry.message_id, None)
+        return entry
+
+    async def schedule(self, game, message, losing_member):
+        # Start waiting for losing_member to confirm game by reacting to message
+        entry = PendingConfirmation(game=game.id, guild_id=message.guild.id, channel_id=message.channel.id, message_id=message.id,
+                                    loser_discord_id=losing_member.id, expires_ts=datetime.datetime.now() + datetime.timedelta(seconds=settings.confirmation_timeout))
+        await db_executor.run(entry.save, force_insert=True)
+        self._track(entry)
+        self._wake.set()
+
+        await message.add_reaction(CONFIRM_EMOJI)
+        await message.add_reaction(REJECT_EMOJI)
+
+    async def cancel(self, game_id):
+        # Stop waiting on a game that was confirmed or deleted some other way. Returns True if it was pending
+        entry = self._untrack(game_id)
+        claimed = await db_executor.run(PendingConfirmation.claim, game_id)
+        if entry:
+            await self._clear_reactions(entry)
+        return claimed
+
+    def is_pending(self, game_id):
+        return game_id in self._by_game
+
+    async def handle_reaction(self, payload):
+        # Called from on_raw_reaction_add for every reaction the bot sees
+        entry = self._by_message.get(payload.message_id)
+        if entry is None or payload.user_id != entry.loser_discord_id:
+            return
+
+        emoji = str(payload.emoji)
+        if emoji.startswith(CONFIRM_EMOJI):
+            await self._resolve(entry, confirmed=True, auto=False)
+        elif emoji.startswith(REJECT_EMOJI):
+            await self._resolve(entry, confirmed=False, auto=False)
+
+    async def _resolve(self, entry, confirmed: bool, auto: bool):
+        if self._by_game.get(entry.game_id) is not entry:
+            return
+        self._untrack(entry.game_id)
+        try:
+            if not await db_executor.run(PendingConfirmation.claim, entry.game_id, reject=not confirmed):
+                # Already resolved elsewhere, or the game was deleted
+                return
+
+            await self._clear_reactions(entry)
+            channel = self.bot.get_channel(entry.channel_id)
+            if channel is None:
+                logger.warn(f'Channel {entry.channel_id} for pending game {entry.game_id} is gone')
+            if confirmed:
+                await self.on_confirm(channel, entry.game_id, auto=auto)
+            else:
+                await self.on_reject(channel, entry.game_id)
+        except Exception:
+            logger.exception(f'Error resolving pending confirmation for game {entry.game_id}')
+
+    async def _clear_reactions(self, entry):
+        channel = self.bot.get_channel(entry.channel_id)
+        if channel is None:
+            return
+        try:
+            message = await channel.fetch_message(entry.message_id)
+            await message.remove_reaction(CONFIRM_EMOJI, self.bot.user)
+            await message.remove_reaction(REJECT_EMOJI, self.bot.user)
+        except discord.DiscordException as e:
+            logger.debug(f'Could not remove confirmation reactions for game {entry.game_id}: {e}')
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = datetime.datetime.now()
+            while self._heap and self._heap[0][0] <= now:
+                expires_ts, game_id = heapq.heappop(self._heap)
+                entry = self._by_game.get(game_id)
+                if entry and entry.expires_ts == expires_ts:
+                    logger.info(f'Pending confirmation for game {game_id} expired')
+                    self.bot.loop.create_task(self._resolve(entry, confirmed=True, auto=True))
+
+            timeout = (self._heap[0][0] - now).total_seconds() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,111 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import threading
+from timeit import default_timer as timer
+
+import modules.instrumentation as instrumentation
+import modules.models as models
+import modules.utilities as utilities
+import settings
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+
+class DatabaseExecutor:
+    # Bounded thread pool that runs all synchronous peewee work, so database queries never block the event loop.
+    # Usage: result = await db_executor.run(Player.get_or_create, discord_id=123, defaults={'name': 'Nelluk'})
+    # Work that changes ratings (confirming, deleting or recalculating games) goes through run_serialized() instead, which runs
+    # jobs one at a time on a separate thread so rating changes are applied in the order they were submitted.
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='spiesbot-db')
+        self._serial_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='spiesbot-db-serial')
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits = collections.deque(maxlen=500)
+        self.recent_run_times = collections.deque(maxlen=500)
+
+    def _job(self, submitted_at, func, args, kwargs):
+        started_at = timer()
+        wait = started_at - submitted_at
+        with self._lock:
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.recent_waits.append(wait)
+        instrumentation.record_executor_wait(wait)
+
+        try:
+            with utilities.connection():
+                return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.completed += 1
+                self.recent_run_times.append(timer() - started_at)
+
+    async def _submit(self, executor, func, args, kwargs):
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            self.submitted += 1
+        # run the job in a copy of the caller's context, so its queries are charged to the command that submitted it
+        context = contextvars.copy_context()
+        job = functools.partial(context.run, self._job, timer(), func, args, kwargs)
+        return await loop.run_in_executor(executor, job)
+
+    async def run(self, func, *args, **kwargs):
+        return await self._submit(self._executor, func, args, kwargs)
+
+    async def run_serialized(self, func, *args, **kwargs):
+        # Run func after every job previously submitted with run_serialized() has finished
+        return await self._submit(self._serial_executor, func, args, kwargs)
+
+    def queue_depth(self):
+        # jobs submitted but not yet picked up by a worker thread
+        with self._lock:
+            return self.submitted - self.started
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self.recent_waits)
+            run_times = sorted(self.recent_run_times)
+
+            def percentile(samples, pct):
+                return samples[min(len(samples) - 1, int(len(samples) * pct))] if samples else 0.0
+
+            return {
+                'workers': self.max_workers,
+                'queue_depth': self.submitted - self.started,
+                'running': self.started - self.completed,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait': self.total_wait / self.started if self.started else 0.0,
+                'max_wait': self.max_wait,
+                'p50_wait': percentile(waits, 0.5),
+                'p95_wait': percentile(waits, 0.95),
+                'p50_run': percentile(run_times, 0.5),
+                'p95_run': percentile(run_times, 0.95),
+            }
+
+    def pool_stats(self):
+        return models.pool_stats()
+
+    def shutdown(self, wait=True):
+        self._serial_executor.shutdown(wait=wait)
+        self._executor.shutdown(wait=wait)
+
+
+db_executor = DatabaseExecutor(max_workers=settings.db_executor_workers)
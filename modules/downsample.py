@@ -0,0 +1,48 @@
+import datetime
+from array import array
+
+# Downsampling for rating history graphs, see modules/graphs.py. Kept free of settings and discord imports so it can be tested on its own
+
+
+def lttb(xs, ys, threshold: int):
+    # Largest-Triangle-Three-Buckets downsampling. Returns the indexes of at most threshold points that keep the shape of the
+    # series, always including the first and last. Runs in O(len(xs)) time and only allocates the returned list
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    selected = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket is the third point of the triangle
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        count = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / count
+        avg_y = sum(ys[next_start:next_end]) / count
+
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+
+    selected.append(n - 1)
+    return selected
+
+
+def downsample_history(rows, threshold: int):
+    # rows is an iterable of (completed_ts, elo) in time order. Returns ([datetime, ...], [elo, ...]) with at most threshold points.
+    # Only the timestamps and ELOs are held for the whole series, as floats in arrays. Datetimes are rebuilt for the selected points
+    xs, ys = array('d'), array('d')
+    for completed_ts, elo in rows:
+        xs.append(completed_ts.timestamp())
+        ys.append(elo)
+    keep = lttb(xs, ys, threshold)
+    return [datetime.datetime.fromtimestamp(xs[i]) for i in keep], [int(ys[i]) for i in keep]
@@ -0,0 +1,130 @@
+from array import array
+import logging
+from timeit import default_timer as timer
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+DEFAULT_ELO = 1000
+MAX_ELO_DELTA = 32  # elo 'k' value
+
+
+def chance_of_winning(target_elo, opponent_elo):
+    # Calculate the expected chance of winning based on one player's elo compared to their opponent's elo.
+    return round(1 / (1 + (10 ** ((opponent_elo - target_elo) / 400.0))), 3)
+
+
+def elo_delta(winner_elo, loser_elo, losing_score, for_winner=True):
+    # ELO change for one side of a game, given both players' ELO before the game. Used by Game.calc_elo_delta() and the replay engine
+
+    # Calculate a base change of elo based on your chance of winning and whether or not you won
+    if for_winner is True:
+        elo = winner_elo
+        delta = int(round((MAX_ELO_DELTA * (1 - chance_of_winning(target_elo=elo, opponent_elo=loser_elo))), 0))
+    else:
+        elo = loser_elo
+        delta = int(round((MAX_ELO_DELTA * (0 - chance_of_winning(target_elo=elo, opponent_elo=winner_elo))), 0))
+
+    elo_boost = .60 * ((1200 - max(min(elo, 1200), 900)) / 300)  # 60% boost to delta at elo 900, gradually shifts to 0% boost at 1200 ELO
+
+    elo_bonus = int(abs(delta) * elo_boost)
+    delta += elo_bonus
+
+    if losing_score == 0:
+        delta = int(round(delta * 1.15))  # larger delta for a 3-0 blowout
+    elif losing_score == 2:
+        delta = int(round(delta * 0.85))  # smaller delta for a 3-2 close game
+
+    return delta
+
+
+class ReplayResult:
+    # Output of replay_games(). Per-game results are kept in parallel arrays, in the order the games were replayed
+
+    def __init__(self):
+        self.player_ids = []  # dense index -> player_id
+        self.elo = array('i')
+        self.elo_max = array('i')
+
+        self.game_ids = array('q')
+        self.winner_index = array('i')
+        self.loser_index = array('i')
+        self.winner_delta = array('i')
+        self.loser_delta = array('i')
+        self.winner_elo_after = array('i')
+        self.loser_elo_after = array('i')
+        self.timings = {}
+
+    def __len__(self):
+        return len(self.game_ids)
+
+    def player_ratings(self):
+        # [(player_id, elo, elo_max), ...] for every player touched by the replay
+        return list(zip(self.player_ids, self.elo, self.elo_max))
+
+    def game_changes(self):
+        # [(game_id, elo_change_winner, elo_change_loser), ...]
+        return list(zip(self.game_ids, self.winner_delta, self.loser_delta))
+
+    def playergame_elos(self):
+        # [(game_id, player_id, elo_after_game), ...] - two rows per game
+        rows = []
+        player_ids = self.player_ids
+        for i in range(len(self.game_ids)):
+            rows.append((self.game_ids[i], player_ids[self.winner_index[i]], self.winner_elo_after[i]))
+            rows.append((self.game_ids[i], player_ids[self.loser_index[i]], self.loser_elo_after[i]))
+        return rows
+
+
+def replay_games(games, seed_ratings=None, players=(), checkpoint_every=None, on_checkpoint=None):
+    # Replay ELO changes in memory, in the same way as Game.confirm() would if each game was confirmed in order.
+    # games is an iterable of (game_id, winning_player_id, losing_player_id, losing_score, completed_ts), ordered by completed_ts
+    # seed_ratings is an optional {player_id: (elo, elo_max)} of ratings before the first game. Other players start at DEFAULT_ELO
+    # players is an optional list of player_ids to include in the result even if they have no games to replay
+    # If checkpoint_every is set, on_checkpoint(result, game_id, completed_ts) is called after every checkpoint_every games
+
+    start = timer()
+    result = ReplayResult()
+    seed_ratings = seed_ratings if seed_ratings else {}
+    player_index = {}
+    elo, elo_max = result.elo, result.elo_max
+
+    def index_for(player_id):
+        try:
+            return player_index[player_id]
+        except KeyError:
+            i = player_index[player_id] = len(result.player_ids)
+            result.player_ids.append(player_id)
+            seed_elo, seed_max = seed_ratings.get(player_id, (DEFAULT_ELO, DEFAULT_ELO))
+            elo.append(seed_elo)
+            elo_max.append(seed_max)
+            return i
+
+    for player_id in players:
+        index_for(player_id)
+
+    for game_id, winner_id, loser_id, losing_score, completed_ts in games:
+        w, l = index_for(winner_id), index_for(loser_id)
+        winner_elo, loser_elo = elo[w], elo[l]
+
+        winner_delta = elo_delta(winner_elo, loser_elo, losing_score, for_winner=True)
+        loser_delta = elo_delta(winner_elo, loser_elo, losing_score, for_winner=False)
+
+        elo[w] = int(winner_elo + winner_delta)
+        if elo[w] > elo_max[w]:
+            elo_max[w] = elo[w]
+        elo[l] = int(loser_elo + loser_delta)
+
+        result.game_ids.append(game_id)
+        result.winner_index.append(w)
+        result.loser_index.append(l)
+        result.winner_delta.append(winner_delta)
+        result.loser_delta.append(loser_delta)
+        result.winner_elo_after.append(elo[w])
+        result.loser_elo_after.append(elo[l])
+
+        if checkpoint_every and len(result.game_ids) % checkpoint_every == 0:
+            on_checkpoint(result, game_id, completed_ts)
+
+    result.timings['replay'] = timer() - start
+    logger.debug(f'Replayed {len(result)} games for {len(result.player_ids)} players in {result.timings["replay"]:.3f}s')
+    return result
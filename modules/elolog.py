@@ -0,0 +1,6 @@
+import settings
+from modules.eventstore import EloEventLog
+
+# The ELO event log, see modules/eventstore.py for its format
+
+elo_event_log = EloEventLog(directory=settings.elo_event_log_dir, segment_max_bytes=settings.elo_event_segment_bytes)
@@ -0,0 +1,252 @@
+import bisect
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+from array import array
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+# Append-only log of every rating change, written by Game.confirm(), Game.delete_game(), Game.reverse_confirmation() and the recalculation routines.
+# Unlike the free-text spiesbot.elo log it is never rotated away, and each line is a JSON object that can be read back:
+#
+#   {"seq": 1041, "ts": 1591027385.1, "event": "confirm", "game": 812, "completed": 1591027385.0,
+#    "winner": 3, "winner_before": 1014, "winner_after": 1031, "winner_delta": 17,
+#    "loser": 9, "loser_before": 1102, "loser_after": 1087, "loser_delta": -15}
+#
+# event is one of:
+#   'confirm'  a game was confirmed
+#   'delete'   a confirmed game was deleted. before is the player's ELO before the delete, after is their ELO once the game and every
+#              later game were replayed without it. Written ahead of the 'recalc' records of that replay, if there are any
+#   'reverse'  as 'delete', for a confirmed game that was returned to the unconfirmed state by Game.reverse_confirmation()
+#   'recalc'   a game's result after a replay, ie after an earlier game was deleted
+# ts is when the record was written and only ever increases, so it is what since() searches on. completed is the game's completed_ts.
+#
+# Records go into segment files events-NNNNNN.jsonl, and a new segment is started once the current one reaches segment_max_bytes.
+# When a segment is finished an events-NNNNNN.idx file is written next to it, holding the segment's time range, a sparse
+# (ts, offset) index and the offsets of each player's records. These are loaded at startup, so for_player() and since() seek
+# straight to the matching lines instead of reading the whole log. Only the current segment is scanned when the log is opened.
+#
+# The bot's instance is elo_event_log in modules/elolog.py. This module has no settings or discord imports so it can be tested on its own.
+
+SPARSE_EVERY = 256  # records between entries in a segment's (ts, offset) index
+
+
+def _timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+class _Segment:
+
+    def __init__(self, number: int, path: str):
+        self.number = number
+        self.path = path
+        self.index_path = path[:-len('.jsonl')] + '.idx'
+        self.count = 0
+        self.first_seq = None
+        self.last_seq = None
+        self.first_ts = None
+        self.last_ts = None
+        self.sparse_ts = []  # ts of every SPARSE_EVERY'th record
+        self.sparse_offsets = []
+        self.players = {}  # player_id: array of byte offsets of that player's records
+
+    def add(self, record, offset):
+        if self.first_seq is None:
+            self.first_seq, self.first_ts = record['seq'], record['ts']
+        self.last_seq, self.last_ts = record['seq'], record['ts']
+        if self.count % SPARSE_EVERY == 0:
+            self.sparse_ts.append(record['ts'])
+            self.sparse_offsets.append(offset)
+        self.count += 1
+        for key in ('winner', 'loser'):
+            self.players.setdefault(record[key], array('q')).append(offset)
+
+    def scan(self):
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # partial line from a crash mid-write. Truncate it so the next record starts on a fresh line
+                    logger.warn(f'Truncating partial record at offset {offset} of {self.path}')
+                    with open(self.path, 'r+b') as truncate:
+                        truncate.truncate(offset)
+                    break
+                self.add(json.loads(line), offset)
+                offset += len(line)
+
+    def save_index(self):
+        data = {
+            'count': self.count, 'first_seq': self.first_seq, 'last_seq': self.last_seq, 'first_ts': self.first_ts, 'last_ts': self.last_ts,
+            'sparse_ts': self.sparse_ts, 'sparse_offsets': self.sparse_offsets,
+            'players': {str(p): offsets.tolist() for p, offsets in self.players.items()},
+        }
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+    def load_index(self):
+        with open(self.index_path) as f:
+            data = json.load(f)
+        self.count, self.first_seq, self.last_seq = data['count'], data['first_seq'], data['last_seq']
+        self.first_ts, self.last_ts = data['first_ts'], data['last_ts']
+        self.sparse_ts, self.sparse_offsets = data['sparse_ts'], data['sparse_offsets']
+        self.players = {int(p): array('q', offsets) for p, offsets in data['players'].items()}
+
+    def read_at(self, offsets):
+        with open(self.path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield json.loads(f.readline())
+
+    def read_since(self, ts, end=None):
+        # Records with ts >= ts, starting from the last sparse index entry before ts. Stops at byte offset end if given,
+        # so that a record being written to the current segment is never read half-finished
+        i = max(0, bisect.bisect_left(self.sparse_ts, ts) - 1)
+        start = self.sparse_offsets[i] if self.sparse_offsets else 0
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if end is not None and f.tell() > end:
+                    break
+                record = json.loads(line)
+                if record['ts'] >= ts:
+                    yield record
+
+
+class EloEventLog:
+
+    def __init__(self, directory: str, segment_max_bytes: int):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.RLock()
+        self._segments = []
+        self._file = None
+        self._seq = 0
+        self._last_ts = 0.0
+
+    def open(self):
+        # Load segment indexes and open the newest segment for appending. Called on first use
+        with self._lock:
+            if self._file:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._segments = []
+            paths = sorted(glob.glob(os.path.join(self.directory, 'events-*.jsonl')))
+            for i, path in enumerate(paths):
+                segment = _Segment(int(os.path.basename(path)[7:13]), path)
+                is_current = i == len(paths) - 1
+                if not is_current and os.path.exists(segment.index_path):
+                    segment.load_index()
+                else:
+                    segment.scan()
+                    if not is_current:
+                        segment.save_index()
+                self._segments.append(segment)
+
+            if not self._segments:
+                self._segments.append(self._new_segment(1))
+            current = self._segments[-1]
+            self._seq = max((s.last_seq for s in self._segments if s.last_seq is not None), default=0)
+            self._last_ts = max((s.last_ts for s in self._segments if s.last_ts is not None), default=0.0)
+            self._file = open(current.path, 'ab')
+            logger.info(f'ELO event log opened with {sum(s.count for s in self._segments)} records in {len(self._segments)} segments')
+
+    def _new_segment(self, number):
+        return _Segment(number, os.path.join(self.directory, f'events-{number:06d}.jsonl'))
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def append(self, records):
+        # Write records (dicts without seq / ts) as one batch. Logged and ignored on failure, so that a full disk can't stop games being confirmed
+        try:
+            with self._lock:
+                self.open()
+                ts = max(datetime.datetime.now().timestamp(), self._last_ts)
+                for record in records:
+                    self._seq += 1
+                    record = dict(seq=self._seq, ts=ts, **record)
+                    segment = self._segments[-1]
+                    offset = self._file.tell()
+                    self._file.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+                    segment.add(record, offset)
+                    if self._file.tell() >= self.segment_max_bytes:
+                        self._roll()
+                self._file.flush()
+                self._last_ts = ts
+        except (OSError, ValueError):
+            logger.exception('Could not write to ELO event log')
+
+    def _roll(self):
+        self._file.close()
+        self._segments[-1].save_index()
+        segment = self._new_segment(self._segments[-1].number + 1)
+        self._segments.append(segment)
+        self._file = open(segment.path, 'ab')
+
+    def record_game(self, event: str, game_id: int, completed_ts, winner_id: int, winner_before: int, winner_after: int,
+                    loser_id: int, loser_before: int, loser_after: int):
+        self.append([self._game_record(event, game_id, completed_ts, winner_id, winner_before, winner_after, loser_id, loser_before, loser_after)])
+
+    def _game_record(self, event, game_id, completed_ts, winner_id, winner_before, winner_after, loser_id, loser_before, loser_after):
+        return {
+            'event': event, 'game': game_id, 'completed': _timestamp(completed_ts),
+            'winner': winner_id, 'winner_before': winner_before, 'winner_after': winner_after, 'winner_delta': winner_after - winner_before,
+            'loser': loser_id, 'loser_before': loser_before, 'loser_after': loser_after, 'loser_delta': loser_after - loser_before,
+        }
+
+    def record_replay(self, result, completed_ts=None):
+        # One 'recalc' record per game in an elo_engine.ReplayResult. completed_ts is an optional {game_id: completed_ts}
+        completed_ts = completed_ts or {}
+        player_ids = result.player_ids
+        records = []
+        for i, game_id in enumerate(result.game_ids):
+            winner_after, loser_after = result.winner_elo_after[i], result.loser_elo_after[i]
+            records.append(self._game_record(
+                'recalc', game_id, completed_ts.get(game_id),
+                player_ids[result.winner_index[i]], winner_after - result.winner_delta[i], winner_after,
+                player_ids[result.loser_index[i]], loser_after - result.loser_delta[i], loser_after,
+            ))
+        self.append(records)
+
+    def ratings(self):
+        # {player_id: elo} as of each player's latest record, ie the ratings rebuilt by replaying the whole log
+        ratings = {}
+        for record in self.since(0):
+            ratings[record['winner']] = record['winner_after']
+            ratings[record['loser']] = record['loser_after']
+        return ratings
+
+    def for_player(self, player_id: int, since=None):
+        # Every record involving player_id, oldest first. since is an optional datetime or timestamp
+        since = _timestamp(since)
+        with self._lock:
+            self.open()
+            self._file.flush()
+            segments = [(s, s.players.get(player_id, array('q')).tolist()) for s in self._segments]
+        for segment, offsets in segments:
+            if not offsets or (since is not None and segment.last_ts < since):
+                continue
+            for record in segment.read_at(offsets):
+                if since is None or record['ts'] >= since:
+                    yield record
+
+    def since(self, since):
+        # Every record written at or after since (a datetime or timestamp), oldest first
+        since = _timestamp(since)
+        with self._lock:
+            self.open()
+            self._file.flush()
+            current_end = self._file.tell()
+            segments = [(s, current_end if s is self._segments[-1] else None) for s in self._segments if s.count and s.last_ts >= since]
+        for segment, end in segments:
+            yield from segment.read_since(since, end=end)
@@ -1,12 +1,26 @@
 import discord
 from discord.ext import commands
 import modules.utilities as utilities
+import modules.nameindex as nameindex
 import settings
 # import modules.exceptions as exceptions
 import peewee
 from modules.models import Game, Player, db
+from modules.ratingindex import rating_index
+from modules.rendercache import render_cache
+from modules.dbexecutor import db_executor
+from modules.confirmations import ConfirmationScheduler
+from modules.rolesync import RoleSync
+from modules.logqueue import log_queue
+from modules.elolog import elo_event_log
+import modules.graphs as graphs
+import io
+import functools
+import modules.instrumentation as instrumentation
 import logging
 import datetime
+import asyncio
+from timeit import default_timer as timer
 
 logger = logging.getLogger('spiesbot.' + __name__)
 elo_logger = logging.getLogger('spiesbot.elo')
@@ -14,13 +28,114 @@ elo_logger = logging.getLogger('spiesbot.elo')
 yesterday = (datetime.datetime.now() + datetime.timedelta(hours=-24))
 
 
+class LeaderboardPages(utilities.PageProvider):
+    # Loads leaderboard pages on demand with Player.leaderboard_page(), keyed off the first/last row of a neighbouring page,
+    # and prefetches the pages either side of the one being shown. Only pages near the current one are kept, but every
+    # page is also stored in render_cache so that other lb commands can reuse it until the ratings change.
+
+    def __init__(self, date_cutoff, max_flag: bool = False, page_size: int = 12, keep_pages: int = 2):
+        self.date_cutoff = date_cutoff
+        self.max_flag = max_flag
+        self.page_size = page_size
+        self.keep_pages = keep_pages
+        self.total = 0
+        self._pages = {}  # page number: asyncio.Task resolving to [(rank, row), ...]
+
+    def _cache_key(self, *key):
+        return ('lb', self.date_cutoff, self.max_flag, self.page_size) + key
+
+    async def load(self):
+        def count():
+            return Player.leaderboard(date_cutoff=self.date_cutoff, max_flag=self.max_flag).order_by().count()
+        self.total = await db_executor.run(render_cache.get_or_compute, self._cache_key('total'), count)
+        return self
+
+    def _elo(self, row):
+        return row[3] if self.max_flag else row[2]
+
+    def _ranked(self, rows, position, previous=None):
+        # Ties share a rank, so each row's rank is its position unless it ties the row before it.
+        # previous is the (rank, row) just before rows, if known. Otherwise the first rank is counted from the database.
+        ranked = []
+        for row in rows:
+            if previous and self._elo(previous[1]) == self._elo(row):
+                rank = previous[0]
+            elif previous or ranked:
+                rank = position
+            else:
+                rank = Player.leaderboard_count_above(self.date_cutoff, self._elo(row), max_flag=self.max_flag) + 1
+            previous = (rank, row)
+            ranked.append(previous)
+            position += 1
+        return ranked
+
+    async def _fetch(self, page):
+        # Pages are cached by number. That stays correct because a cached page is only valid until the next rating change,
+        # which also invalidates the cached total that the page numbers were counted from
+        version = render_cache.version
+        ranked = render_cache.get(self._cache_key(page))
+        if ranked is None:
+            ranked = await self._query(page)
+            render_cache.put(self._cache_key(page), ranked, version=version)
+        return ranked
+
+    async def _query(self, page):
+        position = page * self.page_size + 1
+        kwargs = {'date_cutoff': self.date_cutoff, 'max_flag': self.max_flag, 'limit': self.page_size}
+        previous = None
+
+        if page == 0:
+            pass
+        elif page == self.page_count() - 1:
+            kwargs.update(last=True, limit=self.total - page * self.page_size)
+        elif page - 1 in self._pages:
+            previous_page = await self._pages[page - 1]
+            previous = previous_page[-1] if previous_page else None
+            kwargs.update(after=(self._elo(previous[1]), previous[1][0]) if previous else None)
+        elif page + 1 in self._pages:
+            next_page = await self._pages[page + 1]
+            kwargs.update(before=(self._elo(next_page[0][1]), next_page[0][1][0]) if next_page else None)
+        else:
+            kwargs.update(offset=page * self.page_size)
+
+        def fetch():
+            return self._ranked(Player.leaderboard_page(**kwargs), position, previous=previous)
+        return await db_executor.run(fetch)
+
+    def _request(self, page):
+        task = self._pages.get(page)
+        if task is None or (task.done() and task.exception()):
+            task = self._pages[page] = asyncio.ensure_future(self._fetch(page))
+        return task
+
+    async def get_page(self, page: int):
+        ranked = await self._request(page)
+
+        for nearby in list(self._pages):
+            if abs(nearby - page) > self.keep_pages:
+                del self._pages[nearby]
+        for nearby in (page + 1, page - 1):
+            if 0 <= nearby < self.page_count():
+                self._request(nearby)
+
+        entries = []
+        for rank, (player_id, name, elo, elo_max, wins, losses) in ranked:
+            elo_field = elo_max if self.max_flag else elo
+            entries.append((f'{rank:>3}. {name}', f'`ELO {elo_field}\u00A0\u00A0\u00A0\u00A0W {wins} / L {losses}`'))
+        return entries
+
+
 class SpiesGame(commands.Converter):
     async def convert(self, ctx, game_id):
         # allows a SpiesGame to be used as a parameter for a discord command, and get converted into a database object on the fly
 
-        utilities.connect()
-        try:
+        def get_game():
             game = Game.get(id=int(game_id))
+            game.winning_player, game.losing_player  # load related players while still on the database thread
+            return game
+
+        try:
+            game = await db_executor.run(get_game)
         except (ValueError, peewee.DataError):
             await ctx.send(f'Invalid game ID "{game_id}".')
             raise commands.UserInputError()
@@ -36,51 +151,145 @@ class games(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.confirmations = ConfirmationScheduler(bot, on_confirm=self.confirm_game, on_reject=self.reject_game)
+        self.role_sync = RoleSync(bot, reconcile_interval=settings.role_sync_interval, min_interval=settings.role_sync_min_interval)
         if settings.run_tasks:
-            pass
-            # self.bg_task = bot.loop.create_task(self.task_purge_game_channels())
+            self.bg_task = bot.loop.create_task(self.task_confirm_stale_games())
+
+    async def task_confirm_stale_games(self):
+        # Periodically confirm pending games that were never confirmed or rejected, such as claims whose reaction message was deleted,
+        # and announce them grouped by guild. Rejected games stay pending until they are confirmed with loseto or deleted
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            try:
+                await self.confirm_stale_games()
+            except Exception:
+                logger.exception('Error confirming stale games')
+            await asyncio.sleep(settings.stale_game_sweep_interval)
+
+    async def confirm_stale_games(self):
+        start = timer()
+        claimed_before = datetime.datetime.now() - settings.stale_game_age
+
+        def confirm_and_describe():
+            confirmed = Game.confirm_stale_games(claimed_before)
+            return [(game.id, game.winning_player.discord_id, game.losing_player.discord_id, winner_elo, game.elo_change_winner, loser_elo, game.elo_change_loser)
+                    for game, winner_elo, loser_elo in confirmed]
+
+        confirmed = await db_executor.run_serialized(confirm_and_describe)
+        logger.info(f'Stale game sweep confirmed {len(confirmed)} games in {timer() - start:.2f}s')
+        if not confirmed:
+            return
+        self.role_sync.request_sync()
+
+        for guild in self.bot.guilds:
+            lines = [f'Game {game_id}: <@{winner_id}> `({winner_elo} +{winner_change})` defeated <@{loser_id}> `({loser_elo} {loser_change})`'
+                     for game_id, winner_id, loser_id, winner_elo, winner_change, loser_elo, loser_change in confirmed
+                     if guild.get_member(winner_id) or guild.get_member(loser_id)]
+            if not lines:
+                continue
+            channel = next(filter(None, (guild.get_channel(c) for c in settings.announcement_channel_ids(guild.id))), None)
+            if not channel:
+                logger.warn(f'Not announcing {len(lines)} automatically confirmed games in guild {guild.id}: no game_announce_channel or bot channel found')
+                continue
+            lines.insert(0, f'**{len(lines)} pending games were automatically confirmed** after {settings.stale_game_age.total_seconds() / 3600:.0f} hours:')
+            await utilities.buffered_send(destination=channel, content='\n'.join(lines))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for guild in self.bot.guilds:
+            await nameindex.index_guild(guild, loop=self.bot.loop)
+        await db_executor.run(Player.rebuild_rating_index, date_cutoff=settings.date_cutoff)
+        await db_executor.run(Player.rebuild_name_index)
+        await self.confirmations.start()
+        self.role_sync.start()
+
+    def cog_unload(self):
+        self.confirmations.stop()
+        self.role_sync.stop()
+        if settings.run_tasks:
+            self.bg_task.cancel()
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        await self.confirmations.handle_reaction(payload)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        nameindex.index_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        nameindex.unindex_member(member)
+        settings.member_permissions.invalidate_member(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        settings.member_permissions.invalidate_guild(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        settings.member_permissions.invalidate_guild(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        # permission levels are matched on role names, so a rename can change the level of every member holding the role
+        if before.name != after.name:
+            settings.member_permissions.invalidate_guild(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        # username changes are sent as user updates rather than member updates
+        if before.name == after.name:
+            return
+        for guild in self.bot.guilds:
+            member = guild.get_member(after.id)
+            if member:
+                nameindex.index_member(member)
 
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
         # Listen for changes to member roles or display names and update database if any relevant changes detected
-        player_query = Player.select().where(
-            (Player.discord_id == after.id)
-        )
+        if before.roles != after.roles:
+            settings.member_permissions.invalidate_member(after.guild.id, after.id)
+        if before.nick != after.nick or before.name != after.name:
+            nameindex.index_member(after)
 
         banned_role = discord.utils.get(before.guild.roles, name='ELO Banned')
         if banned_role not in before.roles and banned_role in after.roles:
-            utilities.connect()
-            try:
-                player = player_query.get()
-            except peewee.DoesNotExist:
-                return
-            player.is_banned = True
-            player.save()
-            logger.info(f'ELO Ban added for player {player.id} {player.name}')
+            ban_change = True
+        elif banned_role in before.roles and banned_role not in after.roles:
+            ban_change = False
+        else:
+            ban_change = None
 
-        if banned_role in before.roles and banned_role not in after.roles:
-            utilities.connect()
+        if ban_change is None and before.display_name == after.display_name:
+            return
+
+        def update_player():
             try:
-                player = player_query.get()
+                player = Player.select().where((Player.discord_id == after.id)).get()
             except peewee.DoesNotExist:
                 return
-            player.is_banned = False
-            player.save()
-            logger.info(f'ELO Ban removed for player {player.id} {player.name}')
-
-        # Updates display name in DB if user changes their display name
-        if before.display_name == after.display_name:
-            return
 
-        logger.debug(f'Attempting to change displayname for {before.display_name} to {after.display_name}')
-        # update name in guild's Player record
-        utilities.connect()
-        try:
-            player = player_query.get()
-        except peewee.DoesNotExist:
-            return
-        player.display_name = after.display_name
-        player.save()
+            if ban_change is not None:
+                player.is_banned = ban_change
+                player.save()
+                Player.refresh_rating_index([player])
+                render_cache.bump_version(f'ban toggled for player {player.id}')
+                logger.info(f'ELO Ban {"added" if ban_change else "removed"} for player {player.id} {player.name}')
+
+            # Updates display name in DB if user changes their display name
+            if before.display_name != after.display_name:
+                logger.debug(f'Attempting to change displayname for {before.display_name} to {after.display_name}')
+                player.name = after.display_name
+                player.save()
+                player.update_name_index()
+                render_cache.bump_version(f'player {player.id} renamed')
+
+        await db_executor.run(update_player)
+        if ban_change is not None:
+            self.role_sync.request_sync()
 
     @commands.command(usage='@Opponent [Losing Score] "Optional Game Name"', aliases=['loseto'])
     async def defeat(self, ctx, *input_args):
@@ -135,21 +344,32 @@ class games(commands.Cog):
             game_name = ' '.join(args[1:])
 
         if ctx.invoked_with == 'defeat':
-            winning_player, _ = Player.get_or_create(discord_id=ctx.author.id, defaults={'name': ctx.author.display_name})
-            losing_player, _ = Player.get_or_create(discord_id=target_discord_member.id, defaults={'name': target_discord_member.display_name})
+            winning_discord_member, losing_discord_member = ctx.author, target_discord_member
             winning_member = ctx.author
             confirm_win = False
         else:
             # invoked with 'loseto', so swap player targets and confirm the game in one step
-            losing_player, _ = Player.get_or_create(discord_id=ctx.author.id, defaults={'name': ctx.author.display_name})
-            winning_player, _ = Player.get_or_create(discord_id=target_discord_member.id, defaults={'name': target_discord_member.display_name})
+            winning_discord_member, losing_discord_member = target_discord_member, ctx.author
             winning_member = ctx.guild.get_member(target_discord_member.id)
             confirm_win = True
 
+        def get_players_and_game():
+            winning_player, winner_created = Player.get_or_create(discord_id=winning_discord_member.id, defaults={'name': winning_discord_member.display_name})
+            losing_player, loser_created = Player.get_or_create(discord_id=losing_discord_member.id, defaults={'name': losing_discord_member.display_name})
+            for player, player_created in ((winning_player, winner_created), (losing_player, loser_created)):
+                if player_created:
+                    # index new players straight away, so they can be found by mention or name before they have any games
+                    player.update_name_index()
+            if losing_player.is_banned or winning_player.is_banned:
+                return winning_player, losing_player, None, False
+            game, created = Game.get_or_create_pending_game(winning_player=winning_player, losing_player=losing_player, name=game_name, losing_score=losing_score)
+            return winning_player, losing_player, game, created
+
+        winning_player, losing_player, game, created = await db_executor.run(get_players_and_game)
+
         if losing_player.is_banned or winning_player.is_banned:
             return await ctx.send(f'Your opponent has the **ELO Banned** role and can not participate in ELO Games.')
 
-        game, created = Game.get_or_create_pending_game(winning_player=winning_player, losing_player=losing_player, name=game_name, losing_score=losing_score)
         if not game:
             return await ctx.send(f'The loser player\'s score is required to calculate margin of victory. **Example:**: `{ctx.prefix}{ctx.invoked_with} @Nelluk 0` for a 3-0 game. Value must be 0, 1, or 2. '
                 'The score can be omitted if you are confirming a pending loss.')
@@ -159,60 +379,76 @@ class games(commands.Cog):
                 return await ctx.send(f'There is already an unconfirmed game with these two opponents. Game {game.id} must be confirmed or deleted before another game is entered.')
 
             confirm_msg = await ctx.send(f'Game {game.id} created and waiting for defeated player <@{losing_player.discord_id}> to confirm loss. React below.')
-            confirm_status = await utilities.wait_for_confirmation(self.bot, ctx, game=game, losing_member=guild_matches[0], message=confirm_msg)
+            return await self.confirmations.schedule(game, confirm_msg, losing_member=target_discord_member)
 
-            try:
-                game = game.refresh()  # Update game from database in case is_confirmed flag changed during reaction wait time
-            except peewee.DoesNotExist:
-                return await ctx.send(f'Game {game.id} cannot be found. Most likely it was deleted by a user while waiting for confirmation. No ELO has changed.')
+        # confirming with loseto, so stop waiting on the winner's claim if there was one
+        await self.confirmations.cancel(game.id)
+        await self.confirm_game(ctx.channel, game)
 
-            if confirm_status:
-                confirm_win = True
-            else:
-                if game.is_confirmed:
-                    return await ctx.send(f'Game {game.id} is already marked as confirmed.')
-                return await ctx.send(f'Confirmation has been *rejected*. Game {game.id} is still pending. Contact your opponent <@{winning_player.discord_id}> or server staff '
-                    f'to resolve the dispute. To manually confirm the game please use the command `{ctx.prefix}loseto @{winning_player.name}`')
-        if confirm_win:
-            # not using an else since confirm_win value can change after it is checked as False
-            try:
-                winning_player_new_elo, losing_player_new_elo = game.confirm()
-            except ValueError:
-                return await ctx.send(f'Game {game.id} is already marked as confirmed.')
-
-            rank_winner, _ = winning_player.leaderboard_rank(date_cutoff=settings.date_cutoff)
-            rank_loser, _ = losing_player.leaderboard_rank(date_cutoff=settings.date_cutoff)
-
-            champion_role = discord.utils.get(ctx.guild.roles, name=settings.guild_setting(ctx.guild.id, 'champion_role_name'))
-            hero_role = discord.utils.get(ctx.guild.roles, name=settings.guild_setting(ctx.guild.id, 'hero_role_name'))
-
-            if rank_winner == 1 and champion_role and winning_member and champion_role not in winning_member.roles:
-                for member in hero_role.members:
-                    try:
-                        await member.remove_roles(champion_role, reason='Dethroned champion')
-                    except discord.DiscordException as e:
-                        logger.warn(f'Could not remove champion role: {e}')
-                        await ctx.send(f'**Warning** Tried to remove champion role from {member.display_name} but got a discord error: {e}')
-                try:
-                    await winning_member.add_roles(champion_role, reason='New champion')
-                except discord.DiscordException as e:
-                    logger.warn(f'Could not apply champion role: {e}')
-                    await ctx.send(f'**Warning** Tried to apply champion role to {winning_member.display_name} but got a discord error: {e}')
-
-            if hero_role and winning_player_new_elo > 1200 and hero_role not in winning_member.roles:
-                try:
-                    await winning_member.add_roles(hero_role, reason='New Hero')
-                except discord.DiscordException as e:
-                    logger.warn(f'Could not apply Hero role: {e}')
-                    await ctx.send(f'**Warning** Tried to apply Hero role to {winning_member.display_name} but got a discord error: {e}')
-
-            return await ctx.send(f'Game {game.id} has been confirmed with <@{winning_player.discord_id}> `({winning_player_new_elo} +{game.elo_change_winner} 📈{rank_winner})` '
-                f'defeating <@{losing_player.discord_id}> `({losing_player_new_elo} {game.elo_change_loser} 📉{rank_loser})`. Good game! ')
+    async def confirm_game(self, channel, game, auto: bool = False):
+        # Confirm game, queue a sync of the champion/hero roles and announce the result in channel.
+        # Used by defeat/loseto and by self.confirmations, which passes a game ID and may pass channel=None if the channel is gone
+
+        def confirm_and_rank():
+            confirm_game = Game.get_by_id(game) if isinstance(game, int) else game.refresh()
+            winning_player_new_elo, losing_player_new_elo = confirm_game.confirm()
+            ranks, _ = Player.leaderboard_ranks([confirm_game.winning_player, confirm_game.losing_player], date_cutoff=settings.date_cutoff)
+            return confirm_game, winning_player_new_elo, losing_player_new_elo, ranks
+
+        game_id = game if isinstance(game, int) else game.id
+        try:
+            game, winning_player_new_elo, losing_player_new_elo, ranks = await db_executor.run_serialized(confirm_and_rank)
+        except ValueError:
+            message = f'Game {game_id} is already marked as confirmed.'
+        except peewee.DoesNotExist:
+            message = f'Game {game_id} cannot be found. Most likely it was deleted by a user while waiting for confirmation. No ELO has changed.'
+        else:
+            message = None
+        if message:
+            return await channel.send(message) if channel else logger.info(message)
+
+        winning_player, losing_player = game.winning_player, game.losing_player
+        rank_winner, rank_loser = ranks.get(winning_player.id), ranks.get(losing_player.id)
+        # the leaderboard is shared by every guild, so any of them could have a new champion
+        self.role_sync.request_sync()
+        if not channel:
+            return logger.warn(f'Game {game.id} confirmed but its channel is gone, so it was not announced')
+
+        auto_str = 'No reaction detected in time, so the game was automatically confirmed. If it should not have been, contact your opponent or server staff.\n' if auto else ''
+        return await channel.send(f'{auto_str}Game {game.id} has been confirmed with <@{winning_player.discord_id}> `({winning_player_new_elo} +{game.elo_change_winner} 📈{rank_winner})` '
+            f'defeating <@{losing_player.discord_id}> `({losing_player_new_elo} {game.elo_change_loser} 📉{rank_loser})`. Good game! ')
+
+    async def reject_game(self, channel, game_id: int):
+        # Called by self.confirmations when the loser rejects a claim. The game stays pending until it is confirmed with loseto or deleted
+
+        def get_game():
+            game = Game.get_by_id(game_id)
+            game.winning_player  # load related player while still on the database thread
+            return game
+
+        try:
+            game = await db_executor.run(get_game)
+        except peewee.DoesNotExist:
+            return
+        if not channel:
+            return
+        if game.is_confirmed:
+            return await channel.send(f'Game {game.id} is already marked as confirmed.')
+        prefix = settings.guild_setting(channel.guild.id, 'command_prefix')
+        await channel.send(f'Confirmation has been *rejected*. Game {game.id} is still pending. Contact your opponent <@{game.winning_player.discord_id}> or server staff '
+            f'to resolve the dispute. To manually confirm the game please use the command `{prefix}loseto @{game.winning_player.name}`')
 
     @settings.in_bot_channel_strict()
-    @commands.command(aliases=['lbmax'])
-    async def lb(self, ctx):
-        """Display leaderboard - use lbmax to sort by maximum ELO achieved"""
+    @commands.command(aliases=['lbmax'], usage='[YYYY-MM-DD]')
+    async def lb(self, ctx, as_of_date: str = None):
+        """Display leaderboard - use lbmax to sort by maximum ELO achieved
+
+        Include a date to see the leaderboard as it stood at the end of that day.
+
+        **Examples**
+        `[p]lb` - Current leaderboard
+        `[p]lb 2020-06-01` - Leaderboard as of June 1st 2020
+        """
 
         leaderboard = []
         lb_title = 'Two Spies Leaderboard'
@@ -224,21 +460,23 @@ class games(commands.Cog):
             max_flag = False
             max_str = ''
 
-        def process_leaderboard():
-            utilities.connect()
-            leaderboard_query = Player.leaderboard(date_cutoff=date_cutoff, max_flag=max_flag)
+        if as_of_date:
+            try:
+                as_of = datetime.datetime.strptime(as_of_date, '%Y-%m-%d') + datetime.timedelta(days=1)
+            except ValueError:
+                return await ctx.send(f'Could not parse date *{utilities.escape_role_mentions(as_of_date)}*. Use the format `{ctx.prefix}{ctx.invoked_with} YYYY-MM-DD`')
 
-            for counter, player in enumerate(leaderboard_query[:2000]):
-                wins, losses = player.get_record()
-                elo_field = player.elo_max if max_flag else player.elo
-                leaderboard.append(
-                    (f'{(counter + 1):>3}. {player.name}', f'`ELO {elo_field}\u00A0\u00A0\u00A0\u00A0W {wins} / L {losses}`')
-                )
-            return leaderboard, leaderboard_query.count()
+            def process_leaderboard_as_of():
+                for player_id, name, elo, elo_max, rank in Player.leaderboard_as_of(as_of=as_of, max_flag=max_flag)[:2000]:
+                    elo_field = elo_max if max_flag else elo
+                    leaderboard.append((f'{rank:>3}. {name}', f'`ELO {elo_field}`'))
+                return leaderboard
 
-        leaderboard, leaderboard_size = await self.bot.loop.run_in_executor(None, process_leaderboard)
+            leaderboard = await db_executor.run(process_leaderboard_as_of)
+            return await utilities.paginate(self.bot, ctx, title=f'**{lb_title}** as of {as_of_date}\n{len(leaderboard)} ranked players{max_str}', message_list=leaderboard, page_start=0, page_size=12)
 
-        await utilities.paginate(self.bot, ctx, title=f'**{lb_title}**\n{leaderboard_size} ranked players{max_str}', message_list=leaderboard, page_start=0, page_end=12, page_size=12)
+        provider = await LeaderboardPages(date_cutoff=date_cutoff, max_flag=max_flag, page_size=12).load()
+        await utilities.paginate(self.bot, ctx, title=f'**{lb_title}**\n{provider.total} ranked players{max_str}', provider=provider)
 
     @commands.command(usage='game_id')
     async def delete(self, ctx, game: SpiesGame = None):
@@ -262,7 +500,12 @@ class games(commands.Cog):
 
         gid = game.id
         async with ctx.typing():
-            await self.bot.loop.run_in_executor(None, game.delete_game)
+            await self.confirmations.cancel(gid)
+            try:
+                await db_executor.run_serialized(game.delete_game)
+            except peewee.DoesNotExist:
+                return await ctx.send(f'Game with ID {gid} has already been deleted.')
+            self.role_sync.request_sync()
             # Allows bot to remain responsive while this large operation is running.
             await ctx.send(f'Game with ID {gid} has been deleted and team/player ELO changes have been reverted, if applicable.')
 
@@ -284,7 +527,7 @@ class games(commands.Cog):
         player_mention = ' '.join(args_list)
         player_mention_safe = utilities.escape_role_mentions(player_mention)
 
-        player_results = Player.string_matches(player_string=player_mention)
+        player_results = await db_executor.run(lambda: list(Player.string_matches(player_string=player_mention)))
         if len(player_results) > 1:
             p_names = [p.name for p in player_results]
             p_names_str = '**, **'.join(p_names[:10])
@@ -303,18 +546,23 @@ class games(commands.Cog):
         else:
             player = player_results[0]
 
+        def player_card_data():
+            # re-read the player since string_matches() results can be older than the cached card
+            card_player = Player.get_by_id(player.id)
+            wins, losses = card_player.get_record()
+            rank, lb_length = card_player.leaderboard_rank(settings.date_cutoff)
+            return (card_player.elo, card_player.elo_max, wins, losses, rank, lb_length)
+
         def async_create_player_embed():
-            utilities.connect()
-            wins, losses = player.get_record()
-            rank, lb_length = player.leaderboard_rank(settings.date_cutoff)
+            elo, elo_max, wins, losses, rank, lb_length = render_cache.get_or_compute(('player_card', player.id, settings.date_cutoff), player_card_data)
 
             if rank is None:
                 rank_str = 'Unranked'
             else:
                 rank_str = f'{rank} of {lb_length}'
 
-            max_str = f'(Max: {player.elo_max})\n' if player.elo_max > player.elo else ''
-            results_str = f'ELO: {player.elo}\n{max_str}W\u00A0{wins}\u00A0/\u00A0L\u00A0{losses}'
+            max_str = f'(Max: {elo_max})\n' if elo_max > elo else ''
+            results_str = f'ELO: {elo}\n{max_str}W\u00A0{wins}\u00A0/\u00A0L\u00A0{losses}'
 
             embed = discord.Embed(description=f'__Player card for <@{player.discord_id}>__')
             embed.add_field(name='**Results**', value=results_str)
@@ -326,9 +574,106 @@ class games(commands.Cog):
 
             return embed
 
-        embed = await self.bot.loop.run_in_executor(None, async_create_player_embed)
+        embed = await db_executor.run(async_create_player_embed)
+        await ctx.send(embed=embed)
+
+    @commands.command(brief='Head-to-head record between two players', usage='[@Player] @Opponent', aliases=['h2h'])
+    async def vs(self, ctx, *args):
+        """Show the head-to-head record between two players, or your most frequent opponents
+
+        **Examples**
+        `[p]vs` - Your most frequent opponents
+        `[p]vs Nelluk` - Your record against Nelluk
+        `[p]vs Nelluk DuffyDood` - Nelluk's record against DuffyDood
+        """
+
+        names = list(args)
+        if len(names) > 2:
+            return await ctx.send(f'**Usage:** `{ctx.prefix}{ctx.invoked_with} [@Player] @Opponent`. Use @Mentions or quotes for names with spaces.')
+        if len(names) < 2:
+            names.insert(0, f'<@{ctx.author.id}>')
+
+        players = []
+        for name in names:
+            matches = await db_executor.run(lambda: list(Player.string_matches(player_string=name)))
+            if len(matches) != 1:
+                return await ctx.send(f'Found {len(matches)} players with game history matching *{utilities.escape_role_mentions(name)}*. Be more specific or use an @Mention.')
+            players.append(matches[0])
+
+        if len(players) == 1:
+            player = players[0]
+            rivals = await db_executor.run(lambda: list(player.top_rivals(limit=10)))
+            if not rivals:
+                return await ctx.send(f'**{player.name}** has no confirmed games.')
+            embed = discord.Embed(title=f'Most frequent opponents of {player.name}')
+            for m in rivals:
+                embed.add_field(name=m.opponent.name, value=f'W {m.wins} / L {m.losses}\u00A0\u00A0\u00A0\u00A0ELO {m.elo_net:+}', inline=False)
+            return await ctx.send(embed=embed)
+
+        player, opponent = players
+        if player.id == opponent.id:
+            return await ctx.send('Stop beating yourself up.')
+        m = await db_executor.run(player.matchup, opponent)
+        if not m:
+            return await ctx.send(f'**{player.name}** and **{opponent.name}** have not played a confirmed game against each other.')
+
+        embed = discord.Embed(description=f'__**{player.name}** vs **{opponent.name}**__')
+        embed.add_field(name='**Record**', value=f'W\u00A0{m.wins}\u00A0/\u00A0L\u00A0{m.losses}')
+        embed.add_field(name='**Net ELO**', value=f'{m.elo_net:+}')
+        embed.add_field(name='**Wins**', value=f'3-0: {m.wins_3_0}\n3-1: {m.wins_3_1}\n3-2: {m.wins_3_2}')
+        embed.add_field(name='**Losses**', value=f'0-3: {m.losses_0_3}\n1-3: {m.losses_1_3}\n2-3: {m.losses_2_3}')
+        if m.last_completed_ts:
+            embed.set_footer(text=f'Last played {m.last_completed_ts.strftime("%Y-%m-%d")}')
         await ctx.send(embed=embed)
 
+    @commands.command(brief='Graph a player\'s ELO over time', usage='player_name', aliases=['graph'])
+    async def history(self, ctx, *args):
+        """Show a graph of a player's ELO over time
+
+        **Examples**
+        `[p]history` - Graph your own ELO history
+        `[p]graph Nelluk` - Graph Nelluk's ELO history
+        """
+
+        player_mention = ' '.join(args) if args else f'<@{ctx.author.id}>'
+        player_mention_safe = utilities.escape_role_mentions(player_mention)
+
+        player_results = await db_executor.run(lambda: list(Player.string_matches(player_string=player_mention)))
+        if len(player_results) > 1:
+            p_names_str = '**, **'.join(p.name for p in player_results[:10])
+            return await ctx.send(f'Found {len(player_results)} players matching *{player_mention_safe}*. Be more specific or use an @Mention.\nFound: **{p_names_str}**')
+        elif len(player_results) == 0:
+            return await ctx.send(f'Could not find a player matching *{player_mention_safe}* with any game history.')
+        player = player_results[0]
+
+        # string_matches() results can be older than the cache, so key on a fresh read of the player's last game. Deletes and recalculations
+        # rewrite ratings after other players' games too, so history_version is part of the key. It is read first, so a graph drawn
+        # while a recalculation commits is filed under the older version
+        def history_key():
+            history_version = render_cache.history_version
+            games_played, last_completed_ts = Player.select(Player.games_played, Player.last_completed_ts).where(Player.id == player.id).tuples().get()
+            return ('history', player.id, games_played, last_completed_ts, history_version)
+
+        key = await db_executor.run(history_key)
+        png = graphs.history_cache.get(key)
+        if png is None:
+            def load_history():
+                return graphs.downsample_history(player.elo_history().iterator(), threshold=settings.history_graph_points)
+
+            dates, elos = await db_executor.run(load_history)
+            if len(dates) < 2:
+                return await ctx.send(f'**{player.name}** needs at least two confirmed games for a graph.')
+
+            title = f'{player.name} - ELO history'
+            try:
+                png = await self.bot.loop.run_in_executor(None, graphs.render_history, title, dates, elos, key[2])
+            except ImportError:
+                logger.error('matplotlib is not installed, so the history command is unavailable')
+                return await ctx.send('Graphs are not available on this bot.')
+            graphs.history_cache.put(key, png)
+
+        await ctx.send(file=discord.File(io.BytesIO(png), filename=f'elo_history_{player.id}.png'))
+
     @commands.command(aliases=['dbb'])
     @commands.is_owner()
     async def backup_db(self, ctx):
@@ -349,20 +694,133 @@ class games(commands.Cog):
                 logger.error('Error during execution')
                 return await ctx.send(f'Error during execution: {str(process.stderr)}')
 
+    @commands.is_owner()
+    @commands.command(aliases=['checkindex'])
+    async def check_index(self, ctx):
+        """ *Owner*: Compare the in-memory rating index against leaderboard ranks calculated by the database """
+
+        if not rating_index.is_authoritative(settings.date_cutoff):
+            return await ctx.send(f'Rating index is not in use (loaded: {rating_index.loaded}, {len(rating_index)} players). Ranks are calculated by the database.')
+
+        async with ctx.typing():
+            mismatches = await db_executor.run(Player.check_rating_index, date_cutoff=settings.date_cutoff)
+
+        if not mismatches:
+            return await ctx.send(f'Rating index is consistent with the database ({len(rating_index)} players).')
+
+        logger.error(f'Rating index mismatches: {mismatches}')
+        mismatch_str = '\n'.join(f'Player {p_id} {"elo_max" if max_flag else "elo"}: index {index_rank} / db {db_rank}' for p_id, max_flag, index_rank, db_rank in mismatches[:15])
+        await ctx.send(f'Found {len(mismatches)} mismatches between rating index and database. Use `{ctx.prefix}rebuild_index` to reload it.\n{mismatch_str}')
+
+    @commands.is_owner()
+    @commands.command(aliases=['rebuildindex'])
+    async def rebuild_index(self, ctx):
+        """ *Owner*: Reload the in-memory rating index from the database """
+
+        await db_executor.run(Player.rebuild_rating_index, date_cutoff=settings.date_cutoff)
+        await ctx.send(f'Rating index reloaded with {len(rating_index)} players.')
+
+    @commands.is_owner()
+    @commands.command(aliases=['elolog'], usage='player_name')
+    async def elo_log(self, ctx, *, player_name: str):
+        """ *Owner*: Show the latest rating changes for a player from the ELO event log
+
+        **Example:**
+        `[p]elolog Nelluk`
+        """
+
+        player_results = await db_executor.run(lambda: list(Player.string_matches(player_string=player_name)))
+        if len(player_results) != 1:
+            return await ctx.send(f'Found {len(player_results)} players matching *{utilities.escape_role_mentions(player_name)}*. Be more specific or use an @Mention.')
+        player = player_results[0]
+
+        def latest_events():
+            events = list(elo_event_log.for_player(player.id))
+            return events[-15:], len(events)
+
+        events, total = await db_executor.run(latest_events)
+        lines = [f'**{total} rating changes logged for {player.name}**, latest {len(events)}:']
+        for e in events:
+            side = 'winner' if e['winner'] == player.id else 'loser'
+            written = datetime.datetime.fromtimestamp(e['ts']).strftime('%Y-%m-%d %H:%M')
+            lines.append(f'`{written}` {e["event"]} game {e["game"]}: {e[side + "_before"]} -> {e[side + "_after"]} ({e[side + "_delta"]:+})')
+        await utilities.buffered_send(destination=ctx, content='\n'.join(lines))
+
+    @commands.is_owner()
+    @commands.command(aliases=['dbstats'])
+    async def db_stats(self, ctx):
+        """ *Owner*: Show queue depth and wait times of the database executor, connection pool and log queue """
+
+        stats = db_executor.stats()
+        pool = db_executor.pool_stats()
+        logs = log_queue.stats()
+        await ctx.send(f'**Database executor**: {stats["workers"]} workers, {stats["running"]} running, {stats["queue_depth"]} queued\n'
+            f'{stats["completed"]} jobs completed ({stats["failed"]} failed)\n'
+            f'Wait: avg {stats["avg_wait"] * 1000:.1f}ms / p50 {stats["p50_wait"] * 1000:.1f}ms / p95 {stats["p95_wait"] * 1000:.1f}ms / max {stats["max_wait"] * 1000:.1f}ms\n'
+            f'Run time: p50 {stats["p50_run"] * 1000:.1f}ms / p95 {stats["p95_run"] * 1000:.1f}ms\n'
+            f'**Connection pool**: {pool["in_use"]} in use, {pool["idle"]} idle, max {pool["max_connections"]}\n'
+            f'**Log queue**: {logs["depth"]} queued of {logs["maxsize"]} (high water {logs["high_water"]}), {logs["written"]} written, '
+            f'{logs["dropped"]} dropped {logs["dropped_by_level"] or ""}, rate limited {logs["rate_limited"]}')
+
+    @commands.is_owner()
+    @commands.command(usage='[reset]')
+    async def perf(self, ctx, *, arg: str = None):
+        """ *Owner*: Show the slowest commands and database queries since the bot started
+
+        Timings are also written to logs/metrics.log, one line per command.
+        **Examples:**
+        `[p]perf` - Show command latency percentiles and the slowest queries
+        `[p]perf reset` - Clear the collected timings
+        """
+
+        if arg and arg.lower() == 'reset':
+            instrumentation.metrics.reset()
+            return await ctx.send('Collected timings have been cleared.')
+
+        lines = ['**Slowest commands** (p50 / p95 / max wall time, p95 db time, p95 queries, avg executor wait)']
+        for c in instrumentation.metrics.command_stats()[:10]:
+            lines.append(f'`{c["command"]}` x{c["count"]}: {c["p50_wall"] * 1000:.0f} / {c["p95_wall"] * 1000:.0f} / {c["max_wall"] * 1000:.0f}ms, '
+                f'db {c["p95_db"] * 1000:.0f}ms, {c["p95_queries"]} queries, wait {c["avg_executor_wait"] * 1000:.1f}ms')
+
+        slowest = instrumentation.metrics.slowest_invocations[:5]
+        if slowest:
+            lines.append('**Slowest invocations**')
+            for i in slowest:
+                lines.append(f'`{i.command}` {i.wall_time * 1000:.0f}ms, db {i.db_time * 1000:.0f}ms in {i.query_count} queries')
+
+        lines.append(f'**Slowest queries** (by total time, {instrumentation.metrics.untracked_queries} queries ran outside of commands)')
+        for sql, count, total, max_time in instrumentation.metrics.query_stats(order_by='total', limit=5):
+            lines.append(f'{total * 1000:.0f}ms total, x{count}, max {max_time * 1000:.1f}ms: `{sql[:300]}`')
+
+        role_stats = self.role_sync.stats
+        lines.append(f'**Role sync**: {self.role_sync.queue_length()} changes queued, {role_stats["applied"]} applied, {role_stats["skipped"]} skipped, '
+            f'{role_stats["failed"]} failed, {role_stats["rate_limited"]} rate limited over {role_stats["syncs"]} syncs')
+
+        cache = render_cache.stats()
+        lines.append(f'**Render cache**: {cache["hit_rate"]:.0%} hit rate ({cache["hits"]} hits / {cache["misses"]} misses), '
+            f'{cache["entries"]} entries using {cache["bytes"] / 1024:.0f} of {cache["max_bytes"] / 1024:.0f}KB, '
+            f'{cache["evictions"]} evicted, ratings version {cache["version"]}')
+
+        permissions = settings.member_permissions.stats()
+        lines.append(f'**Permission cache**: {permissions["hit_rate"]:.0%} hit rate ({permissions["hits"]} hits / {permissions["misses"]} misses), '
+            f'{permissions["members"]} members in {permissions["guilds"]} guilds, {permissions["invalidations"]} invalidations')
+
+        await utilities.buffered_send(destination=ctx, content='\n'.join(lines))
+
     @commands.is_owner()
     @commands.command()
     async def quit(self, ctx):
         """ *Owner*: Close database connection and quit bot gracefully """
 
         message = ''
+        # stop the confirmation scheduler, role sync and stale game sweep first so nothing new is submitted while the executor drains
+        self.cog_unload()
         try:
-            if db.close():
-                message = 'db connecton closing normally'
-            else:
-                message = 'db connection was already closed'
-
+            await self.bot.loop.run_in_executor(None, functools.partial(db_executor.shutdown, wait=True))
+            db.close_all()
+            message = 'db executor stopped and pooled connections closed'
         except peewee.PeeweeException as e:
-            message = f'Error during post_invoke_cleanup db.close(): {e}'
+            message = f'Error during post_invoke_cleanup db.close_all(): {e}'
         finally:
             logger.info(message)
 
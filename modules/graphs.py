@@ -0,0 +1,49 @@
+import io
+import logging
+import threading
+
+import settings
+from modules.rendercache import RenderCache
+from modules.downsample import downsample_history
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+# Rating history graphs for the history command. matplotlib is only imported the first time a graph is drawn, so the bot
+# starts (and every other command works) without it installed.
+
+# Rendered PNGs, keyed by player, their game count / last game time and render_cache.history_version, so a graph is reused until
+# that player's next game or until a delete or recalculation rewrites past ratings. Not tied to the ratings version in render_cache,
+# since other players' new games don't change a player's history
+history_cache = RenderCache(max_entries=settings.history_cache_max_entries, max_bytes=settings.history_cache_max_bytes)
+_render_lock = threading.Lock()  # pyplot keeps global state, so only draw one graph at a time
+
+
+def render_history(title: str, dates, elos, game_count: int):
+    # PNG of a player's rating over time, as bytes
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    with _render_lock:
+        return _draw(plt, mdates, title, dates, elos, game_count)
+
+
+def _draw(plt, mdates, title, dates, elos, game_count):
+    fig, ax = plt.subplots(figsize=(8, 4), dpi=100)
+    try:
+        ax.plot(dates, elos, color='#3b82c4', linewidth=1.5)
+        ax.axhline(1000, color='#999999', linewidth=0.8, linestyle='--')
+        ax.set_title(title)
+        ax.set_ylabel('ELO')
+        ax.grid(True, alpha=0.3)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+        fig.autofmt_xdate()
+        if len(dates) < game_count:
+            ax.text(0.99, 0.01, f'{game_count} games, {len(dates)} points shown', transform=ax.transAxes, ha='right', va='bottom', fontsize=8, color='#666666')
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png', bbox_inches='tight')
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
@@ -0,0 +1,180 @@
+import collections
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
+from timeit import default_timer as timer
+
+logger = logging.getLogger('spiesbot.' + __name__)
+metrics_logger = logging.getLogger('spiesbot.metrics')  # one JSON line per command invocation, written to logs/metrics.log by bot.py
+
+# Per-command latency and query accounting.
+# bot.before_invoke calls start_invocation() and bot.after_invoke calls finish_invocation(). In between, the instrumented peewee
+# database in models.py reports every query with record_query(), and the DatabaseExecutor reports how long each job waited
+# for a worker with record_executor_wait(). The current Invocation is carried in a contextvar, which the executor copies into
+# its worker threads, so queries run on the executor are charged to the command that submitted them.
+
+_current = contextvars.ContextVar('spiesbot_invocation', default=None)
+
+
+class Invocation:
+
+    def __init__(self, command: str, guild_id=None, author_id=None):
+        self.command = command
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.started_ts = time.time()
+        self.started = timer()
+        self.wall_time = None
+        self.db_time = 0.0
+        self.query_count = 0
+        self.executor_wait = 0.0
+        self.executor_jobs = 0
+        self.failed = False
+        self._lock = threading.Lock()  # several executor jobs for the same command can run at once
+
+    def add_query(self, elapsed: float):
+        with self._lock:
+            self.query_count += 1
+            self.db_time += elapsed
+
+    def add_executor_wait(self, wait: float):
+        with self._lock:
+            self.executor_jobs += 1
+            self.executor_wait += wait
+
+    def as_dict(self):
+        return {
+            'ts': self.started_ts,
+            'command': self.command,
+            'guild': self.guild_id,
+            'author': self.author_id,
+            'wall_ms': round(self.wall_time * 1000, 2) if self.wall_time is not None else None,
+            'db_ms': round(self.db_time * 1000, 2),
+            'queries': self.query_count,
+            'executor_wait_ms': round(self.executor_wait * 1000, 2),
+            'executor_jobs': self.executor_jobs,
+            'failed': self.failed,
+        }
+
+
+def _percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct))] if samples else 0.0
+
+
+def normalize_sql(sql: str):
+    # Collapse IN lists of any length so that queries differing only in the number of parameters are grouped together
+    return re.sub(r'\((?:%s, )+%s\)', '(%s, ...)', sql)
+
+
+class Metrics:
+    # Rolling per-command samples and aggregate per-query statistics, kept in memory for the perf command
+
+    def __init__(self, samples_per_command: int = 200, slowest_kept: int = 20, max_query_shapes: int = 500):
+        self.samples_per_command = samples_per_command
+        self.slowest_kept = slowest_kept
+        self.max_query_shapes = max_query_shapes
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = collections.defaultdict(lambda: collections.deque(maxlen=self.samples_per_command))
+            self.slowest_invocations = []  # the slowest Invocations seen, sorted slowest first
+            self.queries = {}  # normalized sql: [count, total time, max time]
+            self.untracked_queries = 0  # queries not issued from within a command, such as listeners and background tasks
+
+    def add_invocation(self, invocation: Invocation):
+        with self._lock:
+            self.commands[invocation.command].append(invocation)
+            slowest = self.slowest_invocations
+            if len(slowest) < self.slowest_kept or invocation.wall_time > slowest[-1].wall_time:
+                slowest.append(invocation)
+                slowest.sort(key=lambda i: i.wall_time, reverse=True)
+                del slowest[self.slowest_kept:]
+
+    def add_query(self, sql: str, elapsed: float, tracked: bool):
+        key = normalize_sql(sql)
+        with self._lock:
+            if not tracked:
+                self.untracked_queries += 1
+            stats = self.queries.get(key)
+            if stats is None:
+                if len(self.queries) >= self.max_query_shapes:
+                    return
+                stats = self.queries[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def command_stats(self):
+        # Returns [{command, count, p50/p95/max wall time, p50/p95 db time, p50/p95 query count, average executor wait}, ...] sorted by p95 wall time
+        with self._lock:
+            samples_by_command = {name: list(samples) for name, samples in self.commands.items()}
+
+        results = []
+        for name, samples in samples_by_command.items():
+            wall = sorted(s.wall_time for s in samples)
+            db_time = sorted(s.db_time for s in samples)
+            queries = sorted(s.query_count for s in samples)
+            results.append({
+                'command': name,
+                'count': len(samples),
+                'p50_wall': _percentile(wall, 0.5),
+                'p95_wall': _percentile(wall, 0.95),
+                'max_wall': wall[-1],
+                'p50_db': _percentile(db_time, 0.5),
+                'p95_db': _percentile(db_time, 0.95),
+                'p50_queries': _percentile(queries, 0.5),
+                'p95_queries': _percentile(queries, 0.95),
+                'avg_executor_wait': sum(s.executor_wait for s in samples) / len(samples),
+            })
+        return sorted(results, key=lambda r: r['p95_wall'], reverse=True)
+
+    def query_stats(self, order_by: str = 'total', limit: int = 10):
+        # Returns [(normalized sql, count, total time, max time), ...] ordered by 'total' or 'max' time
+        with self._lock:
+            rows = [(sql, count, total, max_time) for sql, (count, total, max_time) in self.queries.items()]
+        sort_index = 3 if order_by == 'max' else 2
+        return sorted(rows, key=lambda r: r[sort_index], reverse=True)[:limit]
+
+
+metrics = Metrics()
+
+
+def start_invocation(command: str, guild_id=None, author_id=None):
+    invocation = Invocation(command, guild_id=guild_id, author_id=author_id)
+    _current.set(invocation)
+    return invocation
+
+
+def current_invocation():
+    return _current.get()
+
+
+def finish_invocation(failed: bool = False):
+    invocation = _current.get()
+    if invocation is None or invocation.wall_time is not None:
+        return None
+    invocation.wall_time = timer() - invocation.started
+    invocation.failed = failed
+    _current.set(None)
+
+    metrics.add_invocation(invocation)
+    metrics_logger.info(json.dumps(invocation.as_dict()))
+    return invocation
+
+
+def record_query(sql: str, elapsed: float):
+    invocation = _current.get()
+    if invocation is not None:
+        invocation.add_query(elapsed)
+    metrics.add_query(sql, elapsed, tracked=invocation is not None)
+
+
+def record_executor_wait(wait: float):
+    invocation = _current.get()
+    if invocation is not None:
+        invocation.add_executor_wait(wait)
@@ -0,0 +1,140 @@
+import atexit
+import collections
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler
+
+import settings
+
+# Non-blocking logging. Handlers that write to files or stderr are wrapped with log_queue.wrap(handler), which returns a handler
+# that only puts the record on a bounded queue. A single background thread takes records off the queue and passes each one to the
+# handler it was meant for, so file writes and log rotation never happen on the event loop or a database thread.
+# If the queue is full the record is dropped and counted rather than making the caller wait.
+# RateLimitFilter caps how many records a noisy logger (ie peewee, which logs every SQL statement) can emit per second.
+
+_STOP = object()
+
+
+class QueuedHandler(QueueHandler):
+    # Stands in for target on a logger. Records are formatted for thread safety on the calling thread, and written by the LogQueue thread
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue.queue)
+        self.log_queue = log_queue
+        self.target = target
+        self.setLevel(target.level)
+
+    def enqueue(self, record):
+        self.log_queue.put(self.target, record)
+
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket: lets through `rate` records per second on average, with bursts of up to `burst`. Suppressed records are counted,
+    # and the count is reported in the next record that is let through
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self.suppressed = 0
+        self.total_suppressed = 0
+
+    def filter(self, record):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                self.total_suppressed += 1
+                return False
+            self._tokens -= 1
+            if self.suppressed:
+                record.msg = f'{record.msg} [{self.suppressed} earlier messages suppressed by rate limit]'
+                self.suppressed = 0
+            return True
+
+
+class LogQueue:
+
+    def __init__(self, maxsize: int):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.maxsize = maxsize
+        self._thread = None
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = collections.Counter()  # level name: records dropped because the queue was full
+        self.high_water = 0
+        self.rate_limits = {}  # logger name: RateLimitFilter
+
+    def wrap(self, handler):
+        return QueuedHandler(self, handler)
+
+    def rate_limit(self, logger_name: str, rate: float, burst: int):
+        rate_filter = RateLimitFilter(rate=rate, burst=burst)
+        logging.getLogger(logger_name).addFilter(rate_filter)
+        self.rate_limits[logger_name] = rate_filter
+        return rate_filter
+
+    def put(self, target, record):
+        try:
+            self.queue.put_nowait((target, record))
+        except queue.Full:
+            with self._lock:
+                self.dropped[record.levelname] += 1
+            return
+        with self._lock:
+            self.enqueued += 1
+            self.high_water = max(self.high_water, self.queue.qsize())
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._drain, name='spiesbot-logqueue', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout: float = 5.0):
+        # Write out everything queued so far and stop the thread
+        if not self._thread:
+            return
+        try:
+            self.queue.put((None, _STOP), timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _drain(self):
+        while True:
+            target, record = self.queue.get()
+            if record is _STOP:
+                return
+            try:
+                target.handle(record)
+            except Exception:
+                target.handleError(record)
+            with self._lock:
+                self.written += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.queue.qsize(),
+                'maxsize': self.maxsize,
+                'high_water': self.high_water,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'dropped': sum(self.dropped.values()),
+                'dropped_by_level': dict(self.dropped),
+                'rate_limited': {name: f.total_suppressed for name, f in self.rate_limits.items()},
+            }
+
+
+log_queue = LogQueue(maxsize=settings.log_queue_size)
@@ -0,0 +1,146 @@
+import datetime
+import logging
+
+from peewee import IntegerField, DateTimeField, TextField
+from playhouse.migrate import PostgresqlMigrator, migrate
+
+from modules.models import db, BaseModel, Player, Game, PlayerGame, RatingCheckpoint, RatingCheckpointEntry, PendingConfirmation, Matchup
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+# Versioned schema migrations. Each migration runs once, in order, and is recorded in the schemaversion table.
+# Migrations must be safe to run against a live database: add columns with defaults, and build indexes with
+# CREATE INDEX CONCURRENTLY (see create_index_concurrently()) so that tables are never locked against writes.
+# To change the schema, append a new (version, description, function) entry to MIGRATIONS - never edit an applied one.
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    description = TextField()
+    applied_ts = DateTimeField(default=datetime.datetime.now)
+
+
+def create_index_concurrently(name: str, table: str, columns: str, where: str = None):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and leaves an INVALID index behind if it fails part way,
+    # which IF NOT EXISTS would then skip. So drop any invalid leftover first.
+    invalid = db.execute_sql(
+        'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s AND NOT i.indisvalid', (name,)
+    ).fetchone()
+    if invalid:
+        logger.warn(f'Dropping invalid index {name} left by an earlier failed build')
+        db.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+    where_sql = f' WHERE {where}' if where else ''
+    db.execute_sql(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" ({columns}){where_sql}')
+
+
+def initial_tables():
+    # Tables as they were created by models.py before migrations existed. safe=True leaves existing tables alone
+    db.create_tables([Player, Game, PlayerGame, RatingCheckpoint, RatingCheckpointEntry], safe=True)
+
+
+def player_stats_columns():
+    # Denormalized record columns on Player. Databases created after the columns were added to the model already have them
+    existing_columns = [c.name for c in db.get_columns('player')]
+    if 'games_played' in existing_columns:
+        return
+
+    migrator = PostgresqlMigrator(db)
+    with db.atomic():
+        migrate(
+            migrator.add_column('player', 'win_count', Player.win_count),
+            migrator.add_column('player', 'loss_count', Player.loss_count),
+            migrator.add_column('player', 'games_played', Player.games_played),
+            migrator.add_column('player', 'last_completed_ts', Player.last_completed_ts),
+        )
+        Player.rebuild_stats()
+
+
+def hot_query_indexes():
+    # Leaderboards: active, non-banned players ordered by elo / elo_max
+    create_index_concurrently('player_active_elo', 'player', 'elo DESC, last_completed_ts', where='NOT is_banned')
+    create_index_concurrently('player_active_elo_max', 'player', 'elo_max DESC, last_completed_ts', where='NOT is_banned')
+    # Confirmed games in completion order: recalculate_elo_since(), checkpoints, date_cutoff filters
+    create_index_concurrently('game_confirmed_completed_ts', 'game', 'completed_ts, id', where='is_confirmed')
+    # Player.wins() / Player.losses() and rebuild_stats()
+    create_index_concurrently('game_confirmed_winning_player', 'game', 'winning_player_id, completed_ts', where='is_confirmed')
+    create_index_concurrently('game_confirmed_losing_player', 'game', 'losing_player_id, completed_ts', where='is_confirmed')
+    # Game.get_or_create_pending_game()
+    create_index_concurrently('game_pending_players', 'game', 'winning_player_id, losing_player_id', where='NOT is_confirmed')
+    # Player.ratings_before() and per-player game history
+    create_index_concurrently('playergame_player_game', 'playergame', 'player_id, game_id')
+
+
+def pending_confirmations_table():
+    db.create_tables([PendingConfirmation], safe=True)
+
+
+def stale_pending_games_index():
+    # Game.stale_pending_games()
+    create_index_concurrently('game_pending_claimed_ts', 'game', 'win_claimed_ts, id', where='NOT is_confirmed')
+
+
+def matchups_table():
+    db.create_tables([Matchup], safe=True)
+    # Player.top_rivals()
+    create_index_concurrently('matchup_player_games', 'matchup', 'player_id, games DESC')
+    with db.atomic():
+        Matchup.rebuild()
+
+
+def game_rejected_ts_column():
+    # Game.rejected_ts, so that rejected claims are left out of Game.stale_pending_games()
+    existing_columns = [c.name for c in db.get_columns('game')]
+    if 'rejected_ts' in existing_columns:
+        return
+
+    migrator = PostgresqlMigrator(db)
+    with db.atomic():
+        migrate(migrator.add_column('game', 'rejected_ts', Game.rejected_ts))
+
+
+def checkpoint_game_count_column():
+    # RatingCheckpoint.game_count with a unique index. Checkpoints taken before it existed could be duplicated, or miss a game that was
+    # being confirmed concurrently, so they are discarded and replaced with a single fresh one. ratings_before() reads games directly
+    # for points in history before that
+    existing_columns = [c.name for c in db.get_columns('ratingcheckpoint')]
+    if 'game_count' in existing_columns:
+        return
+
+    with db.atomic():
+        RatingCheckpoint.delete().execute()
+        db.execute_sql('ALTER TABLE "ratingcheckpoint" ADD COLUMN "game_count" INTEGER NOT NULL')
+        db.execute_sql('CREATE UNIQUE INDEX "ratingcheckpoint_game_count" ON "ratingcheckpoint" ("game_count")')
+        RatingCheckpoint.create_from_players()
+
+
+MIGRATIONS = [
+    (1, 'Initial tables', initial_tables),
+    (2, 'Player stats columns', player_stats_columns),
+    (3, 'Indexes for hot queries', hot_query_indexes),
+    (4, 'Pending confirmations table', pending_confirmations_table),
+    (5, 'Index for stale pending games', stale_pending_games_index),
+    (6, 'Head-to-head matchups table', matchups_table),
+    (7, 'Game rejected_ts column', game_rejected_ts_column),
+    (8, 'RatingCheckpoint game_count column', checkpoint_game_count_column),
+]
+
+
+def current_version():
+    return SchemaVersion.select(SchemaVersion.version).order_by(SchemaVersion.version.desc()).scalar() or 0
+
+
+def run_migrations():
+    # Apply any migrations newer than the database's schema version. Returns the list of versions applied
+    applied = []
+    with db.connection_context():
+        db.create_tables([SchemaVersion], safe=True)
+        version = current_version()
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logger.warn(f'Applying schema migration {migration_version}: {description}')
+            migration()
+            SchemaVersion.create(version=migration_version, description=description)
+            applied.append(migration_version)
+    return applied
@@ -1,17 +1,46 @@
 import datetime
+import operator
+import threading
+from functools import reduce
 # import discord
 # import re
 # import psycopg2
 from peewee import *
 from playhouse.postgres_ext import *
+from playhouse.pool import PooledPostgresqlDatabase
 # import modules.exceptions as exceptions
 import settings
 import logging
+from modules.ratingindex import rating_index
+from modules.nameindex import player_name_index
+from modules.rendercache import render_cache
+from modules.elolog import elo_event_log
+import modules.elo as elo_engine
+import modules.instrumentation as instrumentation
+from timeit import default_timer as timer
 
 logger = logging.getLogger('spiesbot.' + __name__)
 elo_logger = logging.getLogger('spiesbot.elo')
 
-db = PostgresqlDatabase(settings.psql_db, autorollback=True, user=settings.psql_user, autoconnect=False)
+
+class InstrumentedPostgresqlDatabase(PooledPostgresqlDatabase):
+    # Times every query and charges it to the command being run, see modules/instrumentation.py
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        start = timer()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            instrumentation.record_query(sql, timer() - start)
+
+
+db = InstrumentedPostgresqlDatabase(settings.psql_db, autorollback=True, user=settings.psql_user, autoconnect=False,
+                              max_connections=settings.db_pool_size, stale_timeout=settings.db_pool_stale_timeout, timeout=settings.db_pool_timeout)
+
+
+def pool_stats():
+    # peewee doesn't expose pool state publicly, so this reads PooledDatabase internals
+    return {'max_connections': db._max_connections, 'in_use': len(db._in_use), 'idle': len(db._connections)}
 
 
 def tomorrow():
@@ -29,25 +58,82 @@ class Player(BaseModel):
     elo = SmallIntegerField(default=1000)
     elo_max = SmallIntegerField(default=1000)
     is_banned = BooleanField(default=False)
+    # Denormalized record of confirmed games, maintained by Game.confirm() and rebuilt by Player.rebuild_stats()
+    win_count = IntegerField(default=0)
+    loss_count = IntegerField(default=0)
+    games_played = IntegerField(default=0)
+    last_completed_ts = DateTimeField(null=True, default=None)
+
+    def elo_history(self):
+        # (completed_ts, elo_after_game) for each of the player's confirmed games in time order, in one query over the playergame_player_game index
+        return PlayerGame.select(Game.completed_ts, PlayerGame.elo_after_game).join(Game).where(
+            (PlayerGame.player == self) & (Game.is_confirmed == 1) & (PlayerGame.elo_after_game.is_null(False))
+        ).order_by(Game.completed_ts, Game.id).tuples()
+
+    def matchup(self, opponent):
+        # This player's head-to-head Matchup record against opponent (a Player or ID), or None if they have never played
+        return Matchup.get_or_none((Matchup.player == self) & (Matchup.opponent == opponent))
+
+    def top_rivals(self, limit: int = 5):
+        # Matchups against the opponents this player has played most often, served by the matchup_player_games index
+        return Matchup.select(Matchup, Player).join(Player, on=(Matchup.opponent == Player.id)).where(
+            Matchup.player == self
+        ).order_by(Matchup.games.desc(), Matchup.last_completed_ts.desc()).limit(limit)
+
+    def leaderboard_rank(self, date_cutoff, max_flag: bool = False):
+        # Returns player's position in the leaderboard, and total size of leaderboard. Rank is None if player is not on the leaderboard
+
+        ranks, total = Player.leaderboard_ranks([self], date_cutoff=date_cutoff, max_flag=max_flag)
+        return (ranks.get(self.id), total)
+
+    def leaderboard_ranks(players, date_cutoff, max_flag: bool = False, dense: bool = False, use_index: bool = True):
+        # Rank several players at once using Postgresql window functions over the same filter as Player.leaderboard()
+        # Answered from the in-memory rating_index instead if it is loaded, unless use_index=False
+        # Returns ({player_id: rank}, total size of leaderboard). Players not on the leaderboard are omitted from the dict.
+        # Tied ELOs share a rank - with dense=False ranks after a tie are skipped (1, 1, 3), with dense=True they are not (1, 1, 2)
 
-    def leaderboard_rank(self, date_cutoff):
-        # Returns player's position in the leaderboard, and total size of leaderboard
-
-        # TODO: This could be replaced with Postgresql Window functions to have the DB calculate the rank.
-        # Advantages: Probably moderately more efficient, and will resolve ties in a sensible way
-        # But no idea how to write the query :/
-        # http://docs.peewee-orm.com/en/latest/peewee/query_examples.html#find-the-top-three-revenue-generating-facilities
+        if max_flag:
+            elo_field = Player.elo_max
+        else:
+            elo_field = Player.elo
 
-        query = Player.leaderboard(date_cutoff=date_cutoff)
+        player_ids = [p.id if isinstance(p, Player) else p for p in players]
+
+        if use_index and rating_index.is_authoritative(date_cutoff):
+            ranks = {}
+            for p_id in player_ids:
+                rank = rating_index.rank(p_id, max_flag=max_flag, dense=dense)
+                if rank is not None:
+                    ranks[p_id] = rank
+            return (ranks, len(rating_index))
+
+        rank_func = fn.DENSE_RANK if dense else fn.RANK
+
+        def ranks_from(base_query):
+            ranked = base_query.select(
+                Player.id,
+                rank_func().over(order_by=[-elo_field]).alias('rank'),
+                fn.ROW_NUMBER().over(order_by=[-elo_field, Player.id]).alias('position'),
+                fn.COUNT(Player.id).over().alias('total')
+            ).order_by().alias('ranked')
+
+            # The position = 1 row is always included so that the leaderboard size is returned even if none of the players are ranked
+            query = Player.select(ranked.c.id, ranked.c.rank, ranked.c.total).from_(ranked).where(
+                (ranked.c.id.in_(player_ids)) | (ranked.c.position == 1)
+            )
 
-        player_found = False
-        for counter, p in enumerate(query.tuples()):
-            if p[0] == self.id:
-                player_found = True
-                break
+            ranks, total = {}, 0
+            for p_id, rank, total in query.tuples():
+                if p_id in player_ids:
+                    ranks[p_id] = rank
+            return (ranks, total)
 
-        rank = counter + 1 if player_found else None
-        return (rank, query.count())
+        # Ranked over the active players directly rather than Player.leaderboard(), whose count() would cost a second round trip.
+        # COUNT(*) OVER () gives the same count, and only in the rare case of fewer than 10 active players is it ranked again over everyone
+        ranks, total = ranks_from(Player.active_players(date_cutoff=date_cutoff))
+        if total < 10:
+            ranks, total = ranks_from(Player.select())
+        return (ranks, total)
 
     def wins(self):
 
@@ -66,7 +152,13 @@ class Player(BaseModel):
 
     def get_record(self):
 
-        return (self.wins().count(), self.losses().count())
+        return (self.win_count, self.loss_count)
+
+    def active_players(date_cutoff):
+        # Players with a confirmed game since date_cutoff who are not banned. Served by the player_active_elo partial index
+        return Player.select().where(
+            (Player.last_completed_ts > date_cutoff) & (Player.is_banned == 0)
+        )
 
     def leaderboard(date_cutoff, max_flag: bool = False):
 
@@ -75,9 +167,7 @@ class Player(BaseModel):
         else:
             elo_field = Player.elo
 
-        query = Player.select().join(PlayerGame).join(Game).where(
-            (Game.is_confirmed == 1) & (Game.completed_ts > date_cutoff) & (Player.is_banned == 0)
-        ).distinct().order_by(-elo_field)
+        query = Player.active_players(date_cutoff=date_cutoff).order_by(-elo_field)
 
         if query.count() < 10:
             # Include all registered players on leaderboard if not many games played
@@ -85,9 +175,170 @@ class Player(BaseModel):
 
         return query
 
+    def leaderboard_page(date_cutoff, max_flag: bool = False, limit: int = 12, after=None, before=None, last: bool = False, offset: int = None):
+        # One page of the leaderboard in (elo desc, id) order using keyset pagination, so the cost of a page doesn't depend on how deep it is.
+        # after / before are the (elo, id) of the last row of the previous page / first row of the following page.
+        # last=True returns the final `limit` rows. offset is a fallback for jumping to a page without a neighbouring page's keys.
+        # Returns [(player_id, name, elo, elo_max, wins, losses), ...] in leaderboard order
+
+        if max_flag:
+            elo_field = Player.elo_max
+        else:
+            elo_field = Player.elo
+
+        query = Player.leaderboard(date_cutoff=date_cutoff, max_flag=max_flag).select(
+            Player.id, Player.name, Player.elo, Player.elo_max, Player.win_count, Player.loss_count
+        )
+
+        reverse = bool(before) or last
+        if after:
+            elo, player_id = after
+            query = query.where((elo_field < elo) | ((elo_field == elo) & (Player.id > player_id)))
+        elif before:
+            elo, player_id = before
+            query = query.where((elo_field > elo) | ((elo_field == elo) & (Player.id < player_id)))
+
+        if reverse:
+            query = query.order_by(elo_field, -Player.id)
+        else:
+            query = query.order_by(-elo_field, Player.id)
+
+        if offset and not reverse:
+            query = query.offset(offset)
+
+        rows = list(query.limit(limit).tuples())
+        return rows[::-1] if reverse else rows
+
+    def leaderboard_count_above(date_cutoff, elo: int, max_flag: bool = False):
+        # Number of players on the leaderboard rated higher than elo, ie the rank of a player with that rating is this + 1
+
+        elo_field = Player.elo_max if max_flag else Player.elo
+        return Player.leaderboard(date_cutoff=date_cutoff, max_flag=max_flag).where(elo_field > elo).order_by().count()
+
+    def leaderboard_leaders(date_cutoff):
+        # Discord IDs of the players ranked #1 on the leaderboard. Several if they are tied
+        top_elo = Player.leaderboard(date_cutoff=date_cutoff).select(fn.MAX(Player.elo)).order_by().scalar()
+        if top_elo is None:
+            return set()
+        query = Player.leaderboard(date_cutoff=date_cutoff).select(Player.discord_id).where(Player.elo == top_elo).order_by()
+        return {discord_id for (discord_id,) in query.tuples()}
+
+    def heroes(min_elo: int):
+        # Discord IDs of non-banned players whose ELO has ever reached min_elo
+        query = Player.select(Player.discord_id).where((Player.elo_max >= min_elo) & (Player.is_banned == 0))
+        return {discord_id for (discord_id,) in query.tuples()}
+
+    def rebuild_stats(players=None):
+        # Recount win_count, loss_count, games_played and last_completed_ts from confirmed games with one UPDATE ... FROM.
+        # players is an optional list of players or player IDs to limit the rebuild to
+        PlayerAlias = Player.alias()
+        stats = PlayerAlias.select(
+            PlayerAlias.id,
+            fn.COUNT(Game.id).filter(Game.winning_player == PlayerAlias.id).alias('wins'),
+            fn.COUNT(Game.id).filter(Game.losing_player == PlayerAlias.id).alias('losses'),
+            fn.MAX(Game.completed_ts).alias('last_completed_ts')
+        ).join(Game, JOIN.LEFT_OUTER, on=(
+            ((Game.winning_player == PlayerAlias.id) | (Game.losing_player == PlayerAlias.id)) & (Game.is_confirmed == 1)
+        )).group_by(PlayerAlias.id)
+
+        if players is not None:
+            stats = stats.where(PlayerAlias.id.in_([p.id if isinstance(p, Player) else p for p in players]))
+
+        stats = stats.alias('stats')
+        return Player.update(
+            win_count=stats.c.wins, loss_count=stats.c.losses, games_played=stats.c.wins + stats.c.losses, last_completed_ts=stats.c.last_completed_ts
+        ).from_(stats).where(Player.id == stats.c.id).execute()
+
+    def rebuild_rating_index(date_cutoff=None):
+        # Load every active player into the in-memory rating_index
+        date_cutoff = date_cutoff if date_cutoff else settings.date_cutoff
+        query = Player.active_players(date_cutoff=date_cutoff).select(Player.id, Player.elo, Player.elo_max)
+        rating_index.load(query.tuples(), date_cutoff=date_cutoff)
+
+    def refresh_rating_index(players):
+        # Re-check leaderboard eligibility and ratings of specific players in the rating_index from their committed rows, ie after a game is confirmed
+        if not rating_index.loaded:
+            return
+        player_ids = [p.id if isinstance(p, Player) else p for p in players]
+
+        def load():
+            return Player.active_players(date_cutoff=rating_index.date_cutoff).select(Player.id, Player.elo, Player.elo_max).where(
+                Player.id.in_(player_ids)
+            ).tuples()
+
+        rating_index.refresh(player_ids, load)
+
+    def check_rating_index(date_cutoff=None):
+        # Compare ranks in the rating_index against ranks calculated by the database. Returns list of (player_id, index_rank, db_rank) mismatches
+        date_cutoff = date_cutoff if date_cutoff else rating_index.date_cutoff
+        active_ids = [p_id for p_id, in Player.active_players(date_cutoff=date_cutoff).select(Player.id).tuples()]
+        candidates = set(active_ids) | set(rating_index.ratings().keys())
+
+        mismatches = []
+        for max_flag in (False, True):
+            db_ranks, _ = Player.leaderboard_ranks(candidates, date_cutoff=date_cutoff, max_flag=max_flag, use_index=False)
+            for p_id in candidates:
+                index_rank = rating_index.rank(p_id, max_flag=max_flag)
+                if index_rank != db_ranks.get(p_id):
+                    mismatches.append((p_id, max_flag, index_rank, db_ranks.get(p_id)))
+        return mismatches
+
+    def ratings_before(timestamp, players=None):
+        # Returns {player_id: (elo, elo_max)} as they were before any game confirmed at or after timestamp. Players with no earlier games are omitted
+        # (ie they are at the default rating). If players is None all players are included.
+        # Starts from the nearest RatingCheckpoint before timestamp and applies PlayerGame.elo_after_game of each player's last confirmed game since then
+
+        checkpoint = RatingCheckpoint.nearest(timestamp)
+        ratings = checkpoint.ratings(players=players) if checkpoint else {}
+
+        game_filter = (Game.is_confirmed == 1) & (Game.completed_ts < timestamp)
+        if checkpoint:
+            game_filter &= checkpoint.after_cursor()
+        if players is not None:
+            game_filter &= (PlayerGame.player.in_(list(players)))
+
+        query = PlayerGame.select(
+            PlayerGame.player, PlayerGame.elo_after_game,
+            fn.MAX(PlayerGame.elo_after_game).over(partition_by=[PlayerGame.player]).alias('elo_max')
+        ).join(Game).where(game_filter).order_by(PlayerGame.player, Game.completed_ts.desc(), Game.id.desc()).distinct(PlayerGame.player)
+
+        for p_id, elo, elo_max in query.tuples():
+            _, previous_max = ratings.get(p_id, (elo_engine.DEFAULT_ELO, elo_engine.DEFAULT_ELO))
+            ratings[p_id] = (elo, max(elo_max, previous_max))
+        return ratings
+
+    def leaderboard_as_of(as_of, max_flag: bool = False, days: int = 90):
+        # Leaderboard as it stood at a point in time, built from the nearest RatingCheckpoint plus the games since.
+        # Players count as active if they had a confirmed game in the 90 days before as_of. Returns [(player_id, name, elo, elo_max, rank), ...]
+
+        ratings = Player.ratings_before(as_of)
+        active_players = PlayerGame.select(PlayerGame.player).join(Game).where(
+            (Game.is_confirmed == 1) & (Game.completed_ts < as_of) & (Game.completed_ts > as_of - datetime.timedelta(days=days))
+        )
+        query = Player.select(Player.id, Player.name).where((Player.id.in_(active_players)) & (Player.is_banned == 0))
+        names = dict(query.tuples())
+        if len(names) < 10:
+            # Include all players who had played by then if not many games played, like Player.leaderboard()
+            names = dict(Player.select(Player.id, Player.name).where(Player.id.in_(list(ratings.keys()))).tuples())
+
+        sort_index = 1 if max_flag else 0
+        rows = sorted(((p_id, ratings.get(p_id, (elo_engine.DEFAULT_ELO, elo_engine.DEFAULT_ELO))) for p_id in names), key=lambda r: (-r[1][sort_index], r[0]))
+
+        leaderboard, rank, previous = [], 0, None
+        for position, (p_id, (elo, elo_max)) in enumerate(rows, start=1):
+            value = elo_max if max_flag else elo
+            if value != previous:
+                rank, previous = position, value
+            leaderboard.append((p_id, names[p_id], elo, elo_max, rank))
+        return leaderboard
+
     def string_matches(player_string: str):
         # Returns QuerySet containing players in current guild matching string. Searches against discord mention ID first, then exact discord name match,
         # then falls back to substring match on name/nick
+        # Uses the in-memory player_name_index if it is loaded, which resolves any search with a single query
+
+        if player_name_index.loaded:
+            return Player.indexed_string_matches(player_string)
 
         try:
             p_id = int(player_string.strip('<>!@'))
@@ -101,12 +352,7 @@ class Player(BaseModel):
             if query_by_id.count() > 0:
                 return query_by_id
 
-        if len(player_string.split('#', 1)[0]) > 2:
-            discord_str = player_string.split('#', 1)[0]
-            # If query is something like 'Nelluk#7034', use just the 'Nelluk' to match against discord_name.
-            # This happens if user does an @Mention then removes the @ character
-        else:
-            discord_str = player_string
+        discord_str = Player._discord_name_str(player_string)
 
         name_exact_match = Player.select(Player).where(
             (Player.name ** discord_str)  # ** is case-insensitive
@@ -125,6 +371,56 @@ class Player(BaseModel):
 
         return []
 
+    def _discord_name_str(player_string: str):
+        if len(player_string.split('#', 1)[0]) > 2:
+            # If query is something like 'Nelluk#7034', use just the 'Nelluk' to match against discord_name.
+            # This happens if user does an @Mention then removes the @ character
+            return player_string.split('#', 1)[0]
+        return player_string
+
+    def indexed_string_matches(player_string: str):
+        # Same matching rules as string_matches(), resolved against player_name_index. Substring matches are ranked
+        # exact match first, then prefix, then other substrings, and by games played within each group
+
+        def fetch(player_ids):
+            players = {p.id: p for p in Player.select().where(Player.id.in_(list(player_ids)))}
+            return [players[p_id] for p_id in player_ids if p_id in players]
+
+        try:
+            p_id = int(player_string.strip('<>!@'))
+        except ValueError:
+            pass
+        else:
+            # lookup either on <@####> mention string or raw ID #
+            if p_id in player_name_index.discord_ids:
+                return fetch([player_name_index.discord_ids[p_id]])
+            # not indexed, ie registered by another bot process since the index was loaded, so check the table as string_matches() would
+            query_by_id = list(Player.select().where(Player.discord_id == p_id))
+            if query_by_id:
+                for player in query_by_id:
+                    player.update_name_index()
+                return query_by_id
+
+        name_exact_match = player_name_index.exact(Player._discord_name_str(player_string))
+        if len(name_exact_match) == 1:
+            # String matches DiscordUser.name exactly
+            return fetch(name_exact_match)
+
+        games_played = player_name_index.games_played
+        ranked = []
+        for tier, matches in enumerate(player_name_index.search(player_string)):
+            ranked.extend(sorted((p_id for p_id in matches if games_played[p_id] > 0), key=lambda p_id: (tier, -games_played[p_id], p_id)))
+
+        return fetch(ranked) if ranked else []
+
+    def rebuild_name_index():
+        # Load every player into the in-memory player_name_index, along with how many games they have entered
+        query = Player.select(Player.id, Player.discord_id, Player.name, fn.COUNT(PlayerGame.id)).join(PlayerGame, JOIN.LEFT_OUTER).group_by(Player.id)
+        player_name_index.load(query.tuples())
+
+    def update_name_index(self):
+        player_name_index.add_player(self.id, self.discord_id, self.name)
+
 
 class Game(BaseModel):
     name = TextField(null=True)
@@ -137,6 +433,7 @@ class Game(BaseModel):
     winning_player = ForeignKeyField(Player, null=False, backref='winning_player', on_delete='RESTRICT')
     elo_change_winner = SmallIntegerField(default=0)
     elo_change_loser = SmallIntegerField(default=0)
+    rejected_ts = DateTimeField(null=True, default=None)  # set when the loser rejects the claim. Rejected games are never confirmed automatically
 
     def __setattr__(self, name, value):
         if name == 'name':
@@ -157,11 +454,26 @@ class Game(BaseModel):
         if created:
             PlayerGame.create(player=winning_player, game=game)
             PlayerGame.create(player=losing_player, game=game)
+            if player_name_index.loaded:
+                winning_player.update_name_index()
+                losing_player.update_name_index()
+                player_name_index.add_games([winning_player.id, losing_player.id])
         return game, created
 
     def confirm(self, bypass_check=False):
         # Calculate elo changes for a newly-confirmed game and write new values to database
 
+        try:
+            winner_before, loser_before = self._write_confirmation(bypass_check=bypass_check)
+        except DatabaseError:
+            # the transaction rolled back, possibly after counting this game towards the next checkpoint
+            checkpoint_schedule.invalidate()
+            raise
+        self._after_confirmation(winner_before, loser_before)
+        return self.winning_player.elo, self.losing_player.elo
+
+    def _write_confirmation(self, bypass_check=False):
+        # The database half of confirm(), in its own transaction (or a savepoint, if called inside one). Returns both players' ELO before the game
         if self.is_confirmed and not bypass_check:
             # checks to make sure we aren't confirming an already-confirmed game.
             # if bypass_check=True, confirming will be allowed to continue even if is_confirmed is set.
@@ -171,10 +483,24 @@ class Game(BaseModel):
         logger.debug(f'Confirming game {self.id}')
         elo_logger.debug(f'Confirm game {self.id}')
 
-        winner_delta = self.calc_elo_delta(for_winner=True)
-        loser_delta = self.calc_elo_delta(for_winner=False)
+        with db.atomic():
+            # Lock the game and both players before reading their ratings, players in ID order so that two confirmations can't deadlock.
+            # A concurrent confirmation that shares a player waits here until this one commits, then computes its deltas from the committed ELO
+            locked_game = Game.select(Game.id, Game.is_confirmed).where(Game.id == self.id).for_update().first()
+            if not locked_game:
+                # Could happen if game is deleted while Game object is still in memory and then a confirm is attempted, usually if a user deletes a game during the auto-confirm time
+                raise Game.DoesNotExist('Game can not be found. No ELO changes saved.')
+            if locked_game.is_confirmed and not bypass_check:
+                raise ValueError('Cannot confirm game - is_confirmed is already marked as True')
+            locked_players = {p.id: p for p in Player.select().where(
+                Player.id.in_([self.winning_player_id, self.losing_player_id])
+            ).order_by(Player.id).for_update()}
+            self.winning_player, self.losing_player = locked_players[self.winning_player_id], locked_players[self.losing_player_id]
+
+            winner_delta = self.calc_elo_delta(for_winner=True)
+            loser_delta = self.calc_elo_delta(for_winner=False)
+            winner_before, loser_before = self.winning_player.elo, self.losing_player.elo
 
-        with db.atomic() as transaction:
             elo_logger.debug(f'Winning player {self.winning_player.name} going from {self.winning_player.elo} to {int(self.winning_player.elo + winner_delta)}')
             self.winning_player.elo = int(self.winning_player.elo + winner_delta)
             if self.winning_player.elo > self.winning_player.elo_max:
@@ -185,123 +511,233 @@ class Game(BaseModel):
             self.losing_player.elo = int(self.losing_player.elo + loser_delta)
             self.elo_change_loser = loser_delta
 
-            self.winning_player.save()
-            self.losing_player.save()
             self.is_confirmed = True
+            # set after the locks are taken, so completed_ts order matches the order that games sharing a player were rated in
             self.completed_ts = datetime.datetime.now()
 
+            for player, won in ((self.winning_player, True), (self.losing_player, False)):
+                # the row is locked, so saving the absolute ELO can't overwrite a concurrent confirmation
+                player.save(only=[Player.elo, Player.elo_max])
+                Player.update(
+                    win_count=Player.win_count + (1 if won else 0), loss_count=Player.loss_count + (0 if won else 1),
+                    games_played=Player.games_played + 1, last_completed_ts=self.completed_ts
+                ).where(Player.id == player.id).execute()
+                player.win_count += 1 if won else 0
+                player.loss_count += 0 if won else 1
+                player.games_played += 1
+                player.last_completed_ts = self.completed_ts
+
             for playergame in self.playergame:
-                if playergame.player == self.winning_player:
+                if playergame.player_id == self.winning_player_id:
                     playergame.elo_after_game = self.winning_player.elo
                 else:
                     playergame.elo_after_game = self.losing_player.elo
                 playergame.save()
 
-            update_count = self.save()
-            if not update_count:
-                # Could happen if game is deleted while Game object is still in memory and then a confirm is attempted, usually if a user deletes a game during the auto-confirm time
-                transaction.rollback()
-                raise Game.DoesNotExist('Game can not be found. No ELO changes saved.')
+            self.save()
+            Matchup.add_game(self)
+            RatingCheckpoint.create_if_due(last_game=self)
+        return winner_before, loser_before
+
+    def _after_confirmation(self, winner_before: int, loser_before: int):
+        # Update the in-memory indexes, caches and the ELO event log for a confirmation. Only call once its transaction has committed,
+        # since none of these can be rolled back
+        # re-read rather than using this thread's copy of the players, which a later confirmation on another thread may already have superseded
+        Player.refresh_rating_index([self.winning_player_id, self.losing_player_id])
+        render_cache.bump_version(f'game {self.id} confirmed')
+        elo_event_log.record_game('confirm', self.id, self.completed_ts, self.winning_player.id, winner_before, self.winning_player.elo,
+                                  self.losing_player.id, loser_before, self.losing_player.elo)
+
+    def stale_pending_games(claimed_before, limit: int = None, exclude=()):
+        # Unconfirmed games claimed before claimed_before that nobody is waiting on, ie with no PendingConfirmation, and that the loser
+        # has not rejected. In claim order. Served by the game_pending_claimed_ts partial index
+        query = Game.select().join(PendingConfirmation, JOIN.LEFT_OUTER, on=(PendingConfirmation.game == Game.id)).where(
+            (Game.is_confirmed == 0) & (Game.win_claimed_ts < claimed_before) & (PendingConfirmation.id.is_null()) & (Game.rejected_ts.is_null())
+        ).order_by(Game.win_claimed_ts, Game.id)
+        if exclude:
+            query = query.where(Game.id.not_in(list(exclude)))
+        if limit:
+            query = query.limit(limit)
+        return query
 
-            return self.winning_player.elo, self.losing_player.elo
+    def confirm_stale_games(claimed_before, batch_size: int = 50):
+        # Confirm every stale pending game in claim order, batch_size games per transaction, so their completed_ts order matches the order they were claimed.
+        # Each batch's index, cache and event log updates are applied after it commits, so a failed batch leaves no trace of its games.
+        # Returns [(game, winner new elo, loser new elo), ...]
+
+        confirmed, skipped = [], set()
+        while True:
+            written = []
+            try:
+                with db.atomic():
+                    batch = list(Game.stale_pending_games(claimed_before, limit=batch_size, exclude=skipped))
+                    for game in batch:
+                        try:
+                            # runs in a savepoint, so a skipped game doesn't roll back the rest of the batch
+                            written.append((game, game._write_confirmation()))
+                        except (ValueError, Game.DoesNotExist) as e:
+                            logger.warn(f'Skipping stale game {game.id}: {e}')
+                            skipped.add(game.id)
+            except Exception:
+                # the batch rolled back after its games were counted towards the next checkpoint
+                checkpoint_schedule.invalidate()
+                raise
+
+            for game, (winner_before, loser_before) in written:
+                game._after_confirmation(winner_before, loser_before)
+                confirmed.append((game, game.winning_player.elo, game.losing_player.elo))
+            if len(batch) < batch_size:
+                return confirmed
 
     def calc_elo_delta(self, for_winner=True):
-        max_elo_delta = 32  # elo 'k' value
-
-        def chance_of_winning(target_elo, opponent_elo):
-            # Calculate the expected chance of winning based on one player's elo compared to their opponent's elo.
-            return round(1 / (1 + (10 ** ((opponent_elo - target_elo) / 400.0))), 3)
+        return elo_engine.elo_delta(winner_elo=self.winning_player.elo, loser_elo=self.losing_player.elo, losing_score=self.losing_score, for_winner=for_winner)
 
-        # Calculate a base change of elo based on your chance of winning and whether or not you won
-        if for_winner is True:
-            elo = self.winning_player.elo
-            elo_delta = int(round((max_elo_delta * (1 - chance_of_winning(target_elo=elo, opponent_elo=self.losing_player.elo))), 0))
-        else:
-            elo = self.losing_player.elo
-            elo_delta = int(round((max_elo_delta * (0 - chance_of_winning(target_elo=elo, opponent_elo=self.winning_player.elo))), 0))
-
-        elo_boost = .60 * ((1200 - max(min(elo, 1200), 900)) / 300)  # 60% boost to delta at elo 900, gradually shifts to 0% boost at 1200 ELO
+    def reverse_confirmation(self):
+        # Return a confirmed game to the unconfirmed state. ELO for both players and any games confirmed since are recalculated as in delete_game().
+        # The claim time is reset, so the reversed game gets a full confirmation window before the stale game sweep would confirm it again
+        self._rewind(delete=False)
 
-        elo_bonus = int(abs(elo_delta) * elo_boost)
-        elo_delta += elo_bonus
+    def delete_game(self):
+        # deletes related lineup records and the game entry itself. If the game was confirmed, ELO for both players and any games confirmed since are recalculated
+        self._rewind(delete=True)
 
-        if self.losing_score == 0:
-            elo_delta = int(round(elo_delta * 1.15))  # larger delta for a 3-0 blowout
-        elif self.losing_score == 2:
-            elo_delta = int(round(elo_delta * 0.85))  # smaller delta for a 3-2 close game
+    def _rewind(self, delete: bool):
+        # Shared by delete_game() and reverse_confirmation(). Logs a 'delete' or 'reverse' event with both players' ELO before and after
 
-        return elo_delta
+        logger.info(f'{"Deleting" if delete else "Reversing confirmation of"} game {self.id}')
+        player_ids = [self.winning_player_id, self.losing_player_id]
 
-    def reverse_confirmation(self):
-        # revert elo changes and return game to unconfirmed state
-        self.winning_player.elo += self.elo_change_winner * -1
-        self.winning_player.save()
-        self.elo_change_winner = 0
+        with db.atomic():
+            # This object may have been loaded before a confirmation that has since committed, so whether ELO needs rebuilding is decided
+            # from the locked row. Locking it also makes a confirmation that arrives later wait, then find the game gone
+            locked_game = Game.select(Game.id, Game.is_confirmed, Game.completed_ts).where(Game.id == self.id).for_update().first()
+            if not locked_game:
+                raise Game.DoesNotExist(f'Game {self.id} has already been deleted.')
+            recalculate, since = locked_game.is_confirmed, locked_game.completed_ts
+            if not recalculate and not delete:
+                raise ValueError('Cannot reverse game - it is not confirmed')
+            if recalculate:
+                # players in ID order, as in _write_confirmation()
+                elo_before = dict(Player.select(Player.id, Player.elo).where(Player.id.in_(player_ids)).order_by(Player.id).for_update().tuples())
+
+            if delete:
+                PlayerGame.delete().where(PlayerGame.game == self).execute()
+                PendingConfirmation.delete().where(PendingConfirmation.game == self).execute()
+                self.delete_instance()
+            else:
+                self.is_confirmed, self.completed_ts, self.win_claimed_ts = False, None, datetime.datetime.now()
+                self.elo_change_winner, self.elo_change_loser = 0, 0
+                self.save(only=[Game.is_confirmed, Game.completed_ts, Game.win_claimed_ts, Game.elo_change_winner, Game.elo_change_loser])
+                PlayerGame.update(elo_after_game=None).where(PlayerGame.game == self).execute()
 
-        self.losing_player.elo += self.elo_change_loser * -1
-        self.losing_player.save()
-        self.elo_change_loser = 0
+            if recalculate:
+                try:
+                    result, completed_ts = Game._write_recalculation(timestamp=since, players=player_ids)
+                finally:
+                    checkpoint_schedule.invalidate()
+                elo_after = dict(Player.select(Player.id, Player.elo).where(Player.id.in_(player_ids)).tuples())
+
+        if delete:
+            player_name_index.add_games(player_ids, amount=-1)
+        event = 'delete' if delete else 'reverse'
+        if recalculate:
+            winner_id, loser_id = player_ids
+            elo_event_log.record_game(event, self.id, since, winner_id, elo_before[winner_id], elo_after[winner_id],
+                                      loser_id, elo_before[loser_id], elo_after[loser_id])
+            Game._after_recalculation(result, completed_ts, reason=f'game {self.id} {event}d')
+        else:
+            render_cache.bump_version(f'game {self.id} deleted')
 
-        for playergame in self.playergame:
-            playergame.elo_after_game = None
-            playergame.save()
+    def recalculate_elo_since(timestamp, players=()):
+        # Rebuild ELO for every game confirmed at or after timestamp. Each affected player's rating is seeded from their last game before timestamp,
+        # the later games are replayed in memory and the results are written back in bulk in one transaction.
+        # players is an optional list of player IDs to re-seed even if they have no games since timestamp, ie the players of a deleted game
 
-        self.is_confirmed = False
-        self.completed_ts = None
+        try:
+            result, completed_ts = Game._write_recalculation(timestamp, players=players)
+        finally:
+            checkpoint_schedule.invalidate()
+        Game._after_recalculation(result, completed_ts, reason=f'ELO recalculated since {timestamp}')
+        return result
 
-        self.save()
+    def _write_recalculation(timestamp, players=()):
+        # The database half of recalculate_elo_since(), in its own transaction (or a savepoint, if called inside one).
+        # Returns the elo_engine.ReplayResult and {game_id: completed_ts} of the replayed games
 
-    def delete_game(self):
-        # resets any relevant ELO changes to players and teams, deletes related lineup records, and deletes the game entry itself
+        elo_logger.debug(f'recalculate_elo_since {timestamp}')
+        start = timer()
 
-        logger.info(f'Deleting game {self.id}')
-        recalculate = False
         with db.atomic():
-            if self.is_confirmed:
-                self.is_confirmed = False
-                recalculate = True
-                since = self.completed_ts
-
-                self.reverse_confirmation()
+            RatingCheckpoint.invalidate_since(timestamp)
 
-            for playergame in self.playergame:
-                playergame.delete_instance()
+            games = Game.select(Game.id, Game.winning_player, Game.losing_player, Game.losing_score, Game.completed_ts).where(
+                (Game.is_confirmed == 1) & (Game.completed_ts >= timestamp)
+            ).order_by(Game.completed_ts, Game.id)
+            game_rows = list(games.tuples())
 
-            self.delete_instance()
+            affected_players = set(players)
+            for _, winner_id, loser_id, _, _ in game_rows:
+                affected_players.update((winner_id, loser_id))
 
-            if recalculate:
-                Game.recalculate_elo_since(timestamp=since)
+            seed_ratings = Player.ratings_before(timestamp, players=affected_players)
+            result = elo_engine.replay_games(game_rows, seed_ratings=seed_ratings, players=affected_players)
+            result.timings['load'] = timer() - start - result.timings['replay']
 
-    def recalculate_elo_since(timestamp):
-        games = Game.select().where(
-            (Game.is_confirmed == 1) & (Game.completed_ts >= timestamp)
-        ).order_by(Game.completed_ts)
+            write_replay_result(result)
+            Player.rebuild_stats(affected_players)
+            Matchup.rebuild(players=affected_players)
+            if len(result) >= settings.checkpoint_interval_games:
+                RatingCheckpoint.create_from_players()
 
-        elo_logger.debug(f'recalculate_elo_since {timestamp}')
-        for g in games:
-            g.reverse_confirmation()
-
-        for g in games:
-            g.confirm()
+        timings_str = ', '.join(f'{k} {v:.2f}s' for k, v in result.timings.items())
+        logger.info(f'recalculate_elo_since {timestamp} replayed {len(result)} games for {len(affected_players)} players: {timings_str}')
         elo_logger.debug(f'recalculate_elo_since complete')
+        return result, {row[0]: row[4] for row in game_rows}
+
+    def _after_recalculation(result, completed_ts, reason: str):
+        # Update the rating index, render cache and ELO event log for a recalculation. Only call once its transaction has committed
+        if rating_index.loaded:
+            Player.rebuild_rating_index(date_cutoff=rating_index.date_cutoff)
+        render_cache.bump_version(reason, rewrites_history=True)
+        elo_event_log.record_replay(result, completed_ts=completed_ts)
 
     def recalculate_all_elo():
-        # Reset all ELOs to 1000,  and re-run Game.declare_winner() on all qualifying games
+        # Reset all ELOs to 1000 and replay every confirmed game in memory, then write the results back in bulk.
+        # Produces the same ratings as calling Game.confirm() on each game in order, without the per-game round trips
 
         logger.warn('Resetting and recalculating all ELO')
         elo_logger.info(f'recalculate_all_elo')
 
-        with db.atomic():
-            Player.update(elo=1000, elo_max=1000).execute()
-
-            games = Game.select().where(
-                (Game.is_confirmed == 1)
-            ).order_by(Game.completed_ts)
+        start = timer()
+        games = Game.select(Game.id, Game.winning_player, Game.losing_player, Game.losing_score, Game.completed_ts).where(
+            (Game.is_confirmed == 1)
+        ).order_by(Game.completed_ts, Game.id)
 
-            for game in games:
-                game.confirm(bypass_check=True)
+        def save_checkpoint(result, game_id, completed_ts):
+            ratings = [r for r in result.player_ratings() if r[1:] != (elo_engine.DEFAULT_ELO, elo_engine.DEFAULT_ELO)]
+            RatingCheckpoint.create_from_ratings(ratings, last_game_id=game_id, last_completed_ts=completed_ts, game_count=len(result))
 
+        with db.atomic():
+            # every existing checkpoint was computed from the old ratings, so they are all replaced with ones taken during the replay
+            RatingCheckpoint.delete().execute()
+            result = elo_engine.replay_games(games.tuples().iterator(), checkpoint_every=settings.checkpoint_interval_games, on_checkpoint=save_checkpoint)
+            result.timings['load'] = timer() - start - result.timings['replay']
+
+            Player.update(elo=elo_engine.DEFAULT_ELO, elo_max=elo_engine.DEFAULT_ELO).execute()
+            write_replay_result(result)
+            Player.rebuild_stats()
+            Matchup.rebuild()
+
+        checkpoint_schedule.invalidate()
+        if rating_index.loaded:
+            Player.rebuild_rating_index(date_cutoff=rating_index.date_cutoff)
+        render_cache.bump_version('all ELO recalculated', rewrites_history=True)
+        elo_event_log.record_replay(result)
+
+        timings_str = ', '.join(f'{k} {v:.2f}s' for k, v in result.timings.items())
+        logger.info(f'recalculate_all_elo replayed {len(result)} games: {timings_str}')
         elo_logger.info(f'recalculate_all_elo complete')
+        return result
 
 
 class PlayerGame(BaseModel):
@@ -310,5 +746,271 @@ class PlayerGame(BaseModel):
     elo_after_game = SmallIntegerField(default=None, null=True)  # snapshot of what elo was after game concluded
 
 
-with db:
-    db.create_tables([Player, Game, PlayerGame])
+class Matchup(BaseModel):
+    # Head-to-head record of player against opponent, from player's point of view. Each pair that has played has two rows, one each way.
+    # Maintained by Game.confirm() and rebuilt from Game by Matchup.rebuild()
+    player = ForeignKeyField(Player, null=False, on_delete='CASCADE')
+    opponent = ForeignKeyField(Player, null=False, on_delete='CASCADE')
+    games = IntegerField(default=0)
+    wins = IntegerField(default=0)
+    losses = IntegerField(default=0)
+    wins_3_0 = IntegerField(default=0)  # score distribution, from player's point of view
+    wins_3_1 = IntegerField(default=0)
+    wins_3_2 = IntegerField(default=0)
+    losses_0_3 = IntegerField(default=0)
+    losses_1_3 = IntegerField(default=0)
+    losses_2_3 = IntegerField(default=0)
+    elo_net = IntegerField(default=0)  # ELO player has gained (or lost, if negative) in games against opponent
+    last_completed_ts = DateTimeField(null=True, default=None)
+
+    class Meta:
+        indexes = ((('player', 'opponent'), True),)
+
+    def _row_values(player_id, opponent_id, won: bool, losing_score, elo_change, completed_ts):
+        return {
+            'player': player_id, 'opponent': opponent_id, 'games': 1, 'wins': 1 if won else 0, 'losses': 0 if won else 1,
+            'wins_3_0': 1 if won and losing_score == 0 else 0, 'wins_3_1': 1 if won and losing_score == 1 else 0, 'wins_3_2': 1 if won and losing_score == 2 else 0,
+            'losses_0_3': 1 if not won and losing_score == 0 else 0, 'losses_1_3': 1 if not won and losing_score == 1 else 0, 'losses_2_3': 1 if not won and losing_score == 2 else 0,
+            'elo_net': elo_change, 'last_completed_ts': completed_ts,
+        }
+
+    def add_game(game):
+        # Add a newly confirmed game to both players' rows with one INSERT ... ON CONFLICT DO UPDATE
+        rows = [
+            Matchup._row_values(game.winning_player_id, game.losing_player_id, True, game.losing_score, game.elo_change_winner, game.completed_ts),
+            Matchup._row_values(game.losing_player_id, game.winning_player_id, False, game.losing_score, game.elo_change_loser, game.completed_ts),
+        ]
+        counters = ['games', 'wins', 'losses', 'wins_3_0', 'wins_3_1', 'wins_3_2', 'losses_0_3', 'losses_1_3', 'losses_2_3', 'elo_net']
+        update = {getattr(Matchup, c): getattr(Matchup, c) + getattr(EXCLUDED, c) for c in counters}
+        update[Matchup.last_completed_ts] = fn.GREATEST(Matchup.last_completed_ts, EXCLUDED.last_completed_ts)
+        return Matchup.insert_many(rows).on_conflict(conflict_target=[Matchup.player, Matchup.opponent], update=update).execute()
+
+    def rebuild(players=None, pairs=None):
+        # Rebuild rows from confirmed games with one INSERT ... SELECT. Limited to rows involving any of players (IDs),
+        # or to the given (player_id, opponent_id) pairs (either order), if either is given. Should be called inside a transaction
+
+        won = Game.select(
+            Game.winning_player.alias('player_id'), Game.losing_player.alias('opponent_id'), Value(1).alias('won'),
+            Game.losing_score.alias('losing_score'), Game.elo_change_winner.alias('elo_change'), Game.completed_ts.alias('completed_ts')
+        ).where(Game.is_confirmed == 1)
+        lost = Game.select(
+            Game.losing_player.alias('player_id'), Game.winning_player.alias('opponent_id'), Value(0).alias('won'),
+            Game.losing_score.alias('losing_score'), Game.elo_change_loser.alias('elo_change'), Game.completed_ts.alias('completed_ts')
+        ).where(Game.is_confirmed == 1)
+
+        delete = Matchup.delete()
+        if players is not None:
+            player_ids = list(players)
+            won = won.where((Game.winning_player.in_(player_ids)) | (Game.losing_player.in_(player_ids)))
+            lost = lost.where((Game.winning_player.in_(player_ids)) | (Game.losing_player.in_(player_ids)))
+            delete = delete.where((Matchup.player.in_(player_ids)) | (Matchup.opponent.in_(player_ids)))
+        elif pairs is not None:
+            pair_filter = reduce(operator.or_, [
+                ((Game.winning_player == a) & (Game.losing_player == b)) | ((Game.winning_player == b) & (Game.losing_player == a)) for a, b in pairs
+            ])
+            won, lost = won.where(pair_filter), lost.where(pair_filter)
+            delete = delete.where(reduce(operator.or_, [
+                ((Matchup.player == a) & (Matchup.opponent == b)) | ((Matchup.player == b) & (Matchup.opponent == a)) for a, b in pairs
+            ]))
+
+        games = won.union_all(lost).alias('g')
+        won_col, score_col = games.c.won, games.c.losing_score
+
+        def count_if(condition):
+            return fn.COUNT(SQL('*')).filter(condition)
+
+        aggregate = Select(columns=[
+            games.c.player_id, games.c.opponent_id, fn.COUNT(SQL('*')),
+            count_if(won_col == 1), count_if(won_col == 0),
+            count_if((won_col == 1) & (score_col == 0)), count_if((won_col == 1) & (score_col == 1)), count_if((won_col == 1) & (score_col == 2)),
+            count_if((won_col == 0) & (score_col == 0)), count_if((won_col == 0) & (score_col == 1)), count_if((won_col == 0) & (score_col == 2)),
+            fn.COALESCE(fn.SUM(games.c.elo_change), 0), fn.MAX(games.c.completed_ts),
+        ]).from_(games).group_by(games.c.player_id, games.c.opponent_id)
+
+        delete.execute()
+        return Matchup.insert_from(aggregate, [
+            Matchup.player, Matchup.opponent, Matchup.games, Matchup.wins, Matchup.losses,
+            Matchup.wins_3_0, Matchup.wins_3_1, Matchup.wins_3_2, Matchup.losses_0_3, Matchup.losses_1_3, Matchup.losses_2_3,
+            Matchup.elo_net, Matchup.last_completed_ts,
+        ]).execute()
+
+
+class RatingCheckpoint(BaseModel):
+    # Snapshot of every player's rating after all games confirmed up to and including (last_completed_ts, last_game_id).
+    # Players without an entry were at the default rating. Used as a starting point by Player.ratings_before()
+    created_ts = DateTimeField(default=datetime.datetime.now)
+    last_completed_ts = DateTimeField(null=False, index=True)
+    last_game_id = IntegerField(null=False)
+    game_count = IntegerField(null=False, unique=True)  # confirmed games included. Unique, so the same point in history is never snapshotted twice
+
+    def nearest(timestamp):
+        # Latest checkpoint that only includes games confirmed before timestamp
+        return RatingCheckpoint.select().where(
+            (RatingCheckpoint.last_completed_ts < timestamp)
+        ).order_by(RatingCheckpoint.last_completed_ts.desc(), RatingCheckpoint.last_game_id.desc()).first()
+
+    def latest():
+        return RatingCheckpoint.select().order_by(RatingCheckpoint.last_completed_ts.desc(), RatingCheckpoint.last_game_id.desc()).first()
+
+    def after_cursor(self):
+        # Expression matching games confirmed after this checkpoint
+        return ((Game.completed_ts > self.last_completed_ts) | ((Game.completed_ts == self.last_completed_ts) & (Game.id > self.last_game_id)))
+
+    def ratings(self, players=None):
+        query = RatingCheckpointEntry.select(RatingCheckpointEntry.player, RatingCheckpointEntry.elo, RatingCheckpointEntry.elo_max).where(
+            (RatingCheckpointEntry.checkpoint == self)
+        )
+        if players is not None:
+            query = query.where(RatingCheckpointEntry.player.in_(list(players)))
+        return {p_id: (elo, elo_max) for p_id, elo, elo_max in query.tuples()}
+
+    def _insert(last_game_id, last_completed_ts, game_count):
+        # Returns the new checkpoint's ID, or None if one already exists for game_count
+        return RatingCheckpoint.insert(
+            last_game_id=last_game_id, last_completed_ts=last_completed_ts, game_count=game_count
+        ).on_conflict_ignore().execute()
+
+    def create_from_ratings(ratings, last_game_id, last_completed_ts, game_count):
+        # ratings is a list of (player_id, elo, elo_max) as of the given game, which was the game_count'th confirmed game
+        with db.atomic():
+            checkpoint_id = RatingCheckpoint._insert(last_game_id, last_completed_ts, game_count)
+            if not checkpoint_id:
+                return None
+            rows = [(checkpoint_id, p_id, elo, elo_max) for p_id, elo, elo_max in ratings]
+            fields = [RatingCheckpointEntry.checkpoint, RatingCheckpointEntry.player, RatingCheckpointEntry.elo, RatingCheckpointEntry.elo_max]
+            for batch in chunked(rows, 5000):
+                RatingCheckpointEntry.insert_many(batch, fields=fields).execute()
+        return checkpoint_id
+
+    def create_from_players(last_game=None):
+        # Snapshot the current Player ratings, which reflect every confirmed game. last_game is the most recently confirmed game if the
+        # caller already has it, ie Game.confirm() calling from inside its transaction. Returns the new checkpoint's ID, or None
+        with db.atomic():
+            if last_game is None:
+                last_game = Game.select(Game.id, Game.completed_ts).where(
+                    (Game.is_confirmed == 1)
+                ).order_by(Game.completed_ts.desc(), Game.id.desc()).first()
+                if not last_game:
+                    return None
+
+            game_count = Game.select().where(Game.is_confirmed == 1).count()
+            checkpoint_id = RatingCheckpoint._insert(last_game.id, last_game.completed_ts, game_count)
+            if not checkpoint_id:
+                logger.info(f'Rating checkpoint at {game_count} games already exists')
+                return None
+            snapshot = Player.select(Value(checkpoint_id), Player.id, Player.elo, Player.elo_max).where(
+                (Player.elo != elo_engine.DEFAULT_ELO) | (Player.elo_max != elo_engine.DEFAULT_ELO)
+            )
+            RatingCheckpointEntry.insert_from(snapshot, fields=[RatingCheckpointEntry.checkpoint, RatingCheckpointEntry.player, RatingCheckpointEntry.elo, RatingCheckpointEntry.elo_max]).execute()
+        logger.info(f'Created rating checkpoint {checkpoint_id} at game {last_game.id}')
+        return checkpoint_id
+
+    def create_if_due(last_game):
+        # Called from inside Game.confirm()'s transaction once last_game is written, so a checkpoint is committed (or rolled back)
+        # together with the game that triggered it. Whether one is due is decided by checkpoint_schedule without querying
+        if not checkpoint_schedule.game_confirmed():
+            return None
+        checkpoint_id = RatingCheckpoint.create_from_players(last_game=last_game)
+        checkpoint_schedule.reset()
+        return checkpoint_id
+
+    def invalidate_since(timestamp):
+        # Remove checkpoints that include games confirmed at or after timestamp, ie before those games are recalculated
+        return RatingCheckpoint.delete().where(RatingCheckpoint.last_completed_ts >= timestamp).execute()
+
+
+class RatingCheckpointEntry(BaseModel):
+    checkpoint = ForeignKeyField(RatingCheckpoint, null=False, backref='entries', on_delete='CASCADE')
+    player = ForeignKeyField(Player, null=False, on_delete='CASCADE')
+    elo = SmallIntegerField(null=False)
+    elo_max = SmallIntegerField(null=False)
+
+    class Meta:
+        indexes = ((('checkpoint', 'player'), True),)
+
+
+class CheckpointSchedule:
+    # Counts games confirmed since the latest RatingCheckpoint in memory, so Game.confirm() can decide whether a checkpoint is due
+    # without querying. Loaded from the database on first use. Anything that adds or removes checkpoints or confirmed games other
+    # than Game.confirm(), or rolls back after game_confirmed() was called, calls invalidate() so the next check reloads
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.games_since = 0
+        self.last_created_ts = None  # None if there are no checkpoints
+
+    def _load(self):
+        latest = RatingCheckpoint.latest()
+        if latest:
+            self.games_since = Game.select().where((Game.is_confirmed == 1) & latest.after_cursor()).count()
+            self.last_created_ts = latest.created_ts
+        else:
+            self.games_since, self.last_created_ts = 0, None
+        self.loaded = True
+
+    def game_confirmed(self):
+        # Count one more confirmed game. Returns True if a checkpoint is now due
+        with self._lock:
+            if not self.loaded:
+                self._load()
+            self.games_since += 1
+            if self.last_created_ts is None:
+                return True
+            return (self.games_since >= settings.checkpoint_interval_games or
+                    datetime.datetime.now() - self.last_created_ts >= settings.checkpoint_interval_time)
+
+    def reset(self):
+        # A checkpoint including every confirmed game was just written
+        with self._lock:
+            self.games_since, self.last_created_ts, self.loaded = 0, datetime.datetime.now(), True
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded = False
+
+
+checkpoint_schedule = CheckpointSchedule()
+
+
+class PendingConfirmation(BaseModel):
+    # A claimed game waiting for the loser to react to the claim message. Used by modules/confirmations.py to resume
+    # confirmations after a restart. A row is removed when the game is confirmed, rejected or deleted
+    game = ForeignKeyField(Game, null=False, unique=True, backref='pending_confirmation', on_delete='CASCADE')
+    guild_id = BitField(null=False)
+    channel_id = BitField(null=False)
+    message_id = BitField(unique=True, null=False)
+    loser_discord_id = BitField(null=False)
+    expires_ts = DateTimeField(null=False, index=True)
+
+    def claim(game_id, reject: bool = False):
+        # Remove the pending confirmation for game_id. Returns True if this call removed it, so that a reaction and the
+        # auto-confirm timer (or two bot processes) can't both act on the same claim.
+        # With reject=True the game is marked as rejected in the same transaction, so it is left for staff and never auto-confirmed
+        with db.atomic():
+            claimed = PendingConfirmation.delete().where(PendingConfirmation.game == game_id).execute() > 0
+            if claimed and reject:
+                Game.update(rejected_ts=datetime.datetime.now()).where((Game.id == game_id) & (Game.is_confirmed == 0)).execute()
+        return claimed
+
+
+def write_replay_result(result, batch_size=5000):
+    # Write the output of elo_engine.replay_games() to Player, Game and PlayerGame with a handful of UPDATE ... FROM (VALUES ...) statements.
+    # Should be called inside a transaction
+
+    start = timer()
+    for batch in chunked(result.player_ratings(), batch_size):
+        values = ValuesList(batch, columns=('id', 'elo', 'elo_max'), alias='v')
+        Player.update(elo=values.c.elo, elo_max=values.c.elo_max).from_(values).where(Player.id == values.c.id).execute()
+
+    for batch in chunked(result.game_changes(), batch_size):
+        values = ValuesList(batch, columns=('id', 'winner', 'loser'), alias='v')
+        Game.update(elo_change_winner=values.c.winner, elo_change_loser=values.c.loser).from_(values).where(Game.id == values.c.id).execute()
+
+    for batch in chunked(result.playergame_elos(), batch_size):
+        values = ValuesList(batch, columns=('game_id', 'player_id', 'elo'), alias='v')
+        PlayerGame.update(elo_after_game=values.c.elo).from_(values).where(
+            (PlayerGame.game == values.c.game_id) & (PlayerGame.player == values.c.player_id)
+        ).execute()
+
+    result.timings['write'] = timer() - start
@@ -0,0 +1,260 @@
+import bisect
+import collections
+import threading
+import logging
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+
+def normalize(name: str):
+    return name.casefold() if name else ''
+
+
+class NameIndex:
+    # In-memory index of names for case-insensitive exact, prefix and substring lookups without scanning every name.
+    # Each key (ie a player or member ID) can have several names, such as a nickname and a username.
+    # Substring lookups intersect n-gram posting sets, so their cost depends on the number of matches rather than the number of names.
+    # Subclasses that never call prefix() set track_prefixes = False to skip maintaining the sorted name list.
+
+    track_prefixes = True
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._names = {}  # key: tuple of normalized names
+            self._exact = collections.defaultdict(set)  # normalized name: keys
+            self._sorted = []  # sorted (normalized name, key) pairs for prefix lookups
+            self._grams = collections.defaultdict(set)  # 1, 2 and 3 character n-grams: keys
+            self._bulk = False  # set while loading, when _sorted is appended to and sorted once at the end
+            self.loaded = False
+
+    def _ngrams(self, name):
+        for size in (1, 2, 3):
+            for i in range(len(name) - size + 1):
+                yield name[i:i + size]
+
+    def add(self, key, *names):
+        # Index key under the given names, replacing any names it was previously indexed under
+        normalized = tuple(sorted(set(normalize(n) for n in names if n)))
+        with self._lock:
+            if self._names.get(key) == normalized:
+                return
+            self.remove(key)
+            self._names[key] = normalized
+            for name in normalized:
+                self._exact[name].add(key)
+                if self._bulk:
+                    self._sorted.append((name, key))
+                elif self.track_prefixes:
+                    bisect.insort(self._sorted, (name, key))
+                for gram in self._ngrams(name):
+                    self._grams[gram].add(key)
+
+    def remove(self, key):
+        with self._lock:
+            for name in self._names.pop(key, ()):
+                self._exact[name].discard(key)
+                if not self._exact[name]:
+                    del self._exact[name]
+                if self.track_prefixes:
+                    i = bisect.bisect_left(self._sorted, (name, key))
+                    if i < len(self._sorted) and self._sorted[i] == (name, key):
+                        del self._sorted[i]
+                for gram in self._ngrams(name):
+                    postings = self._grams.get(gram)
+                    if postings is not None:
+                        postings.discard(key)
+                        if not postings:
+                            del self._grams[gram]
+
+    def start_bulk_load(self):
+        # Call on an empty index before adding many keys, then finish_bulk_load(), so that loading n names takes O(n log n) rather than O(n²).
+        # Keys must not be removed or re-added in between
+        with self._lock:
+            self._bulk = self.track_prefixes
+
+    def finish_bulk_load(self):
+        with self._lock:
+            if self._bulk:
+                self._sorted.sort()
+                self._bulk = False
+
+    def exact(self, query: str):
+        with self._lock:
+            return set(self._exact.get(normalize(query), ()))
+
+    def prefix(self, query: str):
+        query = normalize(query)
+        matches = set()
+        with self._lock:
+            i = bisect.bisect_left(self._sorted, (query,))
+            while i < len(self._sorted) and self._sorted[i][0].startswith(query):
+                matches.add(self._sorted[i][1])
+                i += 1
+        return matches
+
+    def substring(self, query: str):
+        query = normalize(query)
+        if not query:
+            return set()
+        with self._lock:
+            if len(query) <= 3:
+                return set(self._grams.get(query, ()))
+
+            posting_sets = sorted((self._grams.get(query[i:i + 3], set()) for i in range(len(query) - 2)), key=len)
+            candidates = set(posting_sets[0])
+            for postings in posting_sets[1:]:
+                candidates &= postings
+                if not candidates:
+                    break
+            # n-grams can all be present without being contiguous, so confirm each candidate
+            return {key for key in candidates if any(query in name for name in self._names[key])}
+
+    def search(self, query: str):
+        # Returns (exact matches, prefix matches, substring matches) as disjoint sets of keys
+        exact = self.exact(query)
+        prefix = self.prefix(query) - exact
+        substring = self.substring(query) - exact - prefix
+        return exact, prefix, substring
+
+    def __contains__(self, key):
+        return key in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+
+class PlayerNameIndex(NameIndex):
+    # NameIndex of Player.name keyed by Player.id, which also tracks discord IDs and the number of games each player has,
+    # used to rank matches in Player.string_matches()
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self.discord_ids = {}  # discord_id: player_id
+            self.games_played = collections.Counter()
+
+    def load(self, rows):
+        # rows is an iterable of (player_id, discord_id, name, games_played)
+        with self._lock:
+            self.clear()
+            self.start_bulk_load()
+            for player_id, discord_id, name, games_played in rows:
+                self.add_player(player_id, discord_id, name, games_played)
+            self.finish_bulk_load()
+            self.loaded = True
+        logger.info(f'Player name index loaded with {len(self)} players')
+
+    def add_player(self, player_id, discord_id, name, games_played=None):
+        with self._lock:
+            self.add(player_id, name)
+            self.discord_ids[discord_id] = player_id
+            if games_played is not None:
+                self.games_played[player_id] = games_played
+
+    def add_games(self, player_ids, amount=1):
+        with self._lock:
+            for player_id in player_ids:
+                self.games_played[player_id] += amount
+
+
+player_name_index = PlayerNameIndex()
+
+
+class MemberNameIndex(NameIndex):
+    # NameIndex of a guild's members keyed by member ID, covering nickname and username. Also keeps an exact username map
+    # and each member's position in the guild so results come back in the same order as iterating guild.members
+
+    track_prefixes = False  # find() only does exact and substring lookups
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self.usernames = collections.defaultdict(set)  # normalized username: member IDs
+            self.member_usernames = {}
+            self.order = {}
+            self._next_position = 0
+
+    def add_member(self, member):
+        self.add_names(member.id, member.nick, member.name)
+
+    def add_names(self, member_id, nick, name):
+        with self._lock:
+            self.remove_member(member_id)
+            self.add(member_id, nick, name)
+            username = normalize(name)
+            self.usernames[username].add(member_id)
+            self.member_usernames[member_id] = username
+            if member_id not in self.order:
+                self.order[member_id] = self._next_position
+                self._next_position += 1
+
+    def remove_member(self, member_id, forget_position=False):
+        with self._lock:
+            self.remove(member_id)
+            username = self.member_usernames.pop(member_id, None)
+            if username is not None:
+                self.usernames[username].discard(member_id)
+                if not self.usernames[username]:
+                    del self.usernames[username]
+            if forget_position:
+                self.order.pop(member_id, None)
+
+    def find(self, query: str):
+        # Returns (member IDs whose username matches query exactly, member IDs with query in their nickname or username), each in guild order
+        with self._lock:
+            exact = self.usernames.get(normalize(query), set())
+            substring = self.substring(query) - exact
+            ordered = self.order.get
+            return sorted(exact, key=ordered), sorted(substring, key=ordered)
+
+
+member_name_indexes = {}  # guild_id: MemberNameIndex
+_pending_updates = {}  # guild_id: member changes received while that guild's index is being built, as (member, removed)
+
+
+def build_member_index(members):
+    # members is a list of (member_id, nick, name) in guild order. Safe to run off the event loop, as it doesn't touch discord objects
+    member_index = MemberNameIndex()
+    for member_id, nick, name in members:
+        member_index.add_names(member_id, nick, name)
+    member_index.loaded = True
+    return member_index
+
+
+async def index_guild(guild, loop):
+    # Build a fresh index of guild's members on a worker thread, then swap it in. Joins, leaves and renames that arrive during
+    # the build are queued and applied to the new index before it replaces the old one
+    members = [(m.id, m.nick, m.name) for m in guild.members]
+    _pending_updates[guild.id] = []
+    try:
+        member_index = await loop.run_in_executor(None, build_member_index, members)
+        for member, removed in _pending_updates[guild.id]:
+            if removed:
+                member_index.remove_member(member.id, forget_position=True)
+            else:
+                member_index.add_member(member)
+        member_name_indexes[guild.id] = member_index
+    finally:
+        del _pending_updates[guild.id]
+    logger.debug(f'Indexed {len(member_index)} members of guild {guild.id}')
+    return member_index
+
+
+def index_member(member):
+    if member.guild.id in _pending_updates:
+        _pending_updates[member.guild.id].append((member, False))
+    member_index = member_name_indexes.get(member.guild.id)
+    if member_index:
+        member_index.add_member(member)
+
+
+def unindex_member(member):
+    if member.guild.id in _pending_updates:
+        _pending_updates[member.guild.id].append((member, True))
+    member_index = member_name_indexes.get(member.guild.id)
+    if member_index:
+        member_index.remove_member(member.id, forget_position=True)
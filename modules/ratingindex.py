@@ -0,0 +1,146 @@
+import threading
+import logging
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+# ELO values are stored in SmallIntegerFields, so every possible value fits in a fixed-size tree
+ELO_OFFSET = 32768
+ELO_RANGE = 65536
+
+
+class _FenwickTree:
+    # Binary indexed tree counting how many players hold each ELO value. Supports O(log n) updates and
+    # O(log n) "how many players are above this ELO" queries.
+
+    def __init__(self):
+        self.counts = [0] * (ELO_RANGE + 1)
+        self.value_counts = [0] * ELO_RANGE  # players at each exact value, used to track distinct values for dense ranks
+        self.distinct = [0] * (ELO_RANGE + 1)
+        self.size = 0
+
+    def _add(self, tree, position, amount):
+        i = position + 1
+        while i <= ELO_RANGE:
+            tree[i] += amount
+            i += i & -i
+
+    def _prefix(self, tree, position):
+        # sum of entries from 0 to position inclusive
+        total, i = 0, position + 1
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, elo, amount=1):
+        position = elo + ELO_OFFSET
+        before = self.value_counts[position]
+        self.value_counts[position] += amount
+        self.size += amount
+        self._add(self.counts, position, amount)
+        if before == 0 and self.value_counts[position] > 0:
+            self._add(self.distinct, position, 1)
+        elif before > 0 and self.value_counts[position] == 0:
+            self._add(self.distinct, position, -1)
+
+    def count_above(self, elo):
+        return self.size - self._prefix(self.counts, elo + ELO_OFFSET)
+
+    def distinct_above(self, elo):
+        return self._prefix(self.distinct, ELO_RANGE - 1) - self._prefix(self.distinct, elo + ELO_OFFSET)
+
+
+class RatingIndex:
+    # In-memory order-statistics index of the players on the leaderboard, keyed by elo and by elo_max.
+    # Loaded with Player.rebuild_rating_index() and kept current by Player.refresh_rating_index() after confirmations and bans, and
+    # rebuilt after Game.delete_game() and recalculations
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._players = {}  # player_id: (elo, elo_max)
+        self._trees = {False: _FenwickTree(), True: _FenwickTree()}  # keyed by max_flag
+        self.date_cutoff = None
+        self.loaded = False
+
+    def load(self, rows, date_cutoff):
+        # rows is an iterable of (player_id, elo, elo_max) for every player currently on the leaderboard
+        with self._lock:
+            self._clear()
+            for player_id, elo, elo_max in rows:
+                self._insert(player_id, elo, elo_max)
+            self.date_cutoff = date_cutoff
+            self.loaded = True
+        logger.info(f'Rating index loaded with {len(self._players)} players')
+
+    def unload(self):
+        with self._lock:
+            self._clear()
+
+    def _insert(self, player_id, elo, elo_max):
+        self._players[player_id] = (elo, elo_max)
+        self._trees[False].add(elo)
+        self._trees[True].add(elo_max)
+
+    def _remove(self, player_id):
+        elo, elo_max = self._players.pop(player_id)
+        self._trees[False].add(elo, -1)
+        self._trees[True].add(elo_max, -1)
+
+    def update(self, player_id, elo, elo_max):
+        # insert player, or move them to their new ratings if already present
+        with self._lock:
+            if not self.loaded:
+                return
+            if player_id in self._players:
+                self._remove(player_id)
+            self._insert(player_id, elo, elo_max)
+
+    def refresh(self, player_ids, load):
+        # Re-read the given players with load(), a callable returning (player_id, elo, elo_max) for those still on the leaderboard, and
+        # apply the result. The read and the update happen under the lock, so when several threads refresh the same player after their
+        # commits the last update to land is always from the latest read
+        with self._lock:
+            if not self.loaded:
+                return
+            still_active = set()
+            for player_id, elo, elo_max in load():
+                self.update(player_id, elo, elo_max)
+                still_active.add(player_id)
+            for player_id in set(player_ids) - still_active:
+                self.discard(player_id)
+
+    def discard(self, player_id):
+        with self._lock:
+            if self.loaded and player_id in self._players:
+                self._remove(player_id)
+
+    def is_authoritative(self, date_cutoff):
+        # Player.leaderboard() falls back to listing every player when fewer than 10 are active, which the index does not track
+        return self.loaded and self.date_cutoff == date_cutoff and len(self._players) >= 10
+
+    def rank(self, player_id, max_flag: bool = False, dense: bool = False):
+        # Same semantics as RANK()/DENSE_RANK() in Player.leaderboard_ranks(). Returns None if player is not on the leaderboard
+        with self._lock:
+            try:
+                elo, elo_max = self._players[player_id]
+            except KeyError:
+                return None
+            tree = self._trees[max_flag]
+            value = elo_max if max_flag else elo
+            return (tree.distinct_above(value) if dense else tree.count_above(value)) + 1
+
+    def ratings(self):
+        with self._lock:
+            return dict(self._players)
+
+    def __contains__(self, player_id):
+        return player_id in self._players
+
+    def __len__(self):
+        return len(self._players)
+
+
+rating_index = RatingIndex()
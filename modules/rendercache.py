@@ -0,0 +1,105 @@
+import collections
+import logging
+import sys
+import threading
+
+import settings
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+
+def _size_of(value):
+    # Rough size in bytes of a cached value made of tuples, lists, dicts, strings and numbers
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(_size_of(v) for v in value)
+    elif isinstance(value, dict):
+        size += sum(_size_of(k) + _size_of(v) for k, v in value.items())
+    return size
+
+
+class RenderCache:
+    # LRU cache of rendered leaderboard pages and player card data, keyed by a global ratings version.
+    # Anything that changes ratings, records, names or leaderboard membership calls bump_version(), which makes every cached
+    # entry stale at once, so entries never have to be invalidated individually.
+    # Entries are evicted least-recently-used first once there are more than max_entries or they take more than max_bytes.
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key: (version, value, size)
+        self.version = 0
+        self.history_version = 0  # bumped only when past ratings are rewritten, see bump_version()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def bump_version(self, reason: str = None, rewrites_history: bool = False):
+        # rewrites_history=True for changes that alter ratings after past games, ie deleting a game or recalculating ELO. Caches of
+        # per-game history that are otherwise only keyed on a player's own games (graphs.history_cache) include history_version in their keys
+        with self._lock:
+            self.version += 1
+            if rewrites_history:
+                self.history_version += 1
+            self.invalidations += 1
+            self._entries.clear()
+            self.bytes = 0
+        logger.debug(f'Ratings version bumped to {self.version}' + (f' ({reason})' if reason else ''))
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self.version:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version: int = None):
+        # version is the ratings version the value was computed at. A value computed before a bump is discarded rather than cached
+        size = _size_of(value)
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if size > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (self.version, value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_compute(self, key, func):
+        # Synchronous, so call this from the database executor when func queries the database
+        version = self.version
+        value = self.get(key, default=self)
+        if value is self:
+            value = func()
+            self.put(key, value, version=version)
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'version': self.version,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+render_cache = RenderCache(max_entries=settings.render_cache_max_entries, max_bytes=settings.render_cache_max_bytes)
@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import logging
+
+import discord
+
+import settings
+from modules.models import Player
+from modules.dbexecutor import db_executor
+
+logger = logging.getLogger('spiesbot.' + __name__)
+
+
+def desired_holders():
+    # Discord IDs that should hold each rating role: {'champion_role_name': {...}, 'hero_role_name': {...}}
+    # The champion is whoever is ranked #1 on the leaderboard (several players if tied). Heroes are non-banned players who have reached settings.hero_role_elo
+    return {
+        'champion_role_name': Player.leaderboard_leaders(date_cutoff=settings.date_cutoff),
+        'hero_role_name': Player.heroes(min_elo=settings.hero_role_elo),
+    }
+
+
+class RoleSync:
+    # Keeps the champion and hero roles in each guild in line with the ratings.
+    # request_sync() marks a guild as dirty. The worker task then computes who should hold each role, diffs that against the
+    # members that actually hold it and queues only the changes. Queued changes are keyed by (guild, member, role), so repeated
+    # syncs before a change is applied collapse into one, and they are applied one at a time with a pause between API calls.
+    # A role is only added when a player newly qualifies for it, ie when a rating change takes them over the line since the guild's
+    # last sync, so a role that staff removed by hand is not added back. The reconcile every settings.role_sync_interval seconds
+    # therefore only removes roles: the champion role from anyone who isn't ranked #1, and the hero role from players who stopped
+    # qualifying for it (ie were banned). Heroes granted by hand are left alone. The first sync of a guild after startup only
+    # records who qualifies, since crossings that happened while the bot was offline can't be told apart from manual changes.
+
+    exclusive = {'champion_role_name'}  # roles removed from everyone who doesn't qualify, not only from players who stopped qualifying
+
+    def __init__(self, bot, reconcile_interval: int, min_interval: float):
+        self.bot = bot
+        self.reconcile_interval = reconcile_interval
+        self.min_interval = min_interval
+        self._dirty = set()  # guild IDs waiting to be diffed
+        self._pending = collections.OrderedDict()  # (guild_id, member_id, role_id): True to add the role, False to remove it
+        self._qualified = {}  # guild_id: {setting name: discord IDs that qualified for the role at the guild's last sync}
+        self._wake = asyncio.Event()
+        self._tasks = []
+        self.stats = collections.Counter()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [self.bot.loop.create_task(self._run()), self.bot.loop.create_task(self._reconcile())]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def request_sync(self, guild_id: int = None):
+        # Queue a sync of guild_id, or of every guild if None. Returns straight away
+        if guild_id is None:
+            self._dirty.update(g.id for g in self.bot.guilds)
+        else:
+            self._dirty.add(guild_id)
+        self._wake.set()
+
+    def queue_length(self):
+        return len(self._pending)
+
+    async def _reconcile(self):
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            self.request_sync()
+            await asyncio.sleep(self.reconcile_interval)
+
+    async def _run(self):
+        while True:
+            if not self._dirty and not self._pending:
+                await self._wake.wait()
+            self._wake.clear()
+
+            if self._dirty:
+                # holders are the same for every guild, so one query serves all the guilds dirtied since the last round
+                try:
+                    holders = await db_executor.run(desired_holders)
+                except Exception:
+                    logger.exception('Could not load rating role holders')
+                    await asyncio.sleep(self.reconcile_interval)
+                    continue
+                while self._dirty:
+                    guild = self.bot.get_guild(self._dirty.pop())
+                    if guild:
+                        self._diff_guild(guild, holders)
+
+            if self._pending:
+                key, add = self._pending.popitem(last=False)
+                delay = await self._apply(key, add)
+                await asyncio.sleep(max(delay, self.min_interval))
+
+    def _diff_guild(self, guild, holders):
+        # Queue the changes needed to bring guild in line with holders. Queued removals are recomputed from scratch. Queued additions
+        # are kept while their player still qualifies, since the crossing that queued them has already been recorded
+        for key in [k for k, add in self._pending.items() if k[0] == guild.id and not add]:
+            del self._pending[key]
+
+        previous = self._qualified.get(guild.id)
+        for setting_name, discord_ids in holders.items():
+            role = discord.utils.get(guild.roles, name=settings.guild_setting(guild.id, setting_name))
+            if not role:
+                continue
+            actual = {m.id for m in role.members}
+            desired = {d for d in discord_ids if guild.get_member(d)}
+            qualified_before = previous[setting_name] if previous else desired
+
+            for key in [k for k, add in self._pending.items() if add and k[0] == guild.id and k[2] == role.id and k[1] not in desired]:
+                del self._pending[key]
+            for discord_id in (desired - qualified_before) - actual:
+                self._pending[(guild.id, discord_id, role.id)] = True
+            if setting_name in self.exclusive:
+                lapsed = actual - desired
+            else:
+                lapsed = actual & (qualified_before - desired)
+            for discord_id in lapsed:
+                self._pending[(guild.id, discord_id, role.id)] = False
+
+        self._qualified[guild.id] = {setting_name: set(discord_ids) for setting_name, discord_ids in holders.items()}
+        changes = sum(1 for k in self._pending if k[0] == guild.id)
+        if changes:
+            logger.info(f'Role sync queued {changes} role changes in guild {guild.id}')
+        self.stats['syncs'] += 1
+
+    async def _apply(self, key, add: bool):
+        # Apply one queued change if it is still needed. Returns how long to wait before the next API call
+        guild_id, member_id, role_id = key
+        guild = self.bot.get_guild(guild_id)
+        member = guild.get_member(member_id) if guild else None
+        role = guild.get_role(role_id) if guild else None
+        if not member or not role or (role in member.roles) == add:
+            self.stats['skipped'] += 1
+            return 0
+
+        try:
+            if add:
+                await member.add_roles(role, reason='Rating role sync')
+            else:
+                await member.remove_roles(role, reason='Rating role sync')
+        except discord.Forbidden as e:
+            logger.warn(f'Missing permission to {"add" if add else "remove"} role {role.name} for {member.display_name}: {e}')
+            self.stats['failed'] += 1
+        except discord.HTTPException as e:
+            if e.status == 429:
+                # discord.py retries rate limited requests itself, so getting here means the limit is persistent. Requeue and back off
+                self._pending.setdefault(key, add)
+                self.stats['rate_limited'] += 1
+                retry_after = getattr(e, 'retry_after', None) or 30
+                logger.warn(f'Rate limited applying role changes, retrying in {retry_after}s')
+                return retry_after
+            logger.warn(f'Could not {"add" if add else "remove"} role {role.name} for {member.display_name}: {e}')
+            self.stats['failed'] += 1
+        else:
+            logger.info(f'{"Added" if add else "Removed"} role {role.name} {"to" if add else "from"} {member.display_name}')
+            self.stats['applied'] += 1
+        return 0
@@ -1,9 +1,12 @@
+import abc
 import discord
 from discord.ext import commands
 import logging
 import asyncio
+import contextlib
 import re
 import modules.models as models
+import modules.nameindex as nameindex
 
 logger = logging.getLogger('spiesbot.' + __name__)
 
@@ -17,6 +20,18 @@ def connect():
         return False
 
 
+@contextlib.contextmanager
+def connection():
+    # Check out a pooled connection for the current thread, and return it to the pool when done.
+    # Nested uses on the same thread share the outer connection, which is only released by the outermost block.
+    opened = connect()
+    try:
+        yield models.db
+    finally:
+        if opened:
+            models.db.close()
+
+
 def escape_role_mentions(input: str):
     # like escape_mentions but allow user mentions. disallows everyone/here/role
 
@@ -29,46 +44,79 @@ def escape_everyone_here_roles(input: str):
     return re.sub(r'@(everyone|here)', '@\u200b\\1', str(input))
 
 
-async def wait_for_confirmation(bot, ctx, game, losing_member, message):
+async def buffered_send(destination, content: str, max_length: int = 2000):
+    # Send content in as many messages as needed to stay under Discord's message length limit, splitting on line breaks
 
-    await message.add_reaction('✅')
-    await message.add_reaction('❌')
+    chunk = ''
+    for line in content.split('\n'):
+        line = line[:max_length]
+        if chunk and len(chunk) + len(line) + 1 > max_length:
+            await destination.send(chunk)
+            chunk = ''
+        chunk = f'{chunk}\n{line}' if chunk else line
+    if chunk:
+        await destination.send(chunk)
 
-    def check(reaction, user):
-        e = str(reaction.emoji)
-        return ((user == losing_member) and (reaction.message.id == message.id) and e.startswith(('✅', '❌')))
 
-    try:
-        reaction, user = await bot.wait_for('reaction_add', timeout=600.0, check=check)
-    except asyncio.TimeoutError:
-        await message.remove_reaction('❌', bot.user)
-        await message.remove_reaction('✅', bot.user)
-        await ctx.send('No reaction detected in time. This game will be automatically confirmed. If the game should not be confirmed please contact your opponent or server staff.')
-        return True
+class PageProvider(abc.ABC):
+    # Supplies paginate() with pages of (embed field name, value) tuples on demand, so that a long list doesn't have to be built
+    # before the first page can be shown. Subclasses set total and page_size and implement get_page()
+
+    page_size = 10
+    total = 0  # number of entries across all pages
+
+    def page_count(self):
+        return max(1, -(-self.total // self.page_size))
+
+    @abc.abstractmethod
+    async def get_page(self, page: int):
+        # Entries on page (counting from 0)
+        pass
 
-    else:
-        await message.remove_reaction('✅', bot.user)
-        await message.remove_reaction('❌', bot.user)
 
-        if '✅' in str(reaction.emoji):
-            return True
-        elif '❌' in str(reaction.emoji):
-            return False
+class ListPageProvider(PageProvider):
 
+    def __init__(self, message_list, page_size: int = 10):
+        self.message_list = message_list
+        self.page_size = page_size
+        self.total = len(message_list)
 
-async def paginate(bot, ctx, title, message_list, page_start=0, page_end=10, page_size=10):
+    async def get_page(self, page: int):
+        return self.message_list[page * self.page_size:(page + 1) * self.page_size]
+
+
+async def paginate(bot, ctx, title, message_list=None, page_start=0, page_end=None, page_size=10, provider: PageProvider = None):
     # Allows user to page through a long list of messages with reactions
     # message_list should be a [(List of, two-item tuples)]. Each tuple will be split into an embed field name/value
-
-    page_end = page_end if len(message_list) > page_end else len(message_list)
+    # message_list[page_start:page_end] is shown first (page_end defaults to page_start + page_size), then each page holds page_size entries
+    # Alternatively pass a PageProvider as provider, which is asked for each page as it is shown. page_size is then taken from the provider
+
+    first_range = None
+    if provider is None:
+        provider = ListPageProvider(message_list, page_size=page_size)
+        page_end = page_end if page_end is not None else page_start + page_size
+        if page_start % page_size or page_end != page_start + page_size:
+            # first range doesn't line up with a page
+            first_range = (page_start, min(page_end, len(message_list)))
+    page_size = provider.page_size
+    page = page_start // page_size
 
     first_loop = True
     while True:
+        last_page = provider.page_count() - 1
+        page = max(0, min(page, last_page))
+        if first_loop and first_range:
+            page_start = first_range[0]
+            entries = message_list[first_range[0]:first_range[1]]
+        else:
+            page_start = page * page_size
+            entries = await provider.get_page(page)
+
         embed = discord.Embed(title=title)
-        for entry in range(page_start, page_end):
-            embed.add_field(name=message_list[entry][0], value=message_list[entry][1], inline=False)
-        if page_size < len(message_list):
-            embed.set_footer(text=f'{page_start + 1} - {page_end} of {len(message_list)}')
+        for name, value in entries:
+            embed.add_field(name=name, value=value, inline=False)
+        if page_size < provider.total:
+            embed.set_footer(text=f'{page_start + 1} - {page_start + len(entries)} of {provider.total}')
 
         if first_loop is True:
             sent_message = await ctx.send(embed=embed)
@@ -79,17 +127,17 @@ async def paginate(bot, ctx, title, message_list, page_start=0, page_end=10, pag
                 logger.warn('Unable to clear message reaction due to insufficient permissions. Giving bot \'Manage Messages\' permission will improve usability.')
             await sent_message.edit(embed=embed)
 
-        if page_start > 0:
+        if page > 0:
             await sent_message.add_reaction('⏪')
             await sent_message.add_reaction('⬅')
-        if page_end < len(message_list):
+        if page < last_page:
             await sent_message.add_reaction('➡')
             await sent_message.add_reaction('⏩')
 
         def check(reaction, user):
             e = str(reaction.emoji)
 
-            if page_size < len(message_list):
+            if page_size < provider.total:
                 compare = e.startswith(('⏪', '⏩', '➡', '⬅'))
             else:
                 compare = False
@@ -108,31 +156,19 @@ async def paginate(bot, ctx, title, message_list, page_start=0, page_end=10, pag
 
             if '⏪' in str(reaction.emoji):
                 # all the way to beginning
-                page_start = 0
-                page_end = page_start + page_size
+                page = 0
 
             if '⏩' in str(reaction.emoji):
                 # last page
-                page_end = len(message_list)
-                page_start = page_end - page_size
+                page = last_page
 
             if '➡' in str(reaction.emoji):
                 # next page
-                page_start = page_start + page_size
-                page_end = page_start + page_size
+                page = page + 1
 
             if '⬅' in str(reaction.emoji):
                 # previous page
-                page_start = page_start - page_size
-                page_end = page_start + page_size
-
-            if page_start < 0:
-                page_start = 0
-                page_end = page_start + page_size
-
-            if page_end > len(message_list):
-                page_end = len(message_list)
-                page_start = page_end - page_size if (page_end - page_size) >= 0 else 0
+                page = page - 1
 
             first_loop = False
 
@@ -150,6 +186,14 @@ async def get_guild_member(ctx, input):
         pass
         # No matches in standard MemberConverter. Move on to a case-insensitive search.
         input = input.strip('@')  # Attempt to handle fake @Mentions that sometimes slip through
+
+        member_index = nameindex.member_name_indexes.get(ctx.guild.id)
+        if member_index and member_index.loaded:
+            exact_ids, substring_ids = member_index.find(input)
+            guild_matches = [m for m in map(ctx.guild.get_member, exact_ids) if m]
+            substring_matches = [m for m in map(ctx.guild.get_member, substring_ids) if m]
+            return guild_matches + substring_matches
+
         for p in ctx.guild.members:
             name_str = p.nick.upper() + p.name.upper() if p.nick else p.name.upper()
             if p.name.upper() == input.upper():
@@ -4,6 +4,8 @@ import datetime
 from discord.ext import commands
 # import discord
 import configparser
+import dataclasses
+import types
 logger = logging.getLogger('spiesbot.' + __name__)
 
 config = configparser.ConfigParser()
@@ -19,10 +21,31 @@ except KeyError:
 
 pastebin_key = config['DEFAULT'].get('pastebin_key', None)
 
+# Database connection pool. Should be at least db_executor_workers + 2 (the serialized rating thread and the event loop) so the executor threads never wait on a connection
+db_pool_size = int(config['DEFAULT'].get('db_pool_size', 8))
+db_pool_stale_timeout = int(config['DEFAULT'].get('db_pool_stale_timeout', 300))  # seconds before an idle connection is recycled
+db_pool_timeout = int(config['DEFAULT'].get('db_pool_timeout', 10))  # seconds to wait for a free connection before raising an error
+
 server_ids = {'test': 478571892832206869}
 owner_id = 272510639124250625  # Nelluk
 bot = None
 run_tasks = True  # if set as False via command line option, tasks should check this and skip
+db_executor_workers = 4  # threads in the pool that runs all database queries, see modules/dbexecutor.py
+confirmation_timeout = 600  # seconds a claimed game waits for the loser to react before it is confirmed automatically
+stale_game_age = datetime.timedelta(hours=24)  # unconfirmed games older than this, that aren't waiting on a reaction, are confirmed automatically
+stale_game_sweep_interval = 600  # seconds between sweeps for stale games
+hero_role_elo = 1201  # players whose ELO has reached this get the hero_role_name role
+role_sync_interval = 3600  # seconds between full reconciles of the champion and hero roles, see modules/rolesync.py
+role_sync_min_interval = 1.0  # minimum seconds between role changes sent to Discord
+log_queue_size = 10000  # log records waiting to be written before new ones are dropped, see modules/logqueue.py
+sql_log_rate, sql_log_burst = 50, 500  # peewee SQL log records allowed per second on average / in a burst
+elo_event_log_dir = 'logs/elo_events'  # append-only log of every rating change, see modules/eventstore.py. Never rotated
+elo_event_segment_bytes = 16 * 1024 * 1024
+history_graph_points = 300  # rating history graphs are downsampled to at most this many points, see modules/graphs.py
+history_cache_max_entries = 200
+history_cache_max_bytes = 16 * 1024 * 1024
+render_cache_max_entries = 1000  # leaderboard pages and player cards kept between rating changes, see modules/rendercache.py
+render_cache_max_bytes = 8 * 1024 * 1024
 
 # bot invite URL https://discordapp.com/oauth2/authorize?client_id=703986191254683728&scope=bot
 # dev bot URL https://discordapp.com/oauth2/authorize?client_id=704776406323953765&scope=bot
@@ -40,7 +63,7 @@ config = {'default':
                       'bot_channels_private': [],  # channels here will pass any bot channel check, and not linked in bot messages
                       'bot_channels_strict': [],  # channels where the most limited commands work, like leaderboards
                       'bot_channels': [],  # channels were more common commands work, like matchmaking
-                      'game_announce_channel': None,
+                      'game_announce_channel': None,  # where automatic confirmations are announced. Falls back to the first bot channel
                       'hero_role_name': 'ELO Hero',
                       'champion_role_name': 'Ranked #1'},
             478571892832206869:  # Test server
@@ -51,6 +74,159 @@ config = {'default':
 
 
 date_cutoff = datetime.datetime.today() - datetime.timedelta(days=90)  # Players who haven't played since cutoff are not included in leaderboards
+checkpoint_interval_games = 500  # A snapshot of all ratings is saved after this many confirmed games...
+checkpoint_interval_time = datetime.timedelta(days=7)  # ...or after this much time, whichever comes first
+
+
+@dataclasses.dataclass(frozen=True)
+class GuildSettings:
+    # Immutable snapshot of one guild's settings with the defaults merged in, built by compile_guild_settings().
+    # Channel and role lists are precomputed as frozensets so the checks that run on every message and command are set lookups
+    guild_id: int
+    values: types.MappingProxyType  # every setting name: value, as guild_setting() would return it
+    command_prefix: str
+    bot_channels: frozenset  # None if the guild has no channel restriction
+    bot_channels_allowed: frozenset  # bot_channels plus bot_channels_private
+    bot_channel_list: tuple  # bot_channels in their configured order, for telling users where to go
+    strict_channels: frozenset  # bot_channels_strict, falling back to bot_channels. None if neither restricts
+    strict_channels_allowed: frozenset
+    strict_channel_list: tuple
+    mod_roles: frozenset
+    staff_roles: frozenset  # helper_roles plus mod_roles
+    level_roles: tuple  # ((4, frozenset of role names), (3, ...), (2, ...), (1, ...))
+
+    def __getitem__(self, setting_name):
+        return self.values[setting_name]
+
+
+def _compile_guild(guild_id, overrides):
+    values = dict(config['default'])
+    values.update(overrides)
+    private = frozenset(values['bot_channels_private'] or ())
+
+    bot_channels = values['bot_channels']
+    strict_channels = values['bot_channels_strict'] if values['bot_channels_strict'] is not None else bot_channels
+
+    return GuildSettings(
+        guild_id=guild_id,
+        values=types.MappingProxyType(values),
+        command_prefix=values['command_prefix'],
+        bot_channels=frozenset(bot_channels) if bot_channels is not None else None,
+        bot_channels_allowed=frozenset(bot_channels or ()) | private,
+        bot_channel_list=tuple(bot_channels or ()),
+        strict_channels=frozenset(strict_channels) if strict_channels is not None else None,
+        strict_channels_allowed=frozenset(strict_channels or ()) | private,
+        strict_channel_list=tuple(strict_channels or ()),
+        mod_roles=frozenset(values['mod_roles']),
+        staff_roles=frozenset(values['helper_roles']) | frozenset(values['mod_roles']),
+        level_roles=tuple((level, frozenset(values[f'user_roles_level_{level}'])) for level in (4, 3, 2, 1)),
+    )
+
+
+compiled_config = {}  # guild_id ('default' for the default block): GuildSettings
+_prefix_cache = {}  # (guild_id, bot user id): prefix list for get_prefix()
+
+
+def compile_guild_settings():
+    # Build the GuildSettings snapshots from config. Runs at import - call it again after changing config
+    global compiled_config
+    compiled_config = {guild_id: _compile_guild(guild_id, overrides) for guild_id, overrides in config.items()}
+    _prefix_cache.clear()
+    member_permissions.clear()
+
+
+def guild_settings(guild_id: int):
+    # GuildSettings for guild_id, or the default block if guild_id is None. None if the guild is not in config
+    return compiled_config.get(guild_id if guild_id else 'default')
+
+
+def announcement_channel_ids(guild_id: int):
+    # Channel IDs to post announcements that aren't replies to a command in, best first: game_announce_channel, then the guild's
+    # bot channels, then its strict bot channels. Empty if the guild is not in config or has none of them
+    snapshot = compiled_config.get(guild_id)
+    if not snapshot:
+        return []
+    channel_ids = [snapshot['game_announce_channel']] if snapshot['game_announce_channel'] else []
+    return channel_ids + [c for c in snapshot.bot_channel_list + snapshot.strict_channel_list if c not in channel_ids]
+
+
+def guild_prefixes(bot, guild_id: int):
+    # Same list as commands.when_mentioned_or(prefix)(bot, message), built once per guild. None if the guild is not in config
+    key = (guild_id, bot.user.id)
+    prefixes = _prefix_cache.get(key)
+    if prefixes is None:
+        snapshot = compiled_config.get(guild_id)
+        if not snapshot:
+            return None
+        prefixes = _prefix_cache[key] = [f'<@{bot.user.id}> ', f'<@!{bot.user.id}> ', snapshot.command_prefix]
+    return prefixes
+
+
+class PermissionCache:
+    # Resolved permissions of each member, as {guild_id: {member_id: (user level, is staff, is mod)}}, so the checks that run for
+    # every command (and for every command when building help) are a dict lookup. Entries only reflect the member's roles - the
+    # owner overrides are applied by the callers. Games.on_member_update / on_member_remove drop a member's entry, and guild
+    # role create/update/delete events drop the whole guild, since a renamed role can change everyone's level
+
+    def __init__(self):
+        self._guilds = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, guild_id: int, member):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = {}
+        entry = guild.get(member.id)
+        if entry is None:
+            self.misses += 1
+            entry = guild[member.id] = self._resolve(guild_settings(guild_id), member)
+        else:
+            self.hits += 1
+        return entry
+
+    def _resolve(self, snapshot, member):
+        role_names = {x.name for x in member.roles}
+        mod = not role_names.isdisjoint(snapshot.mod_roles)
+        staff = not role_names.isdisjoint(snapshot.staff_roles)
+        if mod:
+            return 6, staff, mod
+        if staff:
+            return 5, staff, mod
+        for level, level_roles in snapshot.level_roles:
+            # 4: advanced matchmaking abilities (leave own match, join others to match). can use settribes in bulk
+            # 3: host/join any. 2: join ranked games up to 6p, unranked up to 12p. 1: join ranked games up to 3p, unranked up to 6p. no hosting
+            if not role_names.isdisjoint(level_roles):
+                return level, staff, mod
+        return 0, staff, mod
+
+    def invalidate_member(self, guild_id: int, member_id: int):
+        if self._guilds.get(guild_id, {}).pop(member_id, None):
+            self.invalidations += 1
+
+    def invalidate_guild(self, guild_id: int):
+        if self._guilds.pop(guild_id, None):
+            self.invalidations += 1
+
+    def clear(self):
+        if self._guilds:
+            self._guilds.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'guilds': len(self._guilds),
+            'members': sum(len(g) for g in self._guilds.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+
+member_permissions = PermissionCache()
 
 
 def get_setting(setting_name):
@@ -60,21 +236,11 @@ def get_setting(setting_name):
 def guild_setting(guild_id: int, setting_name: str):
     # if guild_id = None, default block will be used
 
-    if guild_id:
-
-        try:
-            settings_obj = config[guild_id]
-        except KeyError:
-            logger.error(f'Unauthorized guild id {guild_id}.')
-            # raise exceptions.CheckFailedError('Unauthorized: This guild is not in the config.ini file.')
-
-        try:
-            return settings_obj[setting_name]
-        except KeyError:
-            return config['default'][setting_name]
-
-    else:
-        return config['default'][setting_name]
+    snapshot = compiled_config.get(guild_id if guild_id else 'default')
+    if snapshot is None:
+        logger.error(f'Unauthorized guild id {guild_id}.')
+        snapshot = compiled_config['default']
+    return snapshot[setting_name]
 
 
 def get_matching_roles(discord_member, list_of_role_names):
@@ -88,19 +254,9 @@ def get_user_level(ctx, user=None):
 
     if user.id == owner_id:
         return 7
-    if is_mod(ctx, user=user):
-        return 6
-    if is_staff(ctx, user=user):
-        return 5
-    if get_matching_roles(user, guild_setting(ctx.guild.id, 'user_roles_level_4')):
-        return 4  # advanced matchmaking abilities (leave own match, join others to match). can use settribes in bulk
-    if get_matching_roles(user, guild_setting(ctx.guild.id, 'user_roles_level_3')):
-        return 3  # host/join any
-    if get_matching_roles(user, guild_setting(ctx.guild.id, 'user_roles_level_2')):
-        return 2  # join ranked games up to 6p, unranked up to 12p
-    if get_matching_roles(user, guild_setting(ctx.guild.id, 'user_roles_level_1')):
-        return 1  # join ranked games up to 3p, unranked up to 6p. no hosting
-    return 0
+    if ctx.author.id == owner_id:
+        return 6  # is_mod() is always True when the owner invokes, whoever user is
+    return member_permissions.get(ctx.guild.id, user)[0]
 
 
 def is_staff(ctx, user=None):
@@ -108,11 +264,7 @@ def is_staff(ctx, user=None):
 
     if user.id == owner_id:
         return True
-    helper_roles = guild_setting(ctx.guild.id, 'helper_roles')
-    mod_roles = guild_setting(ctx.guild.id, 'mod_roles')
-
-    target_match = get_matching_roles(user, helper_roles + mod_roles)
-    return len(target_match) > 0
+    return member_permissions.get(ctx.guild.id, user)[1]
 
 
 def is_mod(ctx, user=None):
@@ -120,10 +272,7 @@ def is_mod(ctx, user=None):
 
     if ctx.author.id == owner_id:
         return True
-    mod_roles = guild_setting(ctx.guild.id, 'mod_roles')
-
-    target_match = get_matching_roles(user, mod_roles)
-    return len(target_match) > 0
+    return member_permissions.get(ctx.guild.id, user)[2]
 
 
 def is_staff_check():
@@ -144,18 +293,19 @@ def is_mod_check():
 
 def in_bot_channel():
     async def predicate(ctx):
-        if guild_setting(ctx.guild.id, 'bot_channels') is None:
+        snapshot = guild_settings(ctx.guild.id)
+        if snapshot.bot_channels is None:
             return True
         if is_mod(ctx):
             return True
-        if ctx.message.channel.id in guild_setting(ctx.guild.id, 'bot_channels') + guild_setting(ctx.guild.id, 'bot_channels_private'):
+        if ctx.message.channel.id in snapshot.bot_channels_allowed:
             return True
         else:
             if ctx.invoked_with == 'help' and ctx.command.name != 'help':
                 # Silently fail check when help cycles through every bot command for a check.
                 pass
             else:
-                channel_tags = [f'<#{chan_id}>' for chan_id in guild_setting(ctx.guild.id, 'bot_channels')]
+                channel_tags = [f'<#{chan_id}>' for chan_id in snapshot.bot_channel_list]
                 await ctx.send(f'This command can only be used in a designated ELO bot channel. Try: {" ".join(channel_tags)}')
             return False
     return commands.check(predicate)
@@ -163,16 +313,13 @@ def in_bot_channel():
 
 def in_bot_channel_strict():
     async def predicate(ctx):
-        if guild_setting(ctx.guild.id, 'bot_channels_strict') is None:
-            if guild_setting(ctx.guild.id, 'bot_channels') is None:
-                return True
-            else:
-                chan_list = guild_setting(ctx.guild.id, 'bot_channels')
-        else:
-            chan_list = guild_setting(ctx.guild.id, 'bot_channels_strict')
+        # bot_channels_strict falls back to bot_channels when it is None. See _compile_guild()
+        snapshot = guild_settings(ctx.guild.id)
+        if snapshot.strict_channels is None:
+            return True
         if is_mod(ctx):
             return True
-        if ctx.message.channel.id in chan_list + guild_setting(ctx.guild.id, 'bot_channels_private'):
+        if ctx.message.channel.id in snapshot.strict_channels_allowed:
             return True
         else:
             if ctx.invoked_with == 'help' and ctx.command.name != 'help':
@@ -180,7 +327,10 @@ def in_bot_channel_strict():
                 pass
             else:
                 # primary_bot_channel = chan_list[0]
-                channel_tags = [f'<#{chan_id}>' for chan_id in chan_list]
+                channel_tags = [f'<#{chan_id}>' for chan_id in snapshot.strict_channel_list]
                 await ctx.send(f'This command can only be used in a designated bot spam channel. Try: {" ".join(channel_tags)}')
             return False
     return commands.check(predicate)
+
+
+compile_guild_settings()
@@ -0,0 +1,41 @@
+import datetime
+import math
+
+from modules.downsample import lttb, downsample_history
+
+
+def test_short_series_is_returned_whole():
+    xs, ys = [0, 1, 2, 3], [5, 6, 7, 8]
+    assert lttb(xs, ys, threshold=10) == [0, 1, 2, 3]
+    assert lttb(xs, ys, threshold=4) == [0, 1, 2, 3]
+
+
+def test_keeps_endpoints_and_threshold():
+    n = 5000
+    xs = list(range(n))
+    ys = [math.sin(i / 50) * 100 for i in xs]
+
+    for threshold in (3, 10, 300):
+        keep = lttb(xs, ys, threshold)
+        assert len(keep) == threshold
+        assert keep[0] == 0 and keep[-1] == n - 1
+        assert keep == sorted(set(keep))
+
+
+def test_keeps_a_lone_spike():
+    xs = list(range(1000))
+    ys = [1000] * 1000
+    ys[537] = 1400
+    assert 537 in lttb(xs, ys, threshold=50)
+
+
+def test_downsample_history_returns_selected_points():
+    start = datetime.datetime(2020, 5, 1, 12, 30)
+    rows = [(start + datetime.timedelta(hours=i), 1000 + (i % 40)) for i in range(2000)]
+
+    dates, elos = downsample_history(iter(rows), threshold=100)
+
+    assert len(dates) == len(elos) == 100
+    assert (dates[0], elos[0]) == rows[0]
+    assert (dates[-1], elos[-1]) == rows[-1]
+    assert dates == sorted(dates)
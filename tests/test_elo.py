@@ -0,0 +1,83 @@
+import datetime
+import random
+
+import pytest
+
+import modules.elo as elo_engine
+
+
+def synthetic_games(count, player_count=40, seed=0):
+    # (game_id, winner_id, loser_id, losing_score, completed_ts) in completion order
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 5, 1)
+    games = []
+    for game_id in range(1, count + 1):
+        winner, loser = rng.sample(range(1, player_count + 1), 2)
+        games.append((game_id, winner, loser, rng.choice((0, 1, 2)), start + datetime.timedelta(minutes=game_id)))
+    return games
+
+
+def confirm_sequentially(games, ratings=None):
+    # Reference model of Game.confirm(): each game's deltas are computed from the players' current ELO and applied before the next game
+    ratings = dict(ratings) if ratings else {}
+    changes = {}
+    for game_id, winner, loser, losing_score, _ in games:
+        winner_elo, winner_max = ratings.get(winner, (elo_engine.DEFAULT_ELO, elo_engine.DEFAULT_ELO))
+        loser_elo, loser_max = ratings.get(loser, (elo_engine.DEFAULT_ELO, elo_engine.DEFAULT_ELO))
+        winner_delta = elo_engine.elo_delta(winner_elo, loser_elo, losing_score, for_winner=True)
+        loser_delta = elo_engine.elo_delta(winner_elo, loser_elo, losing_score, for_winner=False)
+        winner_elo, loser_elo = int(winner_elo + winner_delta), int(loser_elo + loser_delta)
+        ratings[winner] = (winner_elo, max(winner_max, winner_elo))
+        ratings[loser] = (loser_elo, loser_max)
+        changes[game_id] = (winner_delta, loser_delta, winner_elo, loser_elo)
+    return ratings, changes
+
+
+def test_replay_matches_sequential_confirm():
+    games = synthetic_games(400)
+    expected_ratings, expected_changes = confirm_sequentially(games)
+
+    result = elo_engine.replay_games(games)
+
+    assert len(result) == len(games)
+    assert {p_id: (elo, elo_max) for p_id, elo, elo_max in result.player_ratings()} == expected_ratings
+    for game_id, winner_delta, loser_delta in result.game_changes():
+        assert (winner_delta, loser_delta) == expected_changes[game_id][:2]
+
+    elo_after = {(game_id, p_id): elo for game_id, p_id, elo in result.playergame_elos()}
+    for game_id, winner, loser, _, _ in games:
+        assert elo_after[(game_id, winner)] == expected_changes[game_id][2]
+        assert elo_after[(game_id, loser)] == expected_changes[game_id][3]
+
+
+def test_tail_replay_from_seed_matches_full_replay():
+    # recalculate_elo_since() seeds players from their ratings before the tail and replays only the tail
+    games = synthetic_games(300, seed=1)
+    head, tail = games[:180], games[180:]
+    seed_ratings, _ = confirm_sequentially(head)
+    expected_ratings, _ = confirm_sequentially(games)
+
+    idle_player = 999
+    result = elo_engine.replay_games(tail, seed_ratings=seed_ratings, players=[idle_player])
+    ratings = {p_id: (elo, elo_max) for p_id, elo, elo_max in result.player_ratings()}
+
+    assert ratings.pop(idle_player) == (elo_engine.DEFAULT_ELO, elo_engine.DEFAULT_ELO)
+    for p_id, rating in ratings.items():
+        assert rating == expected_ratings[p_id]
+
+
+@pytest.mark.parametrize('every', [1, 50, 400])
+def test_checkpoint_callback_sees_ratings_as_of_its_game(every):
+    games = synthetic_games(200, seed=2)
+    seen = []
+
+    def on_checkpoint(result, game_id, completed_ts):
+        seen.append((len(result), game_id, sorted(result.player_ratings())))
+
+    elo_engine.replay_games(games, checkpoint_every=every, on_checkpoint=on_checkpoint)
+
+    assert [count for count, _, _ in seen] == list(range(every, len(games) + 1, every))
+    for count, game_id, ratings in seen:
+        assert game_id == games[count - 1][0]
+        expected, _ = confirm_sequentially(games[:count])
+        assert {p_id: (elo, elo_max) for p_id, elo, elo_max in ratings} == expected
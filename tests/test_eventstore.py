@@ -0,0 +1,69 @@
+import datetime
+import random
+
+import pytest
+
+import modules.elo as elo_engine
+from modules.eventstore import EloEventLog
+
+
+def synthetic_games(count, player_count=20, seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 5, 1)
+    games = []
+    for game_id in range(1, count + 1):
+        winner, loser = rng.sample(range(1, player_count + 1), 2)
+        games.append((game_id, winner, loser, rng.choice((0, 1, 2)), start + datetime.timedelta(minutes=game_id)))
+    return games
+
+
+def ratings_of(result):
+    return {p_id: elo for p_id, elo, _ in result.player_ratings()}
+
+
+def log_delete(log, games, deleted_id):
+    # Write what Game.delete_game() writes for deleted_id: a 'delete' record with both players' ELO before and after,
+    # then the 'recalc' records of the replay of every later game. Returns the games that remain
+    i = next(i for i, game in enumerate(games) if game[0] == deleted_id)
+    _, winner, loser, _, completed_ts = games[i]
+    remaining = games[:i] + games[i + 1:]
+
+    before = ratings_of(elo_engine.replay_games(games))
+    seed = {p_id: (elo, elo_max) for p_id, elo, elo_max in elo_engine.replay_games(games[:i]).player_ratings()}
+    tail = elo_engine.replay_games(remaining[i:], seed_ratings=seed, players=[winner, loser])
+    after = ratings_of(elo_engine.replay_games(remaining))
+
+    log.record_game('delete', deleted_id, completed_ts, winner, before[winner], after[winner], loser, before[loser], after[loser])
+    log.record_replay(tail, completed_ts={game[0]: game[4] for game in remaining[i:]})
+    return remaining
+
+
+@pytest.mark.parametrize('deleted_id', [1, 120, 300])
+def test_log_replays_to_current_ratings_across_a_delete(tmp_path, deleted_id):
+    games = synthetic_games(300)
+    log = EloEventLog(directory=str(tmp_path), segment_max_bytes=8192)  # small segments, so the log rolls over several times
+    log.record_replay(elo_engine.replay_games(games), completed_ts={game[0]: game[4] for game in games})
+    assert log.ratings() == ratings_of(elo_engine.replay_games(games))
+
+    remaining = log_delete(log, games, deleted_id)
+    expected = ratings_of(elo_engine.replay_games(remaining))
+    assert log.ratings() == expected
+
+    log.close()
+    reopened = EloEventLog(directory=str(tmp_path), segment_max_bytes=8192)
+    assert reopened.ratings() == expected
+
+
+def test_deleting_the_latest_game_is_logged(tmp_path):
+    # no later games are replayed, so the 'delete' record is the only record of the change
+    games = synthetic_games(50, seed=1)
+    log = EloEventLog(directory=str(tmp_path), segment_max_bytes=1 << 20)
+    log.record_replay(elo_engine.replay_games(games))
+    _, winner, loser, _, _ = games[-1]
+
+    log_delete(log, games, games[-1][0])
+
+    latest = list(log.for_player(winner))[-1]
+    assert latest['event'] == 'delete' and latest['game'] == games[-1][0]
+    assert latest['winner_delta'] < 0 and list(log.for_player(loser))[-1]['loser_delta'] > 0
+    assert log.ratings() == ratings_of(elo_engine.replay_games(games[:-1]))
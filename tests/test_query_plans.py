@@ -0,0 +1,24 @@
+import contextlib
+import os
+
+import pytest
+
+# Runs benchmarks/check_query_plans.py against a scratch database, given by name in SPIES_TEST_DATABASE (all bot tables in it are
+# dropped, SPIES_TEST_DATABASE_USER overrides psql_user) or created with initdb when SPIES_TEST_TEMP_CLUSTER=1. Needs config.ini,
+# so run from the repository root. Skipped only when neither is set - a configured database that can't be reached fails the test
+
+
+def test_hot_queries_use_indexes():
+    database = os.environ.get('SPIES_TEST_DATABASE')
+    temp_cluster = os.environ.get('SPIES_TEST_TEMP_CLUSTER') == '1'
+    if not database and not temp_cluster:
+        pytest.skip('no database configured, set SPIES_TEST_DATABASE or SPIES_TEST_TEMP_CLUSTER=1')
+
+    from benchmarks.bench_models import open_database
+    from benchmarks.check_query_plans import check_plans
+
+    with contextlib.ExitStack() as stack:
+        models, settings = open_database(stack, database=database, user=os.environ.get('SPIES_TEST_DATABASE_USER'), temp_cluster=temp_cluster)
+        failures = check_plans(models, settings, players=500, games=5000)
+
+    assert not failures, '\n'.join(f'{name}: sequential scan on {", ".join(scanned)}\n    {sql}' for name, sql, scanned in failures)
@@ -0,0 +1,76 @@
+import random
+
+import pytest
+
+from modules.ratingindex import RatingIndex
+
+
+def brute_force_rank(ratings, player_id, max_flag=False, dense=False):
+    # RANK() / DENSE_RANK() over ratings sorted by descending value
+    values = [r[1 if max_flag else 0] for r in ratings.values()]
+    value = ratings[player_id][1 if max_flag else 0]
+    if dense:
+        return len({v for v in values if v > value}) + 1
+    return sum(1 for v in values if v > value) + 1
+
+
+def random_ratings(rng, count):
+    ratings = {}
+    for player_id in range(1, count + 1):
+        elo = rng.randint(850, 1250)  # narrow range, so there are plenty of ties
+        ratings[player_id] = (elo, elo + rng.randint(0, 60))
+    return ratings
+
+
+@pytest.mark.parametrize('max_flag', [False, True])
+@pytest.mark.parametrize('dense', [False, True])
+def test_ranks_match_brute_force(max_flag, dense):
+    rng = random.Random(0)
+    ratings = random_ratings(rng, 500)
+    index = RatingIndex()
+    index.load(((p_id, elo, elo_max) for p_id, (elo, elo_max) in ratings.items()), date_cutoff=None)
+
+    for player_id in ratings:
+        assert index.rank(player_id, max_flag=max_flag, dense=dense) == brute_force_rank(ratings, player_id, max_flag=max_flag, dense=dense)
+
+
+def test_ranks_stay_correct_through_updates_and_discards():
+    rng = random.Random(1)
+    ratings = random_ratings(rng, 300)
+    index = RatingIndex()
+    index.load(((p_id, elo, elo_max) for p_id, (elo, elo_max) in ratings.items()), date_cutoff=None)
+
+    for _ in range(2000):
+        player_id = rng.randint(1, 400)
+        if rng.random() < 0.1:
+            index.discard(player_id)
+            ratings.pop(player_id, None)
+        else:
+            elo = rng.randint(850, 1250)
+            ratings[player_id] = (elo, max(elo, ratings.get(player_id, (0, 0))[1]))
+            index.update(player_id, *ratings[player_id])
+
+    assert len(index) == len(ratings)
+    assert index.rank(401) is None
+    for player_id in ratings:
+        for max_flag in (False, True):
+            for dense in (False, True):
+                assert index.rank(player_id, max_flag=max_flag, dense=dense) == brute_force_rank(ratings, player_id, max_flag=max_flag, dense=dense)
+
+
+def test_refresh_applies_loaded_rows_and_drops_missing_players():
+    index = RatingIndex()
+    index.load([(1, 1100, 1100), (2, 1000, 1050), (3, 900, 1000)], date_cutoff=None)
+
+    index.refresh([2, 3], lambda: [(2, 1200, 1200)])
+
+    assert 3 not in index
+    assert index.rank(2) == 1
+    assert index.rank(1) == 2
+
+
+def test_extreme_values_fit_the_tree():
+    index = RatingIndex()
+    index.load([(1, -32768, -32768), (2, 32767, 32767), (3, 0, 0)], date_cutoff=None)
+    assert [index.rank(p_id) for p_id in (2, 3, 1)] == [1, 2, 3]
+    assert index.rank(1, dense=True) == 3